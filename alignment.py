@@ -0,0 +1,248 @@
+from create_database import MyDB
+from shingles import tokenize_with_offsets, hash_tokens, shingle_hashes
+import sql_queries as SQ
+import argparse
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+def seeds(a: np.ndarray, b: np.ndarray, seed_size: int = 6, max_repeats: int = 8) -> np.ndarray:
+    '''(i, j) token positions where a run of seed_size tokens of a also occurs in b. Runs repeated more than max_repeats times in b are ignored'''
+    sa = shingle_hashes(a, seed_size)
+    sb = shingle_hashes(b, seed_size)
+    if len(sa) == 0 or len(sb) == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+    order = np.argsort(sb, kind='stable')
+    sorted_b = sb[order]
+    lo = np.searchsorted(sorted_b, sa, side='left')
+    hi = np.searchsorted(sorted_b, sa, side='right')
+    counts = np.where(hi - lo <= max_repeats, hi - lo, 0)
+    i = np.repeat(np.arange(len(sa)), counts)
+    j = order[np.repeat(lo, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)]
+    return np.stack([i, j], axis=1)
+
+def regions(hits: np.ndarray, band: int = 16, max_gap: int = 50) -> list:
+    '''Group seeds into regions of nearby diagonals (within band) with gaps of at most max_gap tokens. Returns [(i_min, i_max, d_min, d_max)], d = j - i'''
+    if len(hits) == 0:
+        return []
+    diag = hits[:, 1] - hits[:, 0]
+    order = np.argsort(diag, kind='stable')
+    diag, i = diag[order], hits[order, 0]
+    # neighbouring diagonals form one group, and each group is split where the seeds are far apart
+    groups = np.split(np.arange(len(diag)), np.flatnonzero(np.diff(diag) > band) + 1)
+    found = []
+    for group in groups:
+        group = group[np.argsort(i[group], kind='stable')]
+        for run in np.split(group, np.flatnonzero(np.diff(i[group]) > max_gap) + 1):
+            found.append((int(i[run].min()), int(i[run].max()), int(diag[run].min()), int(diag[run].max())))
+    return found
+
+def banded_smith_waterman(a: np.ndarray, b: np.ndarray, d_min: int, d_max: int,
+                          match: int = 2, mismatch: int = -1, gap: int = 1):
+    '''
+    Best local alignment of token hash arrays a and b restricted to the diagonals d_min <= j - i <= d_max. Returns (score, i_start, i_end, j_start, j_end) with inclusive token positions, or None.
+
+    The band is processed a row at a time with whole-row NumPy operations: cell t of a row is column j = i + d_min + t. Diagonal and vertical moves only depend on the previous row. Horizontal gaps depend on cells to the left in the same row; with a linear gap penalty, H[t] = max over k <= t of (T[k] - (t - k) * gap), which is a prefix maximum of T[k] + k * gap, so np.maximum.accumulate resolves the whole row at once.
+    '''
+    n, m = len(a), len(b)
+    width = d_max - d_min + 1
+    t = np.arange(width)
+    ramp = t * gap
+    # scores of the whole band at once; cells outside b are masked out
+    j = np.arange(n)[:, None] + d_min + t
+    inside = (j >= 0) & (j < m)
+    scores = np.where(b[np.clip(j, 0, m - 1)] == a[:, None], match, mismatch)
+    # start cell of the best alignment ending in each cell, packed as i * (m + 1) + j. Before row 0, every alignment starts at (0, j)
+    h_prev = np.zeros(width + 1, dtype=np.int64)
+    start_prev = np.append(np.clip(j[0], 0, m), 0)
+    best_score = 0
+    best = None
+    for i in range(n):
+        # in band coordinates, (i-1, j-1) is cell t and (i-1, j) is cell t+1 of the previous row
+        diagonal = h_prev[:width] + scores[i]
+        up = h_prev[1:] - gap
+        use_diagonal = diagonal >= up
+        cell = np.where(inside[i], np.maximum(np.where(use_diagonal, diagonal, up), 0), 0)
+        start = np.where(use_diagonal, start_prev[:width], start_prev[1:])
+
+        # horizontal gaps: prefix maximum of cell[k] + k * gap, and the position it came from
+        shifted = cell + ramp
+        running = np.maximum.accumulate(shifted)
+        source = np.maximum.accumulate(np.where(shifted == running, t, 0))
+        h = np.where(inside[i], running - ramp, 0)
+        start = start[source]
+
+        k = h.argmax()
+        if h[k] > best_score:
+            best_score = int(h[k])
+            best = (best_score, int(start[k] // (m + 1)), i, int(start[k] % (m + 1)), int(j[i, k]))
+        # the next alignment through a cell at zero starts at the following cell
+        h_prev[:width] = h
+        start_prev[:width] = np.where(h > 0, start, (i + 1) * (m + 1) + j[i] + 1)
+    return best
+
+def align_texts(text_a: str, text_b: str, seed_size: int = 6, band: int = 16, max_gap: int = 50,
+                min_tokens: int = 20, match: int = 2, mismatch: int = -1, gap: int = 1) -> list:
+    '''
+    Passages shared by two texts. Exact seed matches of seed_size tokens are grouped into regions and each region is extended with a banded Smith-Waterman alignment of the hashed tokens. Returns [(a_start, a_end, b_start, b_end, tokens, score)] with character offsets into the texts, longest first.
+    '''
+    tokens_a, starts_a, ends_a = tokenize_with_offsets(text_a)
+    tokens_b, starts_b, ends_b = tokenize_with_offsets(text_b)
+    a, b = hash_tokens(tokens_a), hash_tokens(tokens_b)
+    passages = []
+    seen = set()
+    for i_min, i_max, d_min, d_max in regions(seeds(a, b, seed_size), band, max_gap):
+        # align the region plus a margin on both sides, so the passage can extend past the outermost seeds
+        lo = max(0, i_min - max_gap)
+        hi = min(len(a), i_max + seed_size + max_gap)
+        found = banded_smith_waterman(a[lo:hi], b, d_min + lo - band, d_max + lo + band, match, mismatch, gap)
+        if found is None:
+            continue
+        score, si, ei, sj, ej = found
+        si, ei = si + lo, ei + lo
+        if ei - si + 1 < min_tokens or (si, ei, sj, ej) in seen:
+            continue
+        seen.add((si, ei, sj, ej))
+        passages.append((int(starts_a[si]), int(ends_a[ei]), int(starts_b[sj]), int(ends_b[ej]), ei - si + 1, score))
+    return sorted(passages, key=lambda passage: -passage[4])
+
+def _align_batch(args):
+    '''Align a batch of (bill_id, other_id, content, other_content), run in a worker process'''
+    pairs, options = args
+    return [(bill_id, other_id, align_texts(text_a, text_b, **options)) for bill_id, other_id, text_a, text_b in pairs]
+
+class PassageAligner:
+    '''
+    Extracts the passages two similar bills share, for candidate pairs found by minhash.MinHashLSH (tNearDuplicates) or another pair table with bill_id and other_id columns. Pairs are aligned on a process pool with align_texts and the passages are written to tAlignments with character offsets into tBills.content of both bills, so they can be highlighted. Each pair is checkpointed in tAlignmentRuns; the passages and checkpoint of a pair are dropped when the text of either bill changes, so it is aligned again, and every run drops those of pairs that are no longer in the candidate table.
+
+    class parameters:
+
+    db: MyDB instance for legislation.db (default: MyDB())
+    pairs_table: table of candidate pairs (default: str = 'tNearDuplicates')
+    seed_size: number of words in an exact seed match (default: int = 6)
+    band: number of diagonals on either side of the seeds the alignment may use, i.e. the largest net insertion or deletion inside a passage (default: int = 16)
+    max_gap: seeds further apart than this many words start a new passage (default: int = 50)
+    min_tokens: shortest passage stored, in words (default: int = 20)
+    batch_size: number of pairs per worker task (default: int = 32)
+    max_workers: number of aligning processes, None uses every core (default: None)
+    '''
+
+    def __init__(self,
+                 db: MyDB = None,
+                 pairs_table: str = 'tNearDuplicates',
+                 seed_size: int = 6,
+                 band: int = 16,
+                 max_gap: int = 50,
+                 min_tokens: int = 20,
+                 batch_size: int = 32,
+                 max_workers: int = None,
+                ):
+        self.db = db if db is not None else MyDB()
+        self.pairs_table = pairs_table
+        self.options = {'seed_size': seed_size, 'band': band, 'max_gap': max_gap, 'min_tokens': min_tokens}
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.build_tables()
+
+    def build_tables(self):
+        '''Create the alignment and checkpoint tables if they do not exist'''
+        self.db.connect()
+        for sql in SQ.SQL_ALIGNMENTS_BUILD:
+            self.db.curs.execute(sql)
+        self.db.close()
+        return
+
+    def pending_pairs(self, limit: int = None) -> list:
+        '''(bill_id, other_id) candidate pairs, with bill_id < other_id, that have not been aligned since their text changed'''
+        self.db.connect()
+        sql = SQ.SQL_PENDING_ALIGNMENT_PAIRS.format(self.pairs_table) + ('' if limit is None else ' LIMIT ' + str(int(limit)))
+        pairs = self.db.curs.execute(sql).fetchall()
+        self.db.close()
+        return pairs
+
+    def read_pairs(self, pairs: list) -> list:
+        '''(bill_id, other_id, content, other_content) for pairs where both bills have text'''
+        bill_ids = sorted({bill_id for pair in pairs for bill_id in pair})
+        self.db.connect()
+        contents = dict(self.db.curs.execute(SQ.SQL_SELECT_CONTENT.format(', '.join('?' * len(bill_ids))), bill_ids).fetchall())
+        self.db.close()
+        return [(bill_id, other_id, contents[bill_id], contents[other_id]) for bill_id, other_id in pairs
+                if bill_id in contents and other_id in contents]
+
+    def drop_stale(self) -> int:
+        '''Delete the passages and checkpoints of pairs that are no longer in the candidate table, in one transaction. Returns the number of checkpoints deleted'''
+        self.db.connect()
+        self.db.curs.execute('BEGIN;')
+        try:
+            for sql in SQ.SQL_DELETE_STALE_ALIGNMENTS:
+                self.db.curs.execute(sql.format(self.pairs_table))
+            dropped = self.db.curs.rowcount
+            self.db.curs.execute('COMMIT;')
+        except Exception:
+            self.db.curs.execute('ROLLBACK;')
+            raise
+        finally:
+            self.db.close()
+        return dropped
+
+    def write_alignments(self, results: list, pairs: list):
+        '''Replace the passages of a set of pairs and checkpoint them, in one transaction'''
+        self.db.connect()
+        self.db.curs.execute('BEGIN;')
+        try:
+            self.db.curs.executemany(SQ.SQL_DELETE_ALIGNMENTS, pairs)
+            self.db.curs.executemany(SQ.SQL_INSERT_ALIGNMENT, [(bill_id, other_id) + passage
+                                                               for bill_id, other_id, passages in results for passage in passages])
+            self.db.curs.executemany(SQ.SQL_UPSERT_ALIGNMENT_RUN, pairs)
+            self.db.curs.execute('COMMIT;')
+        except Exception:
+            self.db.curs.execute('ROLLBACK;')
+            raise
+        finally:
+            self.db.close()
+        return
+
+    def run(self, limit: int = None) -> int:
+        '''Drop the passages of pairs that are no longer candidates and align every pending pair. Returns the number of pairs aligned'''
+        print(self.drop_stale(), 'pairs no longer candidates')
+        pending = self.pending_pairs(limit)
+        print(len(pending), 'pairs to align')
+        workers = self.max_workers or os.cpu_count() or 1
+        window = self.batch_size * workers
+        done = 0
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for i in range(0, len(pending), window):
+                chunk = pending[i:i + window]
+                pairs = self.read_pairs(chunk)
+                batches = [(pairs[j:j + self.batch_size], self.options) for j in range(0, len(pairs), self.batch_size)]
+                results = [result for batch in pool.map(_align_batch, batches) for result in batch]
+                self.write_alignments(results, chunk)
+                done += len(chunk)
+                print(done, 'of', len(pending), 'pairs aligned')
+        return done
+
+    def passages(self, bill_id: int, other_id: int) -> list:
+        '''
+        Shared passages of two bills as [(start, end, other_start, other_end, tokens, score)], with offsets into the content of bill_id and of other_id. Pairs that were never aligned are aligned now.
+        '''
+        first, second = min(bill_id, other_id), max(bill_id, other_id)
+        self.db.connect()
+        aligned = self.db.curs.execute(SQ.SQL_SELECT_ALIGNMENT_RUN, (first, second)).fetchone()
+        rows = self.db.curs.execute(SQ.SQL_SELECT_ALIGNMENTS, (first, second)).fetchall()
+        self.db.close()
+        if aligned is None:
+            pairs = self.read_pairs([(first, second)])
+            if len(pairs) == 0:
+                return []
+            rows = align_texts(pairs[0][2], pairs[0][3], **self.options)
+        if bill_id != first:
+            rows = [(b_start, b_end, a_start, a_end, tokens, score) for a_start, a_end, b_start, b_end, tokens, score in rows]
+        return [tuple(row) for row in rows]
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Align candidate bill pairs and store the passages they share')
+    args.add_argument('--pairs-table', default='tNearDuplicates')
+    args.add_argument('--max-workers', type=int, default=None)
+    args.add_argument('--limit', type=int, default=None)
+    args = args.parse_args()
+    PassageAligner(pairs_table=args.pairs_table, max_workers=args.max_workers).run(args.limit)
@@ -0,0 +1,242 @@
+import json
+import os
+import shutil
+import numpy as np
+
+class ArrayStore:
+    '''
+    Append-only on-disk store of one NumPy array per bill, read through memory maps. Rows either all have width elements (MinHash signatures, embeddings), so the data is a rows x width matrix, or have any length (shingle sets), with the start of every row in an offsets file. Every row records its bill_id, and a sorted index of bill_id -> row finds the current row of a bill with a binary search.
+
+    append() only writes at the end of the files. A bill that is appended again gets a new row and the index points to it; its old row stays on disk, no longer live, until compact(). Bulk loads pass index=False to every append() and call update_index() once at the end, so the index is rewritten once rather than once per batch; until then the new rows are on disk but not live. meta.json holds the number of committed rows and is replaced last, so readers and a crashed writer only ever see whole appends: bytes past the committed length are ignored and cut off by the next append. The index is written under a new file name on every append for the same reason.
+
+    Readers get views of the memory maps (matrix, row(), get()), not copies, so several processes opening the same store share its pages in the OS cache. A reader sees appends made after it opened the store when it calls open() again.
+
+    class parameters:
+
+    path: directory of the store
+    dtype: type of the elements, required when the store is created (default: None, read from the store)
+    width: number of elements per row, or None for rows of any length (default: None, read from the store)
+    '''
+
+    def __init__(self, path: str, dtype=None, width: int = None):
+        self.path = path
+        self.arrays = None
+        if os.path.exists(os.path.join(path, 'meta.json')):
+            with open(os.path.join(path, 'meta.json')) as f:
+                self.meta = json.load(f)
+            if (dtype is not None and np.dtype(dtype).str != self.meta['dtype']) or (width is not None and width != self.meta['width']):
+                raise ValueError('the store in {0} holds {1} rows of width {2}'.format(path, self.meta['dtype'], self.meta['width']))
+        elif dtype is None:
+            raise FileNotFoundError('no array store in ' + path)
+        else:
+            self.meta = {'dtype': np.dtype(dtype).str, 'width': width, 'rows': 0, 'size': 0, 'index': 0, 'generation': 0}
+
+    @property
+    def ragged(self) -> bool:
+        return self.meta['width'] is None
+
+    def file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def index_files(self, generation: int) -> tuple:
+        return self.file('keys.{0}.bin'.format(generation)), self.file('rows.{0}.bin'.format(generation))
+
+    @staticmethod
+    def map(path: str, dtype, count: int) -> np.ndarray:
+        '''Read-only memory map of the first count elements of a file (np.memmap cannot map nothing)'''
+        if count == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r', shape=(count,))
+
+    def open(self):
+        '''Memory-map the committed rows; nothing is read until a view is used'''
+        if os.path.exists(self.file('meta.json')):
+            with open(self.file('meta.json')) as f:
+                self.meta = json.load(f)
+        rows, width = self.meta['rows'], self.meta['width']
+        keys, positions = self.index_files(self.meta['generation'])
+        self.arrays = {'ids': self.map(self.file('ids.bin'), '<i8', rows),
+                       'data': self.map(self.file('data.bin'), self.meta['dtype'], self.meta['size']),
+                       'keys': self.map(keys, '<i8', self.meta['index']),
+                       'rows': self.map(positions, '<i8', self.meta['index'])}
+        if self.ragged:
+            self.arrays['offsets'] = self.map(self.file('offsets.bin'), '<i8', rows + 1) if rows > 0 else np.zeros(1, dtype='<i8')
+        else:
+            self.arrays['data'] = self.arrays['data'].reshape(rows, width)
+        self.live_rows = None
+        return self
+
+    def view(self, name: str) -> np.ndarray:
+        if self.arrays is None:
+            self.open()
+        return self.arrays[name]
+
+    @property
+    def rows(self) -> int:
+        return self.meta['rows']
+
+    @property
+    def ids(self) -> np.ndarray:
+        '''bill_id of every row, live or not'''
+        return self.view('ids')
+
+    @property
+    def offsets(self) -> np.ndarray:
+        '''Start of every row in data, and the end of the last one (ragged stores only)'''
+        return self.view('offsets')
+
+    @property
+    def data(self) -> np.ndarray:
+        '''Elements of every row: a rows x width matrix, or one flat array for ragged stores'''
+        return self.view('data')
+
+    matrix = data
+
+    @property
+    def bill_ids(self) -> np.ndarray:
+        '''Sorted bill_ids of the live rows'''
+        return self.view('keys')
+
+    def live(self) -> np.ndarray:
+        '''Boolean mask of the rows that are the current row of their bill'''
+        rows = self.view('rows')
+        if self.live_rows is None:
+            self.live_rows = np.zeros(self.rows, dtype=bool)
+            self.live_rows[np.asarray(rows)] = True
+        return self.live_rows
+
+    def rows_of(self, bill_ids) -> np.ndarray:
+        '''Current row of every bill_id, -1 for bills that are not in the store'''
+        keys, rows = self.view('keys'), self.view('rows')
+        bill_ids = np.asarray(bill_ids, dtype=np.int64).reshape(-1)
+        if len(keys) == 0:
+            return np.full(len(bill_ids), -1, dtype=np.int64)
+        found = np.minimum(np.searchsorted(keys, bill_ids), len(keys) - 1)
+        return np.where(keys[found] == bill_ids, rows[found], -1)
+
+    def row_of(self, bill_id: int) -> int:
+        return int(self.rows_of([bill_id])[0])
+
+    def row(self, row: int) -> np.ndarray:
+        '''View of one row'''
+        if self.ragged:
+            return self.data[self.offsets[row]:self.offsets[row + 1]]
+        return self.data[row]
+
+    def get(self, bill_id: int) -> np.ndarray:
+        '''View of the current row of a bill'''
+        row = self.row_of(bill_id)
+        if row < 0:
+            raise KeyError('bill {0} is not in {1}'.format(bill_id, self.path))
+        return self.row(row)
+
+    def write_meta(self, **changes):
+        meta = dict(self.meta, **changes)
+        with open(self.file('meta.json.tmp'), 'w') as f:
+            json.dump(meta, f)
+        os.replace(self.file('meta.json.tmp'), self.file('meta.json'))
+        self.meta = meta
+        return
+
+    def write_index(self, keys: np.ndarray, rows: np.ndarray) -> int:
+        '''Write the index under the next generation number; it is used once meta.json names that generation'''
+        generation = self.meta['generation'] + 1
+        for path, array in zip(self.index_files(generation), (keys, rows)):
+            with open(path, 'wb') as f:
+                f.write(np.ascontiguousarray(array, dtype='<i8').tobytes())
+        return generation
+
+    def append_file(self, name: str, committed: int, array: np.ndarray):
+        '''Write array after the first committed bytes of a file, cutting off anything a crashed append left behind'''
+        with open(self.file(name), 'ab') as f:
+            f.truncate(committed)
+            f.write(np.ascontiguousarray(array).tobytes())
+        return
+
+    def append(self, bill_ids, arrays, index: bool = True) -> np.ndarray:
+        '''
+        Append one row per bill: arrays is a len(bill_ids) x width array, or a list of 1-d arrays for ragged stores. Bills that are in the store already (or twice in bill_ids) are replaced by their last new row. With index=False the rows are only made live by the next update_index() (or indexed append). Returns the new row numbers.
+        '''
+        bill_ids = np.asarray(bill_ids, dtype=np.int64).reshape(-1)
+        dtype = np.dtype(self.meta['dtype'])
+        if self.ragged:
+            lengths = np.array([len(a) for a in arrays], dtype=np.int64)
+            data = np.concatenate([np.asarray(a, dtype=dtype) for a in arrays]) if len(arrays) > 0 else np.zeros(0, dtype=dtype)
+        else:
+            data = np.asarray(arrays, dtype=dtype).reshape(len(bill_ids), self.meta['width'])
+        if len(bill_ids) != len(data if not self.ragged else lengths):
+            raise ValueError('one array is needed per bill_id')
+        if len(bill_ids) == 0:
+            return np.zeros(0, dtype=np.int64)
+        os.makedirs(self.path, exist_ok=True)
+        first, size = self.meta['rows'], self.meta['size']
+        self.append_file('data.bin', size * dtype.itemsize, data)
+        self.append_file('ids.bin', first * 8, bill_ids.astype('<i8'))
+        if self.ragged:
+            starts = size + np.concatenate([[0] if first == 0 else [], np.cumsum(lengths)]).astype('<i8')
+            self.append_file('offsets.bin', (first + 1) * 8 if first > 0 else 0, starts)
+        new_rows = np.arange(first, first + len(bill_ids), dtype=np.int64)
+        # rows before 'indexed' are in the index (stores written before index=False existed index every row)
+        self.write_meta(rows=first + len(bill_ids), size=size + data.size, indexed=self.meta.get('indexed', first))
+        if index:
+            self.update_index()
+        else:
+            self.open()
+        return new_rows
+
+    def update_index(self) -> int:
+        '''Make the rows appended with index=False live: the index keeps the last row of every bill. Returns the number of rows added to the index'''
+        first = self.meta.get('indexed', self.meta['rows'])
+        if first == self.meta['rows']:
+            return 0
+        if self.arrays is None or len(self.arrays['ids']) != self.meta['rows']:
+            self.open()
+        bill_ids = np.asarray(self.ids[first:])
+        new_rows = np.arange(first, self.meta['rows'], dtype=np.int64)
+        last = len(bill_ids) - 1 - np.unique(bill_ids[::-1], return_index=True)[1]
+        keys, rows = np.asarray(self.view('keys')), np.asarray(self.view('rows'))
+        kept = ~np.isin(keys, bill_ids[last])
+        keys, rows = np.concatenate([keys[kept], bill_ids[last]]), np.concatenate([rows[kept], new_rows[last]])
+        order = np.argsort(keys, kind='stable')
+        old = self.meta['generation']
+        generation = self.write_index(keys[order], rows[order])
+        self.write_meta(index=len(keys), generation=generation, indexed=self.meta['rows'])
+        for path in self.index_files(old):
+            if os.path.exists(path):
+                os.remove(path)
+        self.open()
+        return len(bill_ids)
+
+    def retire(self, bill_ids):
+        '''Remove bills from the index; their rows stay on disk until compact()'''
+        keys, rows = np.asarray(self.view('keys')), np.asarray(self.view('rows'))
+        kept = ~np.isin(keys, np.asarray(bill_ids, dtype=np.int64))
+        old = self.meta['generation']
+        generation = self.write_index(keys[kept], rows[kept])
+        self.write_meta(index=int(kept.sum()), generation=generation)
+        for path in self.index_files(old):
+            if os.path.exists(path):
+                os.remove(path)
+        self.open()
+        return
+
+    def compact(self, batch_size: int = 65536):
+        '''Rewrite the store with only its live rows, in bill_id order. Row numbers change, so anything built on them has to be rebuilt'''
+        keys, rows = np.asarray(self.bill_ids), np.asarray(self.view('rows'))
+        # a store left behind by an interrupted compact() is removed before it is opened
+        shutil.rmtree(self.path + '.compact', ignore_errors=True)
+        new = ArrayStore(self.path + '.compact', self.meta['dtype'], self.meta['width'])
+        for i in range(0, len(keys), batch_size):
+            chunk = rows[i:i + batch_size]
+            new.append(keys[i:i + batch_size], [np.asarray(self.row(r)) for r in chunk] if self.ragged else np.asarray(self.data[chunk]), index=False)
+        new.update_index()
+        if len(keys) == 0:
+            os.makedirs(new.path)
+            new.write_meta()
+        self.arrays = None
+        old = self.path + '.old'
+        shutil.rmtree(old, ignore_errors=True)
+        os.rename(self.path, old)
+        os.rename(new.path, self.path)
+        shutil.rmtree(old, ignore_errors=True)
+        return self.open()
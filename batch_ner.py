@@ -0,0 +1,126 @@
+from create_database import MyDB
+from ner import NERService
+from rollups import Rollups
+import sql_queries as SQ
+import argparse
+import collections
+import time
+
+class BatchNER:
+    '''
+    Headless named entity recognition over every bill with text in tBills. Bills are streamed from the database through one nlp.pipe call (with worker processes), and the entities are written to a normalized tEntities table. The per state/session/status entity counts in tEntityRollup are updated in the same transactions. Every batch of bills is committed together with its rows in tEntityRuns, which acts as the checkpoint: an interrupted run picks up with the bills that have not been processed by the current model, and Bill.save clears the checkpoint of a bill whose text changes.
+
+    class parameters:
+
+    db: MyDB instance for legislation.db (default: MyDB())
+    model: spaCy pipeline to use (default: str = 'en_core_web_sm')
+    profile: pipeline profile from ner.PIPELINE_PROFILES (default: str = 'ner')
+    batch_size: number of bills written per transaction/checkpoint (default: int = 64)
+    n_process: number of NER worker processes, -1 uses every core (default: int = -1)
+    '''
+
+    def __init__(self,
+                 db: MyDB = None,
+                 model: str = 'en_core_web_sm',
+                 profile: str = 'ner',
+                 batch_size: int = 64,
+                 n_process: int = -1,
+                ):
+        self.db = db if db is not None else MyDB()
+        self.ner = NERService(model=model, profile=profile, n_process=n_process)
+        self.batch_size = batch_size
+        self.build_tables()
+        self.rollups = Rollups(self.db)
+
+    def build_tables(self):
+        '''Create tEntities, its indexes and the checkpoint table if they do not exist'''
+        self.db.connect()
+        for sql in SQ.SQL_ENTITIES_BUILD:
+            self.db.curs.execute(sql)
+        self.db.close()
+        return
+
+    def pending_bills(self, limit: int = None) -> list:
+        '''bill_ids with text that have not been processed by the current model'''
+        self.db.connect()
+        sql = SQ.SQL_PENDING_ENTITY_BILLS + ('' if limit is None else ' LIMIT ' + str(int(limit)))
+        bill_ids = [row[0] for row in self.db.curs.execute(sql, (self.ner.model_name,))]
+        self.db.close()
+        return bill_ids
+
+    def stream_bills(self, bill_ids: list):
+        '''Yield (bill_id, content) for the given bills, reading batch_size rows from the database at a time'''
+        for i in range(0, len(bill_ids), self.batch_size):
+            chunk = bill_ids[i:i + self.batch_size]
+            sql = SQ.SQL_SELECT_CONTENT.format(', '.join('?' * len(chunk)))
+            for row in self.db.curs.execute(sql, chunk).fetchall():
+                yield row
+
+    def write_batch(self, batch: list):
+        '''Replace the entities of a batch of (bill_id, content_hash, doc) and checkpoint them in one transaction'''
+        entities = []
+        runs = []
+        for bill_id, content_hash, doc in batch:
+            entities.extend({'bill_id': bill_id, 'label': ent.label_, 'text': ent.text, 'start': ent.start_char, 'end': ent.end_char}
+                            for ent in doc.ents)
+            runs.append({'bill_id': bill_id, 'model': self.ner.model_name, 'content_hash': content_hash})
+        self.db.curs.execute('BEGIN;')
+        try:
+            bill_ids = [run['bill_id'] for run in runs]
+            self.rollups.remove(self.db.curs, 'entity', bill_ids)
+            self.db.curs.executemany(SQ.SQL_DELETE_ENTITIES, [{'bill_id': bill_id} for bill_id in bill_ids])
+            self.db.curs.executemany(SQ.SQL_INSERT_ENTITY, entities)
+            self.rollups.add(self.db.curs, 'entity', bill_ids)
+            self.db.curs.executemany(SQ.SQL_UPSERT_ENTITY_RUN, runs)
+            self.db.curs.execute('COMMIT;')
+        except Exception:
+            self.db.curs.execute('ROLLBACK;')
+            raise
+        return len(entities)
+
+    def run(self, limit: int = None) -> int:
+        '''Process every pending bill (or the first limit of them) and return the number of bills written'''
+        self.rollups.move_changed('entity')
+        bill_ids = self.pending_bills(limit)
+        print(len(bill_ids), 'bills to process with', self.ner.model_name)
+        if len(bill_ids) == 0:
+            return 0
+
+        self.db.connect()
+        rows = collections.deque()
+        def texts():
+            # remember which bill each text belongs to; iter_docs yields Docs in the same order
+            for bill_id, content in self.stream_bills(bill_ids):
+                rows.append(bill_id)
+                yield content
+
+        done = 0
+        n_entities = 0
+        started = time.time()
+        batch = []
+        try:
+            for doc in self.ner.iter_docs(texts()):
+                bill_id = rows.popleft()
+                batch.append((bill_id, self.ner.content_hash(doc.text), doc))
+                if len(batch) == self.batch_size:
+                    n_entities += self.write_batch(batch)
+                    done += len(batch)
+                    batch = []
+                    print(done, 'of', len(bill_ids), 'bills,', n_entities, 'entities,', round(time.time() - started), 's')
+            if len(batch) > 0:
+                n_entities += self.write_batch(batch)
+                done += len(batch)
+        finally:
+            self.db.close()
+        print(done, 'bills,', n_entities, 'entities written')
+        return done
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Run NER over every fetched bill and write the entities to tEntities')
+    args.add_argument('--model', default='en_core_web_sm')
+    args.add_argument('--profile', default='ner')
+    args.add_argument('--batch-size', type=int, default=64, help='bills per checkpoint')
+    args.add_argument('--n-process', type=int, default=-1, help='NER worker processes, -1 for every core')
+    args.add_argument('--limit', type=int, default=None, help='only process this many bills')
+    args = args.parse_args()
+    BatchNER(model=args.model, profile=args.profile, batch_size=args.batch_size, n_process=args.n_process).run(args.limit)
@@ -0,0 +1,108 @@
+from legiscan import LegiScan
+from create_database import MyDB
+from fetch_data import bill_record
+from rollups import Rollups
+import sql_queries as SQ
+import os
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+class DeltaSync:
+    '''
+    Keeps an in-progress legislative session fresh at the level of single bills. Legiscan's master list carries a change_hash for every bill in a session, so we compare those against the hashes stored in tBillHashes and only call getBill for bills that changed. Bills whose newest text document changed are queued for text retrieval again by clearing processed_at in tBills.
+    '''
+
+    def __init__(self,
+                 api_key = os.environ.get('LEGISCAN_API_KEY'),
+                 db: MyDB = None,
+                 max_workers: int = 8,
+                 ):
+        '''
+        default parameters:
+        api_key: retrieves the api key you have saved in your environment variables, unless otherwise specified
+        db: MyDB instance for legislation.db (default: MyDB())
+        max_workers: maximum number of getBill requests in flight at once (default: 8)
+        '''
+        self.__api_key = api_key
+        self.legis = LegiScan(self.__api_key)
+        self.db = db if db is not None else MyDB()
+        self.max_workers = max_workers
+        self.build_tables()
+
+    def build_tables(self):
+        '''Create the change hash table if it does not exist yet'''
+        self.db.connect()
+        self.db.curs.execute(SQ.SQL_BILL_HASHES_BUILD)
+        self.db.close()
+        return
+
+    def stored_hashes(self, bill_ids):
+        '''Return {bill_id: (change_hash, text_doc_id)} for the bills we have already synced'''
+        hashes = {}
+        self.db.connect()
+        bill_ids = list(bill_ids)
+        # stay under sqlite's limit on bound parameters
+        for i in range(0, len(bill_ids), 500):
+            chunk = bill_ids[i:i + 500]
+            sql = SQ.SQL_SELECT_BILL_HASHES.format(', '.join('?' * len(chunk)))
+            for bill_id, change_hash, text_doc_id in self.db.curs.execute(sql, chunk):
+                hashes[bill_id] = (change_hash, text_doc_id)
+        self.db.close()
+        return hashes
+
+    def changed_bills(self, state = None, session_id = None):
+        '''Compare the master list for a state's current session (or a session_id) against the stored change hashes'''
+        master = self.legis.get_master_list(state=state, session_id=session_id)
+        # the master list also holds a 'session' entry, which is not a bill
+        master = [bill for bill in master if 'bill_id' in bill]
+        stored = self.stored_hashes(bill['bill_id'] for bill in master)
+        self.changed = [bill for bill in master
+                        if stored.get(bill['bill_id'], (None, None))[0] != bill['change_hash']]
+        self.stored = stored
+        print(len(self.changed), 'of', len(master), 'bills changed')
+        return self.changed
+
+    def fetch_bills(self, bill_ids):
+        '''Call getBill for each bill id, with at most max_workers requests running at once'''
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            return list(pool.map(lambda bill_id: self.legis.get_bill(bill_id=bill_id), bill_ids))
+
+    def sync(self, state = None, session_id = None):
+        '''
+        Entry point: find changed bills, fetch only those, upsert them into tBills and mark bills with a new text version for text retrieval. Returns the number of bills updated.
+        '''
+        changed = self.changed_bills(state=state, session_id=session_id)
+        if len(changed) == 0:
+            return 0
+        bills = self.fetch_bills([bill['bill_id'] for bill in changed])
+
+        records = []
+        hashes = []
+        stale = []
+        for bill in bills:
+            if bill['status_date'] == '0000-00-00':
+                bill['status_date'] = None
+            filename = '{0}/{1}/bill/{2}.json'.format(bill['state'], bill['session']['session_name'], bill['bill_number'])
+            records.append(bill_record(bill, filename))
+            text_doc_id = bill['texts'][-1]['doc_id'] if bill.get('texts') else None
+            old_doc_id = self.stored.get(bill['bill_id'], (None, None))[1]
+            if text_doc_id is not None and text_doc_id != old_doc_id:
+                stale.append({'bill_id': bill['bill_id']})
+            hashes.append({'bill_id': bill['bill_id'], 'change_hash': bill['change_hash'], 'text_doc_id': text_doc_id})
+
+        self.db.upsert_bills(pd.DataFrame.from_records(records))
+        self.db.connect()
+        try:
+            self.db.curs.execute('BEGIN;')
+            self.db.curs.executemany(SQ.SQL_MARK_TEXT_STALE, stale)
+            self.db.curs.executemany(SQ.SQL_UPSERT_BILL_HASH, hashes)
+            self.db.curs.execute('COMMIT;')
+        except Exception:
+            self.db.curs.execute('ROLLBACK;')
+            raise
+        finally:
+            self.db.close()
+        # a status change moves the bill to another group of the entity/keyword rollups
+        Rollups(self.db).move_changed()
+        print(len(bills), 'bills updated,', len(stale), 'queued for new text')
+        return len(bills)
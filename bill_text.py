@@ -1,13 +1,40 @@
 import pandas as pd
 import sqlite3
 import requests
+import base64
 import tika
 from tika import parser
 from IPython.display import clear_output
+from concurrent.futures import ThreadPoolExecutor
+from legiscan import LegiScanError
+import sql_queries as SQ
 
 # Should we use OCR if normal processing fails?
 USE_OCR = False
 
+def parse_document(buffer, headers=None):
+    '''Extract the text of a document (PDF, Word doc, HTML page, etc) with Tika. Returns (content, None), or (None, 'tika') if Tika found no text'''
+    tika_output = parser.from_buffer(buffer, headers=headers)
+
+    # If we get nothing back, try OCR
+    if USE_OCR and ('content' not in tika_output or not tika_output['content']):
+        # headers = { 'X-Tika-PDFOcrStrategy': 'ocr_only' }
+        ocr_headers = dict(headers or {}, **{ 'X-Tika-PDFextractInlineImages': 'true' })
+        tika_output = parser.from_buffer(buffer, headers=ocr_headers)
+
+    if 'content' in tika_output and tika_output['content']:
+        return str(tika_output['content'].strip()), None
+    return None, 'tika'
+
+def check_sources(sources, legis=None):
+    '''Raise ValueError for a source other than 'url' and 'api', or for 'api' without a LegiScan client'''
+    unknown = [source for source in sources if source not in ('url', 'api')]
+    if len(unknown) > 0:
+        raise ValueError('unknown text sources: ' + ', '.join(map(str, unknown)) + " (use 'url' or 'api')")
+    if 'api' in sources and legis is None:
+        raise ValueError("the 'api' text source needs a LegiScan client: pass legis")
+    return
+
 class Bill:
     '''
     After querying the database by state and legislative session, we need to retrieve the actual text for each bill. For all of the unprocessed rows, we'll retrieve the URL and try to get the text from the file format that it's pointing at (PDF, Word doc, HTML page, etc). If it's successful, we'll save that into the contents column. If we fail, we'll try to update the error column instead. The processed_at column will update with a timestamp for when we attempted to fetch the data.
@@ -24,8 +51,29 @@ class Bill:
         except:
             pass
         self.conn = conn
+        self.doc_id = None # Legiscan text document id, looked up through the API if not known
+
+    def update_content(self, sources=('url',), legis=None):
+        '''
+        Retrieve the bill text and save it. sources is the order to try text sources in: 'url' scrapes the state website, 'api' downloads the document through Legiscan's getBillText (legis must be a LegiScan client). The next source is only tried if the previous one failed.
+        '''
+        self.fetch_content(sources, legis)
+        self.save()
 
-    def update_content(self):
+    def fetch_content(self, sources=('url',), legis=None):
+        '''Try each text source in order until one of them returns content, without saving'''
+        check_sources(sources, legis)
+        for source in sources:
+            if source == 'api':
+                self.content_from_api(legis)
+            else:
+                self.content_from_url()
+            if self.content is not None:
+                break
+        return self.content
+
+    def content_from_url(self):
+        '''Download the bill from the state website and parse it with Tika'''
         self.content = None
         self.error = None
 
@@ -35,33 +83,55 @@ class Bill:
             print(response)
 
             # Send to tika
-            tika_output = parser.from_buffer(response)
-
-            # If we get nothing back, try OCR
-            if USE_OCR and ('content' not in tika_output or not tika_output['content']):
-                # headers = { 'X-Tika-PDFOcrStrategy': 'ocr_only' }
-                headers = { 'X-Tika-PDFextractInlineImages': 'true' }
-                tika_output = parser.from_buffer(response, headers=headers)
-
-            if 'content' in tika_output and tika_output['content']:
-                self.content = tika_output['content'].strip()
-                self.content = str(self.content)
-            else:
-                self.error = 'tika'
+            self.parse(response)
         except requests.exceptions.MissingSchema:
             self.error = 'bad_url'
         except requests.exceptions.Timeout:
             self.error = 'timeout'
         except requests.exceptions.ConnectionError:
             self.error = 'connection'
-        
-        self.save()
+
+    def content_from_api(self, legis):
+        '''Download the newest text document for the bill with Legiscan's getBillText, decode it from base64 and parse it with Tika'''
+        self.content = None
+        self.error = None
+
+        try:
+            if self.doc_id is None:
+                texts = legis.get_bill(bill_id=self.bill_id[0])['texts']
+                if len(texts) == 0:
+                    self.error = 'api'
+                    return
+                self.doc_id = texts[-1]['doc_id']
+            text = legis.get_bill_text(self.doc_id)
+            buffer = base64.b64decode(text['doc'])
+            self.parse(buffer, headers={'Content-Type': text['mime']})
+        except (LegiScanError, requests.exceptions.RequestException):
+            self.error = 'api'
+
+    def parse(self, buffer, headers=None):
+        '''Send a downloaded document to Tika and keep the text, or record a tika error'''
+        self.content, error = parse_document(buffer, headers)
+        if error is not None:
+            self.error = error
         
     def save(self):
+        '''
+        Record the fetched text, or the error of a failed fetch. A failed fetch keeps the text the bill already had. Results computed from the old text are only dropped when the text actually changed, so a refetch that returns the same document does not queue the bill for every downstream job again.
+        '''
+        stored = self.conn.execute('SELECT content FROM tBills WHERE bill_id = (?);', (self.bill_id[0],)).fetchone()
         self.conn.execute("""
-            UPDATE tBills SET content=(?), error=(?), processed_at=(datetime('now','localtime'))
+            UPDATE tBills SET content=COALESCE((?), content), error=(?), processed_at=(datetime('now','localtime'))
             WHERE bill_id = (?)
         """, (self.content, self.error, self.bill_id[0]));
+        if self.content is None or (stored is not None and stored[0] == self.content):
+            return
+        # drop cached NER results and other results computed from the old content
+        for sql in SQ.SQL_INVALIDATE_ON_CONTENT:
+            try:
+                self.conn.execute(sql, (self.bill_id[0],))
+            except sqlite3.OperationalError: # the table has not been created yet
+                pass
         
     @classmethod
     def get(cls, conn, bill_id):
@@ -100,6 +170,34 @@ class Bill:
         for bill in todo:
             bill.update_content()
             
+    @classmethod
+    def process_bills(cls, conn, bill_ids, sources=('url',), legis=None, max_workers=8):
+        '''
+        Retrieve text for several bills at once. Downloading, base64 decoding and Tika parsing run in a pool of worker threads; the results are saved from this thread since the sqlite connection is shared. Text document ids already recorded in tBillHashes save a getBill call per bill. A bill that fails with an error fetch_content does not handle is saved with that error, and the other bills are still saved.
+        '''
+        check_sources(sources, legis)
+        bills = [Bill.get(conn, bill_id) for bill_id in bill_ids]
+        if 'api' in sources and len(bills) > 0:
+            has_hashes = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'tBillHashes';").fetchone()
+            if has_hashes is not None:
+                placeholders = ', '.join('?' * len(bills))
+                doc_ids = dict(conn.execute('SELECT bill_id, text_doc_id FROM tBillHashes WHERE bill_id IN (' + placeholders + ');',
+                                            [bill.bill_id[0] for bill in bills]).fetchall())
+                for bill in bills:
+                    bill.doc_id = doc_ids.get(bill.bill_id[0])
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = [pool.submit(bill.fetch_content, sources, legis) for bill in bills]
+            for bill, future in zip(bills, futures):
+                try:
+                    future.result()
+                except Exception as error: # Tika, decoding or payload errors fetch_content does not handle: record them and keep saving the other bills
+                    print('bill', bill.bill_id[0], 'failed:', repr(error))
+                    bill.content = None
+                    bill.error = 'unexpected: ' + type(error).__name__
+                bill.save()
+        return bills
+            
 def connect_and_update(_):
     conn = sqlite3.connect('sample-data/legislation.db', isolation_level=None)
     Bill.process_queue(conn)
@@ -0,0 +1,76 @@
+import random
+import sqlite3
+import pytest
+import spacy
+from create_database import MyDB
+import sql_queries as SQ
+
+WORDS = ['water', 'district', 'permit', 'county', 'board', 'license', 'tax', 'school', 'fund', 'court', 'election', 'vehicle',
+         'health', 'insurance', 'property', 'commission', 'agency', 'report', 'rule', 'fee', 'hunting', 'mineral', 'lease', 'road']
+
+def random_text(rng: random.Random, n_words: int = 200) -> str:
+    return ' '.join(rng.choice(WORDS) + str(rng.randint(0, 50)) for _ in range(n_words))
+
+def edit_text(rng: random.Random, text: str, n_edits: int = 5) -> str:
+    '''A near-duplicate of text with a few words replaced'''
+    words = text.split()
+    for _ in range(n_edits):
+        words[rng.randrange(len(words))] = rng.choice(WORDS) + str(rng.randint(51, 99))
+    return ' '.join(words)
+
+@pytest.fixture
+def db(tmp_path):
+    '''MyDB on an empty legislation.db with tBills, under a temporary data folder'''
+    db = MyDB()
+    db.path_data = str(tmp_path)
+    db.path_db = str(tmp_path / 'legislation.db')
+    db.connect()
+    db.curs.execute(SQ.SQL_FULL_BILLS_BUILD)
+    db.curs.execute(SQ.SQL_BILLS_STATE_SESSION_INDEX)
+    db.close()
+    return db
+
+def add_bills(db: MyDB, bills: list):
+    '''Insert or replace (bill_id, state, session, content) rows in tBills'''
+    db.connect()
+    db.curs.executemany("""
+        INSERT OR REPLACE INTO tBills (bill_id, bill_number, state, session, filename, content)
+        VALUES (?, 1, ?, ?, 'test', ?)""", bills)
+    db.close()
+    return
+
+def save_content(db: MyDB, bill_id: int, content: str):
+    '''Change the text of a bill the way Bill.save does, clearing everything computed from the old text'''
+    db.connect()
+    db.curs.execute('UPDATE tBills SET content = (?) WHERE bill_id = (?);', (content, bill_id))
+    for sql in SQ.SQL_INVALIDATE_ON_CONTENT:
+        try:
+            db.curs.execute(sql, (bill_id,))
+        except sqlite3.OperationalError: # the table has not been created yet
+            pass
+    db.close()
+    return
+
+def set_pairs(db: MyDB, pairs: dict, table: str = 'tPairs'):
+    '''Replace a (bill_id, other_id, score) pair table with {(bill_id, other_id): score}, stored in both directions'''
+    db.connect()
+    db.curs.execute('CREATE TABLE IF NOT EXISTS ' + table + ' (bill_id INTEGER, other_id INTEGER, score REAL, PRIMARY KEY (bill_id, other_id));')
+    db.curs.execute('DELETE FROM ' + table + ';')
+    db.curs.executemany('INSERT INTO ' + table + ' VALUES (?, ?, ?);', [edge + (score,) for (b, o), score in pairs.items() for edge in ((b, o), (o, b))])
+    db.close()
+    return
+
+def legiscan_bill(bill_id: int, state: str = 'TX', session: str = '2023 Regular Session', change_hash: str = 'a', doc_id: int = 1, status: int = 1) -> dict:
+    '''A bill object shaped like the ones in Legiscan dataset json files and getBill responses'''
+    return {'bill_id': bill_id, 'bill_number': 'HB' + str(bill_id), 'title': 'Title ' + str(bill_id), 'description': 'Description',
+            'state': state, 'session': {'session_name': session}, 'status': status, 'status_date': '0000-00-00',
+            'change_hash': change_hash, 'texts': [{'doc_id': doc_id, 'state_link': 'https://example.com/' + str(doc_id)}]}
+
+def ruler_pipeline():
+    '''A blank English spaCy pipeline that finds a few fixed entities, so no model has to be downloaded'''
+    nlp = spacy.blank('en')
+    ruler = nlp.add_pipe('entity_ruler')
+    ruler.add_patterns([{'label': 'ORG', 'pattern': 'Texas Water Development Board'},
+                        {'label': 'GPE', 'pattern': 'Travis County'},
+                        {'label': 'ORG', 'pattern': 'Water Development'}])
+    return nlp
@@ -9,6 +9,7 @@ from traceback import print_exc as pe
 from IPython.display import clear_output
 import time
 import glob
+import json
 
 sqlite3.register_adapter(np.int64, lambda val: int(val))
 sqlite3.register_adapter(np.int32, lambda val: int(val))
@@ -126,6 +127,7 @@ class MyDB:
             if self.bills_drop:
                 sql = SQ.SQL_FULL_BILLS_BUILD
                 self.curs.execute(sql)
+                self.curs.execute(SQ.SQL_BILLS_STATE_SESSION_INDEX)
 
         self.close()
 
@@ -206,6 +208,98 @@ class MyDB:
         self.close()
     
         
+    def upsert_bills(self, df: pd.DataFrame):
+        '''
+        Insert or update bills from a dataframe with the columns FetchData produces. Creates tBills first if the database does not have it yet.
+        '''
+        self.connect()
+        exists = self.curs.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'tBills';").fetchone()
+        if exists is None:
+            self.curs.execute(SQ.SQL_FULL_BILLS_BUILD)
+            self.curs.execute(SQ.SQL_BILLS_STATE_SESSION_INDEX)
+        df = df.assign(code=df['bill_number']).astype(object)
+        records = df.where(df.notnull(), None).to_dict(orient='records')
+        try:
+            self.curs.execute('BEGIN;')
+            self.curs.executemany(SQ.SQL_UPSERT_TBILLS, records)
+            self.curs.execute('COMMIT;')
+        except Exception:
+            self.curs.execute('ROLLBACK;')
+            raise
+        finally:
+            self.close()
+        return len(records)
+        
+    def load_partitions(self, partition: str = 'state', manifest_path: str = None):
+        '''
+        Load the partition files written by FetchData.df_to_partitions (data/partitions/<partition>), skipping any partition whose sha256 matches the one recorded in tPartitions from the last load.
+        '''
+        manifest_path = manifest_path or os.path.join(self.path_data, 'partitions', partition, 'partitions.json')
+        with open(manifest_path) as file:
+            manifest = json.load(file)
+
+        self.connect()
+        self.curs.execute(SQ.SQL_PARTITIONS_BUILD)
+        loaded = dict(self.curs.execute('SELECT filename, sha256 FROM tPartitions;').fetchall())
+        self.close()
+
+        changed = [f for f, entry in manifest.items() if loaded.get(f) != entry['sha256']]
+        for filename in changed:
+            path = os.path.join(os.path.dirname(manifest_path), filename)
+            df = pd.read_parquet(path) if filename.endswith('.parquet') else pd.read_csv(path)
+            self.upsert_bills(df)
+            self.connect()
+            self.curs.execute(SQ.SQL_UPSERT_PARTITION, dict(manifest[filename], filename=filename))
+            self.close()
+            print('loaded', filename)
+            clear_output(wait=True)
+        return changed
+        
+    def top_entities(self, state: str, session: str = None, status: int = None, label: str = None, limit: int = 20) -> pd.DataFrame:
+        '''Most mentioned entities for a state (optionally one session, bill status and entity label) from the materialized tEntityRollup table'''
+        return self.run_query(SQ.SQL_TOP_ENTITIES, {'state': state, 'session': session, 'status': status, 'label': label, 'limit': limit})
+    
+    def top_keywords(self, state: str, session: str = None, status: int = None, limit: int = 20) -> pd.DataFrame:
+        '''Keywords shared by the most bills for a state (optionally one session and bill status) from the materialized tKeywordRollup table'''
+        return self.run_query(SQ.SQL_TOP_KEYWORDS, {'state': state, 'session': session, 'status': status, 'limit': limit})
+        
+    def similar_bills(self, bill_id: int, limit: int = 10) -> pd.DataFrame:
+        '''
+        Near duplicates (tNearDuplicates), related bills (tSimilar) and possible model sources (tModelMatches) of a bill. Each is an indexed lookup on precomputed results; tables that have not been built yet are skipped
+        '''
+        found = []
+        for sql in (SQ.SQL_SELECT_NEAR_DUPLICATES_OF_BILL, SQ.SQL_SELECT_SIMILAR_OF_BILL, SQ.SQL_SELECT_MODEL_SOURCES_OF_BILL):
+            try:
+                found.append(self.run_query(sql, {'bill_id': bill_id, 'limit': limit}))
+            except pd.errors.DatabaseError: # the table has not been built yet
+                self.close()
+        if len(found) == 0:
+            return pd.DataFrame(columns=['match', 'id', 'state', 'session', 'code', 'title', 'score'])
+        return pd.concat(found, ignore_index=True)
+        
+    def copy_family(self, bill_id: int) -> pd.DataFrame:
+        '''The copy family of a bill from tCopyFamilies (written by families.py): representative bill, number of bills and number of states. Empty if the bill is in no family'''
+        try:
+            return self.run_query(SQ.SQL_SELECT_COPY_FAMILY_OF_BILL, (bill_id,))
+        except pd.errors.DatabaseError: # the table has not been built yet
+            self.close()
+            return pd.DataFrame(columns=['family_id', 'representative', 'state', 'session', 'code', 'title', 'bills', 'states'])
+        
+    def state_share(self) -> pd.DataFrame:
+        '''The state x state shared-text matrix from tStateShare (written by state_share.py), one row per pair of states'''
+        return self.run_query(SQ.SQL_SELECT_STATE_SHARE)
+    
+    def state_session_share(self, state: str, other_state: str) -> pd.DataFrame:
+        '''The sessions of two states that share text, from tStateSessionShare'''
+        return self.run_query(SQ.SQL_SELECT_STATE_SESSION_SHARE, {'state': state, 'other_state': other_state})
+    
+    def state_pairs(self, state: str, other_state: str, session: str = None, other_session: str = None, limit: int = 100) -> pd.DataFrame:
+        '''The bill pairs behind a cell of either matrix, highest score first. Both sessions narrow the state x state cell to a session x session cell'''
+        if session is None or other_session is None:
+            return self.run_query(SQ.SQL_SELECT_STATE_PAIRS, {'state': state, 'other_state': other_state, 'limit': limit})
+        return self.run_query(SQ.SQL_SELECT_STATE_SESSION_PAIRS, {'state': state, 'session': session, 'other_state': other_state,
+                                                                  'other_session': other_session, 'limit': limit})
+        
     def get_tBills(self):
         '''
         Returns the tBills table from the provided database as a Pandas dataframe
@@ -0,0 +1,401 @@
+from create_database import MyDB
+from normalize import normalize_text
+from array_store import ArrayStore
+import sql_queries as SQ
+import argparse
+import heapq
+import json
+import os
+import shutil
+import joblib
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+from sklearn.decomposition import TruncatedSVD
+
+# fitted LSA pipeline, loaded once in every embedding process by _init_worker
+_model = {}
+
+def replace_dir(build_dir: str, path: str):
+    '''Swap a finished build_dir in for path. Readers that opened the old files keep their memory maps of them'''
+    old = path + '.old'
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.exists(path):
+        os.rename(path, old)
+    os.rename(build_dir, path)
+    shutil.rmtree(old, ignore_errors=True)
+    return
+
+def _init_worker(path):
+    _model.update(joblib.load(path))
+
+def _embed_batch(texts):
+    return lsa_vectors(_model, texts)
+
+def lsa_vectors(model: dict, texts: list) -> np.ndarray:
+    '''Unit length float32 LSA vectors of texts, so the dot product of two vectors is their cosine similarity'''
+    vectors = model['svd'].transform(model['tfidf'].transform(model['hashing'].transform(texts))).astype(np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+def project(X: np.ndarray, rows: np.ndarray, normal: np.ndarray, block: int = 65536) -> np.ndarray:
+    '''X[rows] @ normal, reading block rows of the memory map at a time in row order, so no copy of X is made'''
+    order = np.argsort(rows, kind='stable')
+    projection = np.empty(len(rows), dtype=np.float32)
+    for i in range(0, len(rows), block):
+        chunk = order[i:i + block]
+        projection[chunk] = np.asarray(X[rows[chunk]]) @ normal
+    return projection
+
+def _build_tree(args):
+    '''
+    One random projection tree over the live rows of an ArrayStore. Every node splits its rows at the median of their projection on the difference of two random rows, until a node holds at most leaf_size rows. Returns the node arrays and the row order; the rows of a leaf are order[start:stop].
+    '''
+    path, leaf_size, seed = args
+    store = ArrayStore(path).open()
+    X = store.matrix
+    rng = np.random.default_rng(seed)
+    order = np.flatnonzero(store.live()).astype(np.int32)
+    left, right, start, stop, plane = [], [], [], [], []
+    normals, thresholds = [], []
+    stack = [(0, len(order), None, None)]
+    while stack:
+        lo, hi, parent, side = stack.pop()
+        node = len(left)
+        if parent is not None:
+            (left if side == 0 else right)[parent] = node
+        left.append(-1), right.append(-1), start.append(lo), stop.append(hi), plane.append(-1)
+        if hi - lo <= leaf_size:
+            continue
+        rows = order[lo:hi]
+        a, b = rng.choice(rows, 2, replace=False)
+        normal = np.asarray(X[a], dtype=np.float32) - np.asarray(X[b], dtype=np.float32)
+        if not normal.any():
+            normal = rng.standard_normal(X.shape[1]).astype(np.float32)
+        projection = project(X, rows, normal)
+        threshold = float(np.median(projection))
+        below = projection < threshold
+        if below.all() or not below.any():
+            # identical projections: split the rows in two halves at random so the tree still ends
+            below = np.zeros(len(rows), dtype=bool)
+            below[rng.permutation(len(rows))[:len(rows) // 2]] = True
+        order[lo:hi] = np.concatenate([rows[below], rows[~below]])
+        plane[node] = len(normals)
+        normals.append(normal)
+        thresholds.append(threshold)
+        middle = lo + int(below.sum())
+        stack.append((middle, hi, node, 1))
+        stack.append((lo, middle, node, 0))
+    return {'left': np.array(left, dtype=np.int32), 'right': np.array(right, dtype=np.int32),
+            'start': np.array(start, dtype=np.int64), 'stop': np.array(stop, dtype=np.int64), 'plane': np.array(plane, dtype=np.int32),
+            'normals': np.array(normals, dtype=np.float32).reshape(-1, X.shape[1]), 'thresholds': np.array(thresholds, dtype=np.float32),
+            'order': order}
+
+class RandomProjectionForest:
+    '''
+    Approximate nearest neighbor index (by dot product) over the live rows of a fixed width ArrayStore. Each of n_trees trees splits the rows by random hyperplanes until a leaf holds at most leaf_size rows; trees are built in parallel. A query walks all trees at once, always opening the node whose hyperplane is farthest from the query on its side, until search_k rows are collected, and then scores only those rows exactly. Rows appended to the store after the trees were built are scored exactly as well, at most the newest max_unindexed of them, until the next build(). The trees are saved as flat arrays in path/trees and memory-mapped, so opening an index reads nothing until it is queried; build() writes them to a side directory and swaps it in, so a reader never sees the arrays of two builds.
+
+    class parameters:
+
+    path: directory holding the trees; the vectors are the ArrayStore in path/vectors
+    n_trees: number of trees (default: int = 8)
+    leaf_size: largest number of rows in a leaf (default: int = 64)
+    max_unindexed: largest number of rows appended since the last build that a query scores exactly (default: int = 20000)
+    max_workers: number of processes building trees, None uses every core (default: None)
+    '''
+
+    ARRAYS = ('left', 'right', 'start', 'stop', 'plane', 'normals', 'thresholds', 'order', 'roots', 'planes')
+
+    def __init__(self, path: str, n_trees: int = 8, leaf_size: int = 64, max_unindexed: int = 20000, max_workers: int = None):
+        self.path = path
+        self.n_trees = n_trees
+        self.leaf_size = leaf_size
+        self.max_unindexed = max_unindexed
+        self.max_workers = max_workers
+        self.store = None
+        self.arrays = None
+
+    def exists(self) -> bool:
+        return os.path.exists(os.path.join(self.path, 'trees', 'trees.json'))
+
+    def build(self, seed: int = 1):
+        '''Build the trees over the live rows of the vector store and save them'''
+        rows = ArrayStore(os.path.join(self.path, 'vectors')).rows
+        workers = min(self.max_workers or os.cpu_count() or 1, self.n_trees)
+        tasks = [(os.path.join(self.path, 'vectors'), self.leaf_size, seed + tree) for tree in range(self.n_trees)]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            trees = list(pool.map(_build_tree, tasks))
+        n = len(trees[0]['order'])
+        # node, plane and row numbers of every tree are offset so the trees can be stored in one set of arrays
+        roots = np.cumsum([0] + [len(tree['left']) for tree in trees[:-1]]).astype(np.int64)
+        planes = np.cumsum([0] + [len(tree['thresholds']) for tree in trees[:-1]]).astype(np.int64)
+        merged = {'roots': roots, 'planes': planes}
+        for name in ('left', 'right'):
+            merged[name] = np.concatenate([np.where(tree[name] >= 0, tree[name] + root, -1) for tree, root in zip(trees, roots)])
+        for name in ('start', 'stop'):
+            merged[name] = np.concatenate([tree[name] + t * n for t, tree in enumerate(trees)])
+        merged['plane'] = np.concatenate([np.where(tree['plane'] >= 0, tree['plane'] + offset, -1) for tree, offset in zip(trees, planes)])
+        for name in ('normals', 'thresholds', 'order'):
+            merged[name] = np.concatenate([tree[name] for tree in trees])
+        build_dir = os.path.join(self.path, 'trees.build')
+        shutil.rmtree(build_dir, ignore_errors=True)
+        os.makedirs(build_dir)
+        for name, array in merged.items():
+            np.save(os.path.join(build_dir, name + '.npy'), array)
+        # rows appended after this are not in the trees
+        with open(os.path.join(build_dir, 'trees.json'), 'w') as f:
+            json.dump({'rows': rows, 'n_trees': self.n_trees, 'leaf_size': self.leaf_size}, f)
+        replace_dir(build_dir, os.path.join(self.path, 'trees'))
+        self.arrays = None
+        print(self.n_trees, 'trees,', len(merged['left']), 'nodes')
+        return self
+
+    def open(self):
+        self.arrays = {name: np.load(os.path.join(self.path, 'trees', name + '.npy'), mmap_mode='r') for name in self.ARRAYS}
+        with open(os.path.join(self.path, 'trees', 'trees.json')) as f:
+            self.indexed = json.load(f)['rows']
+        self.store = ArrayStore(os.path.join(self.path, 'vectors')).open()
+        return self
+
+    @property
+    def unindexed(self) -> int:
+        '''Number of rows appended to the store since the trees were built'''
+        if self.arrays is None:
+            self.open()
+        return self.store.rows - self.indexed
+
+    def candidates(self, vector: np.ndarray, search_k: int) -> np.ndarray:
+        '''Rows of the leaves closest to vector in all trees, at least search_k rows unless the trees hold fewer'''
+        if self.arrays is None:
+            self.open()
+        left, right, start, stop = self.arrays['left'], self.arrays['right'], self.arrays['start'], self.arrays['stop']
+        plane, normals, thresholds, order = self.arrays['plane'], self.arrays['normals'], self.arrays['thresholds'], self.arrays['order']
+        # heap of (-margin, node): the margin of a node is the smallest distance of the query to a hyperplane on the way to it, on the side of the node
+        heap = [(-np.inf, int(root)) for root in self.arrays['roots']]
+        found, count = [], 0
+        while heap and count < search_k:
+            margin, node = heapq.heappop(heap)
+            if left[node] < 0:
+                found.append(order[start[node]:stop[node]])
+                count += stop[node] - start[node]
+                continue
+            p = plane[node]
+            distance = float(normals[p] @ vector) - float(thresholds[p])
+            heapq.heappush(heap, (max(margin, distance), int(left[node])))
+            heapq.heappush(heap, (max(margin, -distance), int(right[node])))
+        return np.unique(np.concatenate(found)) if found else np.zeros(0, dtype=np.int32)
+
+    def search(self, vector: np.ndarray, k: int = 10, search_k: int = None, exclude: int = None) -> tuple:
+        '''(rows, scores) of the approximate k best rows by dot product with vector, best first'''
+        search_k = search_k or max(k, self.leaf_size) * self.n_trees * 2
+        rows = self.candidates(np.asarray(vector, dtype=np.float32), search_k)
+        # rows appended since the trees were built; LSAEmbeddings.update() rebuilds the trees before there are more than max_unindexed
+        rows = np.concatenate([rows, np.arange(max(self.indexed, self.store.rows - self.max_unindexed), self.store.rows)])
+        # rows of bills that were embedded again since the trees were built are not live
+        rows = rows[self.store.live()[rows]]
+        if exclude is not None:
+            rows = rows[rows != exclude]
+        scores = np.asarray(self.store.matrix[rows]) @ vector
+        best = np.argsort(-scores, kind='stable')[:k]
+        return rows[best], scores[best]
+
+class LSAEmbeddings:
+    '''
+    Dense LSA vectors of bill texts (normalized text where it exists) for semantic similarity, computed locally without model downloads. Words are hashed into n_features columns (HashingVectorizer, so there is no vocabulary to fit or store), weighted by tf-idf and reduced to dims dimensions by TruncatedSVD. tf-idf and SVD are fitted on a random sample of sample_size bills; then every bill is embedded in batches on a process pool and appended to a float32 ArrayStore under path/vectors (one unit length row per bill) that is memory-mapped instead of loaded.
+
+    A RandomProjectionForest over the vectors answers k-nearest-neighbor queries by bill_id (neighbors) or for any text (query_text) by scoring only the rows in the leaves nearest the query, so a query reads a few thousand rows and not the whole corpus. build() recomputes everything in path.build and swaps it in for path when it is complete, so the app keeps querying the old model and vectors meanwhile. update() embeds bills that are new or changed since (tEmbeddingRuns is cleared by Bill.save) with the fitted model and appends them; the trees are rebuilt once the appended rows exceed rebuild_fraction of the indexed ones or max_unindexed rows.
+
+    class parameters:
+
+    db: MyDB instance for legislation.db (default: MyDB())
+    dims: number of LSA dimensions (default: int = 256)
+    n_features: number of hashed word columns (default: int = 2**20)
+    sample_size: number of bills tf-idf and the SVD are fitted on (default: int = 50000)
+    n_trees: number of trees of the nearest neighbor index (default: int = 8)
+    leaf_size: largest number of bills in a leaf of the index (default: int = 64)
+    rebuild_fraction: update() rebuilds the trees when more rows than this share of the indexed rows were appended (default: float = 0.1)
+    max_unindexed: update() rebuilds the trees when more rows than this were appended, and queries score at most this many appended rows exactly (default: int = 20000)
+    batch_size: number of bills embedded per worker task (default: int = 256)
+    max_workers: number of processes, None uses every core (default: None)
+    path: directory the model, vectors and index are saved in (default: data/embeddings)
+    '''
+
+    def __init__(self,
+                 db: MyDB = None,
+                 dims: int = 256,
+                 n_features: int = 2**20,
+                 sample_size: int = 50000,
+                 n_trees: int = 8,
+                 leaf_size: int = 64,
+                 rebuild_fraction: float = 0.1,
+                 max_unindexed: int = 20000,
+                 batch_size: int = 256,
+                 max_workers: int = None,
+                 path: str = None,
+                ):
+        self.db = db if db is not None else MyDB()
+        self.dims = dims
+        self.n_features = n_features
+        self.sample_size = sample_size
+        self.rebuild_fraction = rebuild_fraction
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.path = path or os.path.join(self.db.path_data, 'embeddings')
+        self.forest = RandomProjectionForest(self.path, n_trees=n_trees, leaf_size=leaf_size, max_unindexed=max_unindexed, max_workers=max_workers)
+        self.model = None
+        self.build_tables()
+
+    def build_tables(self):
+        '''Create the checkpoint table (and tCleanText, which the vectors are made from) if they do not exist'''
+        self.db.connect()
+        for sql in SQ.SQL_EMBEDDINGS_BUILD:
+            self.db.curs.execute(sql)
+        self.db.close()
+        return
+
+    def texts(self, bill_ids: list):
+        '''Yield (bill_id, text) in the order of bill_ids, reading batch_size bills at a time'''
+        for i in range(0, len(bill_ids), self.batch_size):
+            chunk = [int(b) for b in bill_ids[i:i + self.batch_size]]
+            self.db.connect()
+            rows = self.db.curs.execute(SQ.SQL_SELECT_CLEAN_CONTENT.format(', '.join('?' * len(chunk))), chunk).fetchall()
+            self.db.close()
+            yield from rows
+
+    def fit(self, bill_ids: list, path: str = None):
+        '''Fit tf-idf and the SVD on a random sample of the bills and save the model in path (default: self.path)'''
+        rng = np.random.default_rng(1)
+        sample = np.sort(rng.choice(bill_ids, min(self.sample_size, len(bill_ids)), replace=False))
+        hashing = HashingVectorizer(n_features=self.n_features, stop_words='english', alternate_sign=False, norm=None, dtype=np.float32)
+        counts = hashing.transform(text for bill_id, text in self.texts(sample))
+        tfidf = TfidfTransformer(sublinear_tf=True).fit(counts)
+        svd = TruncatedSVD(n_components=min(self.dims, counts.shape[0] - 1), algorithm='randomized', random_state=1)
+        svd.fit(tfidf.transform(counts))
+        self.model = {'hashing': hashing, 'tfidf': tfidf, 'svd': svd}
+        joblib.dump(self.model, os.path.join(path or self.path, 'model.joblib'))
+        print('LSA fitted on', len(sample), 'bills, explained variance', round(float(svd.explained_variance_ratio_.sum()), 3))
+        return
+
+    def embed(self, bill_ids: list, path: str = None) -> int:
+        '''
+        Embed bills with the model saved in path on a process pool and append them to the vector store in path. Without a path they go into the live store and are checkpointed every window of bills; the new store of a build is indexed once at the end and checkpointed by build() when it is swapped in.
+        '''
+        live = path is None
+        path = path or self.path
+        store = ArrayStore(os.path.join(path, 'vectors'), np.float32, self.model['svd'].n_components)
+        workers = self.max_workers or os.cpu_count() or 1
+        window = self.batch_size * workers
+        done = 0
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(os.path.join(path, 'model.joblib'),)) as pool:
+            for i in range(0, len(bill_ids), window):
+                rows = list(self.texts(bill_ids[i:i + window]))
+                batches = [[text for bill_id, text in rows[j:j + self.batch_size]] for j in range(0, len(rows), self.batch_size)]
+                vectors = list(pool.map(_embed_batch, batches))
+                if len(vectors) > 0:
+                    store.append([bill_id for bill_id, text in rows], np.concatenate(vectors), index=live)
+                if live:
+                    self.checkpoint(bill_ids[i:i + window])
+                done += len(rows)
+                print(done, 'of', len(bill_ids), 'bills embedded')
+        if not live:
+            store.update_index()
+        return done
+
+    def checkpoint(self, bill_ids: list, reset: bool = False, since: str = None):
+        '''Record bills as embedded in tEmbeddingRuns. reset first forgets every other bill, and bills whose text was saved at or after since are left pending'''
+        self.db.connect()
+        self.db.curs.execute('BEGIN;')
+        try:
+            if reset:
+                self.db.curs.execute(SQ.SQL_DELETE_EMBEDDING_RUNS)
+            self.db.curs.executemany(SQ.SQL_UPSERT_EMBEDDING_RUN, [(int(bill_id),) for bill_id in bill_ids])
+            if since is not None:
+                self.db.curs.execute(SQ.SQL_INVALIDATE_EMBEDDING_RUNS_SINCE, (since,))
+            self.db.curs.execute('COMMIT;')
+        except Exception:
+            self.db.curs.execute('ROLLBACK;')
+            raise
+        finally:
+            self.db.close()
+        return
+
+    def build(self) -> int:
+        '''Fit the model, embed every bill with text into a new vector store and build the nearest neighbor index, all in path.build, and swap them in. Returns the number of bills embedded'''
+        self.db.connect()
+        started = self.db.curs.execute("SELECT datetime('now','localtime');").fetchone()[0]
+        bill_ids = np.array([row[0] for row in self.db.curs.execute(SQ.SQL_SELECT_BILLS_WITH_CONTENT)], dtype=np.int64)
+        self.db.close()
+        if len(bill_ids) < 2:
+            return 0
+        build_dir = self.path + '.build'
+        shutil.rmtree(build_dir, ignore_errors=True)
+        os.makedirs(build_dir)
+        self.fit(bill_ids, build_dir)
+        done = self.embed(bill_ids, build_dir)
+        RandomProjectionForest(build_dir, n_trees=self.forest.n_trees, leaf_size=self.forest.leaf_size,
+                               max_unindexed=self.forest.max_unindexed, max_workers=self.max_workers).build()
+        replace_dir(build_dir, self.path)
+        self.forest.arrays = None
+        # vectors of the old model are gone, so the checkpoints are those of the new store; bills saved during the build are embedded by the next update()
+        self.checkpoint(bill_ids, reset=True, since=started)
+        return done
+
+    def update(self, limit: int = None) -> int:
+        '''Embed the bills that are new or changed since they were embedded, building everything first if there is no model yet. Returns the number of bills embedded'''
+        if not self.forest.exists():
+            return self.build()
+        if self.model is None:
+            self.model = joblib.load(os.path.join(self.path, 'model.joblib'))
+        self.db.connect()
+        sql = SQ.SQL_PENDING_EMBEDDING_BILLS + ('' if limit is None else ' LIMIT ' + str(int(limit)))
+        pending = [row[0] for row in self.db.curs.execute(sql)]
+        self.db.close()
+        print(len(pending), 'bills to embed')
+        done = self.embed(pending)
+        if self.forest.open().unindexed > min(self.rebuild_fraction * self.forest.indexed, self.forest.max_unindexed):
+            self.forest.build()
+        self.forest.arrays = None
+        return done
+
+    def open(self):
+        '''Load the fitted model and memory-map the vectors and the index'''
+        self.model = joblib.load(os.path.join(self.path, 'model.joblib'))
+        self.forest.open()
+        return self
+
+    def row_of(self, bill_id: int) -> int:
+        if self.forest.arrays is None:
+            self.open()
+        row = self.forest.store.row_of(bill_id)
+        if row < 0:
+            raise KeyError('bill {0} is not in the embedding index'.format(bill_id))
+        return row
+
+    def vector(self, bill_id: int) -> np.ndarray:
+        return np.asarray(self.forest.store.matrix[self.row_of(bill_id)])
+
+    def results(self, rows: np.ndarray, scores: np.ndarray) -> pd.DataFrame:
+        return pd.DataFrame({'bill_id': np.asarray(self.forest.store.ids[rows]), 'score': scores})
+
+    def neighbors(self, bill_id: int, k: int = 10, search_k: int = None) -> pd.DataFrame:
+        '''The approximate k most similar bills of a bill by cosine similarity of their LSA vectors'''
+        row = self.row_of(bill_id)
+        return self.results(*self.forest.search(self.vector(bill_id), k, search_k, exclude=row))
+
+    def query_text(self, text: str, k: int = 10, search_k: int = None) -> pd.DataFrame:
+        '''The approximate k bills most similar to any text'''
+        if self.model is None:
+            self.open()
+        return self.results(*self.forest.search(lsa_vectors(self.model, [normalize_text(text)])[0], k, search_k))
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Embed every bill with LSA and build a nearest neighbor index over the vectors')
+    args.add_argument('--dims', type=int, default=256)
+    args.add_argument('--sample-size', type=int, default=50000)
+    args.add_argument('--n-trees', type=int, default=8)
+    args.add_argument('--max-workers', type=int, default=None)
+    args.add_argument('--rebuild', action='store_true', help='fit the model again and embed every bill')
+    args = args.parse_args()
+    embeddings = LSAEmbeddings(dims=args.dims, sample_size=args.sample_size, n_trees=args.n_trees, max_workers=args.max_workers)
+    embeddings.build() if args.rebuild else embeddings.update()
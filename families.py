@@ -0,0 +1,238 @@
+from create_database import MyDB
+import sql_queries as SQ
+import argparse
+
+class UnionFind:
+    '''Disjoint sets of integer ids with union by size and path halving. Ids are added the first time they are seen'''
+
+    def __init__(self, sizes: dict = None):
+        self.parent = {}
+        self.size = dict(sizes or {})
+
+    def find(self, x: int) -> int:
+        self.parent.setdefault(x, x)
+        self.size.setdefault(x, 1)
+        while self.parent[x] != x:
+            self.parent[x] = self.parent[self.parent[x]]
+            x = self.parent[x]
+        return x
+
+    def union(self, x: int, y: int) -> int:
+        '''Join the sets of x and y. The root of the larger set becomes the root of both'''
+        x, y = self.find(x), self.find(y)
+        if x == y:
+            return x
+        if self.size[x] < self.size[y]:
+            x, y = y, x
+        self.parent[y] = x
+        self.size[x] += self.size[y]
+        return x
+
+    def groups(self) -> dict:
+        '''root: [ids] of every set'''
+        found = {}
+        for x in list(self.parent):
+            found.setdefault(self.find(x), []).append(x)
+        return found
+
+class CopyFamilies:
+    '''
+    Groups bills into copy families, bills of near-identical text, by union-find over high-confidence pairs (tNearDuplicates by default, or another pair table with a score). Every bill in a family gets a row in tFamilyMembers(bill_id, family_id); tCopyFamilies(family_id, representative, bills, states) holds the size of each family and its representative, the member with the most high-confidence pairs. Bills without such a pair are in no family.
+
+    Families are kept up to date incrementally. update() compares the pair table with the edges already applied (tFamilyEdges). A new pair joins two families: the bills of the smaller family are relabeled with the id of the larger one. A pair that is gone (the text of a bill changed) can split a family, so only that family is split again from its remaining edges. A family id is always the bill_id of one of its members. merge() and split() join or separate two bills by hand; a split pair is kept as blocked so update() does not add it back.
+
+    class parameters:
+
+    db: MyDB instance for legislation.db (default: MyDB())
+    pairs_table: table of (bill_id, other_id, score) pairs, stored in both directions (default: str = 'tNearDuplicates')
+    min_score: smallest score of a pair that joins two bills (default: float = 0.8)
+    '''
+
+    def __init__(self,
+                 db: MyDB = None,
+                 pairs_table: str = 'tNearDuplicates',
+                 min_score: float = 0.8,
+                ):
+        self.db = db if db is not None else MyDB()
+        self.pairs_table = pairs_table
+        self.min_score = min_score
+        self.build_tables()
+
+    def build_tables(self):
+        '''Create the family tables and their indexes if they do not exist'''
+        self.db.connect()
+        for sql in SQ.SQL_COPY_FAMILIES_BUILD:
+            self.db.curs.execute(sql)
+        self.db.close()
+        return
+
+    def families_of(self, bill_ids) -> dict:
+        '''bill_id: family_id of the given bills that are in a family'''
+        bill_ids = {int(b) for b in bill_ids}
+        if len(bill_ids) == 0:
+            return {}
+        return dict(self.db.curs.execute('SELECT bill_id, family_id FROM tFamilyMembers WHERE bill_id IN (' +
+                                         ', '.join(str(b) for b in bill_ids) + ');').fetchall())
+
+    def join(self, edges: list) -> set:
+        '''
+        Add the families joined by edges [(bill_id, other_id)]. Families are the nodes of the union-find, so the work depends on the number of new edges and not on the size of the families. Returns the ids of the changed families.
+        '''
+        family = self.families_of([b for edge in edges for b in edge])
+        known = set(family.values())
+        sizes = dict(self.db.curs.execute('SELECT family_id, bills FROM tCopyFamilies WHERE family_id IN (' +
+                                          ', '.join(str(f) for f in known) + ');').fetchall()) if known else {}
+        sets = UnionFind(sizes)
+        for bill_id, other_id in edges:
+            sets.union(family.get(bill_id, bill_id), family.get(other_id, other_id))
+        changed = set()
+        for root, members in sets.groups().items():
+            if len(members) == 1:
+                # the pair is inside one family: only its representative can change
+                changed.add(root)
+                continue
+            # families that are joined into root are relabeled; bills in no family so far are added
+            merged = [m for m in members if m != root and m in known]
+            if len(merged) > 0:
+                self.db.curs.execute('UPDATE tFamilyMembers SET family_id = ? WHERE family_id IN (' +
+                                     ', '.join(str(m) for m in merged) + ');', (root,))
+                self.db.curs.execute('DELETE FROM tCopyFamilies WHERE family_id IN (' + ', '.join(str(m) for m in merged) + ');')
+            self.db.curs.executemany(SQ.SQL_UPSERT_FAMILY_MEMBER, [(m, root) for m in members if m not in known])
+            changed.add(root)
+        return changed
+
+    def resplit(self, family_ids: set) -> set:
+        '''
+        Split families again from their remaining edges. The part holding the family id keeps it, every other part takes the id of its smallest bill, and bills left without an edge leave the family. Returns the ids of the changed families.
+        '''
+        changed = set()
+        for family_id in family_ids:
+            members = [row[0] for row in self.db.curs.execute('SELECT bill_id FROM tFamilyMembers WHERE family_id = ?;', (family_id,))]
+            if len(members) == 0:
+                continue
+            sets = UnionFind()
+            for bill_id in members:
+                sets.find(bill_id)
+            for bill_id, other_id in self.db.curs.execute(SQ.SQL_SELECT_FAMILY_EDGES, (family_id,)).fetchall():
+                sets.union(bill_id, other_id)
+            self.db.curs.execute('DELETE FROM tCopyFamilies WHERE family_id = ?;', (family_id,))
+            for part in sets.groups().values():
+                if len(part) == 1:
+                    self.db.curs.execute('DELETE FROM tFamilyMembers WHERE bill_id = ?;', (part[0],))
+                    continue
+                new_id = family_id if family_id in part else min(part)
+                if new_id != family_id:
+                    self.db.curs.executemany(SQ.SQL_UPSERT_FAMILY_MEMBER, [(m, new_id) for m in part])
+                changed.add(new_id)
+        return changed
+
+    def summarize(self, family_ids: set):
+        '''Recount the bills and states of families and pick their representatives'''
+        family_ids = sorted(family_ids)
+        for i in range(0, len(family_ids), 500):
+            chunk = family_ids[i:i + 500]
+            rows = self.db.curs.execute(SQ.SQL_SELECT_FAMILY_MEMBERS.format(', '.join(str(int(f)) for f in chunk))).fetchall()
+            families = {}
+            for family_id, bill_id, state, degree in rows:
+                families.setdefault(family_id, []).append((bill_id, state, degree))
+            summaries = []
+            for family_id, members in families.items():
+                representative = min(members, key=lambda member: (-member[2], member[0]))[0]
+                summaries.append((family_id, representative, len(members), len({state for bill_id, state, degree in members if state is not None})))
+            self.db.curs.executemany(SQ.SQL_UPSERT_COPY_FAMILY, summaries)
+        return
+
+    def update(self) -> int:
+        '''
+        Apply the pairs added to and removed from the pair table since the last update. Returns the number of families changed.
+        '''
+        self.db.connect()
+        added = self.db.curs.execute(SQ.SQL_NEW_FAMILY_EDGES.format(self.pairs_table), (self.min_score,)).fetchall()
+        removed = self.db.curs.execute(SQ.SQL_REMOVED_FAMILY_EDGES.format(self.pairs_table), (self.min_score,)).fetchall()
+        print(len(added), 'new pairs,', len(removed), 'pairs removed')
+        self.db.curs.execute('BEGIN;')
+        try:
+            # split first: the new edges are joined into the families that are left
+            split = set(self.families_of([b for edge in removed for b in edge]).values())
+            self.db.curs.executemany(SQ.SQL_DELETE_FAMILY_EDGE, removed)
+            changed = self.resplit(split)
+            self.db.curs.executemany(SQ.SQL_UPSERT_FAMILY_EDGE, [(b, o, score, 'pair') for b, o, score in added])
+            changed |= self.join([(b, o) for b, o, score in added])
+            # families that were split or joined away and have no members now
+            changed = {f for f in changed if self.db.curs.execute('SELECT 1 FROM tFamilyMembers WHERE family_id = ? LIMIT 1;', (f,)).fetchone()}
+            self.summarize(changed)
+            self.db.curs.execute('COMMIT;')
+        except Exception:
+            self.db.curs.execute('ROLLBACK;')
+            raise
+        finally:
+            self.db.close()
+        print(len(changed), 'families changed')
+        return len(changed)
+
+    def merge(self, bill_id: int, other_id: int) -> int:
+        '''Put two bills (and their families) in one family by hand. Returns the id of the family'''
+        first, second = min(bill_id, other_id), max(bill_id, other_id)
+        self.db.connect()
+        self.db.curs.execute('BEGIN;')
+        try:
+            self.db.curs.execute(SQ.SQL_UPSERT_FAMILY_EDGE, (first, second, None, 'manual'))
+            changed = self.join([(first, second)])
+            self.summarize(changed)
+            self.db.curs.execute('COMMIT;')
+        except Exception:
+            self.db.curs.execute('ROLLBACK;')
+            raise
+        finally:
+            self.db.close()
+        return changed.pop()
+
+    def split(self, bill_id: int, other_id: int) -> set:
+        '''
+        Separate two bills by hand: their pair is blocked and their family is split again. The bills only end up in different families if no other chain of pairs connects them. Returns the ids of the families the old family was split into.
+        '''
+        first, second = min(bill_id, other_id), max(bill_id, other_id)
+        self.db.connect()
+        self.db.curs.execute('BEGIN;')
+        try:
+            self.db.curs.execute(SQ.SQL_UPSERT_FAMILY_EDGE, (first, second, None, 'blocked'))
+            changed = self.resplit(set(self.families_of([first]).values()))
+            self.summarize(changed)
+            self.db.curs.execute('COMMIT;')
+        except Exception:
+            self.db.curs.execute('ROLLBACK;')
+            raise
+        finally:
+            self.db.close()
+        return changed
+
+    def rebuild(self) -> int:
+        '''Drop every family and pair edge except the manual and blocked ones, and build the families again'''
+        self.db.connect()
+        self.db.curs.execute('BEGIN;')
+        try:
+            self.db.curs.execute("DELETE FROM tFamilyEdges WHERE kind = 'pair';")
+            self.db.curs.execute('DELETE FROM tFamilyMembers;')
+            self.db.curs.execute('DELETE FROM tCopyFamilies;')
+            manual = self.db.curs.execute("SELECT bill_id, other_id FROM tFamilyEdges WHERE kind = 'manual';").fetchall()
+            self.summarize(self.join(manual))
+            self.db.curs.execute('COMMIT;')
+        except Exception:
+            self.db.curs.execute('ROLLBACK;')
+            raise
+        finally:
+            self.db.close()
+        return self.update()
+
+    def family(self, bill_id: int):
+        '''The family of a bill with its representative, number of bills and number of states (empty if the bill is in no family)'''
+        return self.db.run_query(SQ.SQL_SELECT_COPY_FAMILY_OF_BILL, (bill_id,))
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Group bills into copy families of near-identical text')
+    args.add_argument('--pairs-table', default='tNearDuplicates')
+    args.add_argument('--min-score', type=float, default=0.8)
+    args.add_argument('--rebuild', action='store_true', help='build every family from scratch')
+    args = args.parse_args()
+    families = CopyFamilies(pairs_table=args.pairs_table, min_score=args.min_score)
+    families.rebuild() if args.rebuild else families.update()
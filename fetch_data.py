@@ -1,5 +1,6 @@
 from legiscan import LegiScan
 import legiscan
+from create_database import MyDB
 import os
 import pandas as pd
 import swifter
@@ -8,6 +9,35 @@ import base64
 import io
 import glob
 import json
+import mmap
+import fnmatch
+import hashlib
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+def bill_record(content, filename): 
+    '''Pull the columns we keep out of a Legiscan bill object (from a dataset json file or getBill)'''
+    bill_data = {}
+    bill_data['bill_id'] = content['bill_id']
+    bill_data['bill_number'] = content['bill_number']
+    bill_data['title'] = content['title']
+    bill_data['description'] = content['description']
+    bill_data['state'] = content['state']
+    bill_data['session'] = content['session']['session_name']
+    bill_data['filename'] = filename
+    bill_data['status'] = content['status']
+    bill_data['status_date'] = content['status_date']
+
+    try:
+        bill_data['url'] = content['texts'][-1]['state_link']
+    except:
+        bill_data['url'] = None
+    return bill_data
+
+class MappedZip(mmap.mmap): 
+    '''Read-only memory map of a dataset zip on disk. mmap only has seekable() from Python 3.13, and zipfile needs it'''
+    def seekable(self): 
+        return True
 
 class FetchData: 
     '''
@@ -17,21 +47,52 @@ class FetchData:
     def __init__(self, 
                  api_key = os.environ.get('LEGISCAN_API_KEY'), 
                  num_datasets = 20, 
+                 stream = False, 
+                 zip_path = None, 
+                 sync = False, 
+                 partition = None, 
+                 file_format = 'csv', 
                  ): 
         '''
         default parameters: 
         api_key: retrieves the api key you have saved in your environment variables, unless otherwise specified
         num_datasets: number of datasets legiscan should retrieve (in sessions/years)
+        stream: read the bill json files straight out of the dataset zip instead of extracting it to ./data (default: False)
+        zip_path: path to a dataset zip already saved on disk. It is memory-mapped rather than downloaded when stream is True (default: None)
+        sync: walk every available dataset and only download the ones whose dataset_hash changed since the last sync, then upsert their bills into the csv and database (default: False)
+        partition: write one file per 'state' or per 'session' (within a state) under ./data/partitions/<partition> instead of the single bills-with-urls.csv (default: None)
+        file_format: 'csv' or 'parquet' for partitioned output (default: 'csv')
         '''
         self.__api_key = api_key
         self.legis = LegiScan(self.__api_key) # create an instance of class LegiScan from legiscan.py with your own api key
         self.num_datasets = num_datasets
+        self.stream = stream
+        self.zip_path = zip_path
+        self.sync = sync
+        self.partition = partition
+        self.file_format = file_format
         self.PATH_OUT = './data' # path for saved data
+        self.PATH_MANIFEST = os.path.join(self.PATH_OUT, 'dataset_manifest.json') # dataset hashes from the last sync
+        # partitions get their own folder and manifest: MyDB.load_df globs ./data/*.csv, and the shipped per-state files have another layout
+        self.PATH_PARTITION_DIR = os.path.join(self.PATH_OUT, 'partitions', str(partition)) if partition is not None else None
+        self.PATH_PARTITIONS = os.path.join(self.PATH_PARTITION_DIR, 'partitions.json') if partition is not None else None # row counts and hashes of the partition files
         self.check_directories()
-        self.find_json()
-        self.process_json()
+        if self.sync: 
+            self.sync_datasets()
+            return
+        if self.stream: 
+            if self.zip_path is None: 
+                self.create_test_dataset_list()
+            self.open_dataset_zip(self.zip_path)
+            self.process_zip()
+        else: 
+            self.find_json()
+            self.process_json()
         self.create_dataframe()
-        self.df_to_csv()
+        if self.partition is not None: 
+            self.df_to_partitions()
+        else: 
+            self.df_to_csv()
         
     def check_directories(self): 
         '''Create data folder if it does not already exist'''
@@ -57,6 +118,26 @@ class FetchData:
         self.zip.extractall(self.PATH_OUT)
         return
     
+    def open_dataset_zip(self, path = None): 
+        '''Open a Legiscan dataset as a zipfile without extracting anything to disk. If path points at a dataset zip that is already saved, the file is memory-mapped; otherwise the base64 payload returned by the API is decoded in memory.
+        '''
+        if path is not None: 
+            with open(path, 'rb') as file: 
+                self.z_bytes = MappedZip(file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.zip = zipfile.ZipFile(self.z_bytes)
+        else: 
+            self.z_bytes = base64.b64decode(self.dataset['zip'])
+            self.zip = zipfile.ZipFile(io.BytesIO(self.z_bytes))
+        return self.zip
+    
+    def iter_zip_json(self): 
+        '''Yield the member name and text of every bill json file in the open dataset zip, read directly from the archive'''
+        for info in self.zip.infolist(): 
+            # same layout find_json globs for: <state>/<session>/bill/<bill>.json
+            if fnmatch.fnmatch(info.filename, '*/*/bill/*.json'): 
+                with self.zip.open(info) as file: 
+                    yield info.filename, file.read().decode('utf-8')
+    
     def find_json(self): 
         '''Create a list of all of the json file paths in the data folder'''
         self.filenames = glob.glob('./data/' + "/*/*/bill/*.json", recursive = True)
@@ -70,45 +151,38 @@ class FetchData:
         self.all_bill_data = {}
         for filename in self.filenames:
             with open(filename) as file:
-                self.bill_data = {}
-                # We need to do a little string replacing so the 
-                self.json_str = file.read().replace('"0000-00-00"', 'null')
-                self.content = json.loads(self.json_str)['bill']
-
-                self.bill_data['bill_id'] = self.content['bill_id']
-                self.bill_data['bill_number'] = self.content['bill_number']
-                self.bill_data['title'] = self.content['title']
-                self.bill_data['description'] = self.content['description']
-                self.bill_data['state'] = self.content['state']
-                self.bill_data['session'] = self.content['session']['session_name']
-                self.bill_data['filename'] = filename
-                self.bill_data['status'] = self.content['status']
-                self.bill_data['status_date'] = self.content['status_date']
-
-                try:
-                    self.bill_data['url'] = self.content['texts'][-1]['state_link']
-                except:
-                    self.bill_data['url'] = None
+                self.parse_bill_json(file.read(), filename)
+        
+            self.all_bill_data[filename] = self.bill_data
+        return
+    
+    def process_zip(self): 
+        '''
+        Same as process_json, but the json files are streamed from the open dataset zip instead of being read back off disk
+        '''
         
+        self.all_bill_data = {}
+        self.filenames = []
+        for filename, json_str in self.iter_zip_json(): 
+            self.parse_bill_json(json_str, filename)
+            self.filenames.append(filename)
             self.all_bill_data[filename] = self.bill_data
         return
+    
+    def parse_bill_json(self, json_str, filename): 
+        '''Pull the columns we keep out of a single bill json string'''
+        # We need to do a little string replacing so the 
+        self.json_str = json_str.replace('"0000-00-00"', 'null')
+        self.content = json.loads(self.json_str)['bill']
+        self.bill_data = bill_record(self.content, filename)
+        return self.bill_data
             
     def create_dataframe(self):
         ''' create a dataframe with the json dictionary'''
         
         COLUMNS = ['bill_id','bill_number','title','description','state','session','filename','status','status_date','url']
-        self.dataframe_final = pd.DataFrame(columns=COLUMNS)
-        keys_all_bills = list(self.all_bill_data.keys())
-        for i in keys_all_bills:
-            values = []
-            for j in list((self.all_bill_data[i]).keys()):
-                values.append(self.all_bill_data[i][j])
-            self.dataframe_final.loc[i] = values
-        self.dataframe_final.reset_index(inplace=True)
-        try: 
-            self.dataframe_final.drop(columns=['index'], axis=1, inplace=True)
-        except: 
-            pass
+        # build the frame in one go -- appending row by row with .loc is quadratic in the number of bills
+        self.dataframe_final = pd.DataFrame.from_records(list(self.all_bill_data.values()), columns=COLUMNS)
         return
 
     def df_to_csv(self): 
@@ -116,6 +190,129 @@ class FetchData:
         self.dataframe_final.to_csv('./data/' + '/bills-with-urls.csv', index=False)
         return 
 
+    def partition_filename(self, state, session = None): 
+        '''<STATE>.csv, or <STATE>_<session>.csv when partitioning by session'''
+        name = str(state)
+        if session is not None: 
+            name += '_' + re.sub(r'[^A-Za-z0-9]+', '_', str(session)).strip('_')
+        return name + '.' + self.file_format
+    
+    def write_partition(self, filename, df): 
+        '''
+        Write one partition, merging with the rows already in the file (rows with the same bill_id are replaced). Returns the manifest entry for the file.
+        '''
+        path = os.path.join(self.PATH_PARTITION_DIR, filename)
+        if os.path.exists(path): 
+            existing = pd.read_parquet(path) if self.file_format == 'parquet' else pd.read_csv(path)
+            existing = existing.loc[~existing['bill_id'].isin(df['bill_id'])]
+            df = pd.concat([existing, df], ignore_index=True)
+        df = df.sort_values('bill_id')
+        tmp_path = path + '.tmp'
+        if self.file_format == 'parquet': 
+            df.to_parquet(tmp_path, index=False)
+        else: 
+            df.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, path)
+        
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as file: 
+            for block in iter(lambda: file.read(1 << 20), b''): 
+                sha256.update(block)
+        return {'state': str(df['state'].iloc[0]), 
+                'session': str(df['session'].iloc[0]) if self.partition == 'session' else None, 
+                'rows': len(df), 
+                'sha256': sha256.hexdigest()}
+    
+    def df_to_partitions(self, max_workers = None): 
+        '''
+        Split self.dataframe_final by state (and session) and write the partitions in parallel. partitions.json records the row count and sha256 of every partition so MyDB.load_partitions only loads files that changed.
+        '''
+        if self.partition not in ('state', 'session'): 
+            raise ValueError("partition must be 'state' or 'session'")
+        if self.file_format not in ('csv', 'parquet'): 
+            raise ValueError("file_format must be 'csv' or 'parquet'")
+        os.makedirs(self.PATH_PARTITION_DIR, exist_ok=True)
+        keys = ['state', 'session'] if self.partition == 'session' else ['state']
+        groups = {}
+        for key, group in self.dataframe_final.groupby(keys): 
+            groups[self.partition_filename(*key)] = group
+        
+        with ThreadPoolExecutor(max_workers=max_workers) as pool: 
+            entries = dict(zip(groups.keys(), pool.map(self.write_partition, groups.keys(), groups.values())))
+        
+        manifest = {}
+        if os.path.exists(self.PATH_PARTITIONS): 
+            with open(self.PATH_PARTITIONS) as file: 
+                manifest = json.load(file)
+        manifest.update(entries)
+        with open(self.PATH_PARTITIONS + '.tmp', 'w') as file: 
+            json.dump(manifest, file, indent=1)
+        os.replace(self.PATH_PARTITIONS + '.tmp', self.PATH_PARTITIONS)
+        return entries
+    
+    def load_manifest(self): 
+        '''Read the dataset hashes recorded by the last sync (keyed by session_id)'''
+        if os.path.exists(self.PATH_MANIFEST): 
+            with open(self.PATH_MANIFEST) as file: 
+                self.manifest = json.load(file)
+        else: 
+            self.manifest = {}
+        return self.manifest
+    
+    def save_manifest(self): 
+        '''Write the manifest to a temporary file first so an interrupted sync never leaves a half written manifest behind'''
+        tmp_path = self.PATH_MANIFEST + '.tmp'
+        with open(tmp_path, 'w') as file: 
+            json.dump(self.manifest, file, indent=1)
+        os.replace(tmp_path, self.PATH_MANIFEST)
+        return
+    
+    def sync_datasets(self, db = None): 
+        '''
+        Walk every dataset from get_dataset_list and compare its dataset_hash against the manifest. Only datasets whose hash changed are downloaded and parsed (streamed from the zip), and their bills are upserted into bills-with-urls.csv and tBills. The manifest is saved after every dataset so an interrupted sync picks up where it stopped.
+        '''
+        if db is None: 
+            db = MyDB()
+        self.load_manifest()
+        self.datasets = self.legis.get_dataset_list()
+        self.synced = []
+        for dataset in self.datasets: 
+            session_id = str(dataset['session_id'])
+            if self.manifest.get(session_id, {}).get('dataset_hash') == dataset['dataset_hash']: 
+                continue
+            print('Syncing', dataset['state_id'], dataset.get('session_name', session_id))
+            self.dataset = self.legis.get_dataset(dataset['session_id'], dataset['access_key'])
+            self.open_dataset_zip()
+            self.process_zip()
+            self.create_dataframe()
+            if self.partition is not None: 
+                self.df_to_partitions()
+            else: 
+                self.upsert_csv()
+            db.upsert_bills(self.dataframe_final)
+            self.manifest[session_id] = {'dataset_hash': dataset['dataset_hash'], 
+                                         'state_id': dataset['state_id'], 
+                                         'session_name': dataset.get('session_name'), 
+                                         'dataset_date': dataset.get('dataset_date'), 
+                                         'bills': len(self.dataframe_final)}
+            self.save_manifest()
+            self.synced.append(session_id)
+        print('Synced', len(self.synced), 'of', len(self.datasets), 'datasets')
+        return self.synced
+    
+    def upsert_csv(self): 
+        '''Merge self.dataframe_final into bills-with-urls.csv, replacing any rows that share a bill_id'''
+        path = os.path.join(self.PATH_OUT, 'bills-with-urls.csv')
+        if os.path.exists(path): 
+            existing = pd.read_csv(path)
+            existing = existing.loc[~existing['bill_id'].isin(self.dataframe_final['bill_id'])]
+            merged = pd.concat([existing, self.dataframe_final], ignore_index=True)
+        else: 
+            merged = self.dataframe_final
+        merged.to_csv(path + '.tmp', index=False)
+        os.replace(path + '.tmp', path)
+        return
+
     def get_test_datasets(self): 
         return self.datasets.copy()
     
@@ -0,0 +1,232 @@
+from create_database import MyDB
+from ner import PIPELINE_PROFILES, chunk_text
+from rollups import Rollups
+import sql_queries as SQ
+import argparse
+import collections
+import threading
+import numpy as np
+import pandas as pd
+
+class KeywordEngine:
+    '''
+    Computes the most distinctive keywords of every bill and of every state/session from tBills.content and stores them in indexed tables, so the app only has to read them.
+
+    Bill texts are part-of-speech tagged in batches with nlp.pipe and only lemmas of the selected parts of speech are kept. Term counts per bill are stored in tBillTerms (a sparse bill x term table) and document frequencies in tTermDF. Both are updated incrementally: a bill that gets new content has its old counts subtracted before the new ones are added, and a bill that loses its content has them subtracted and its keywords dropped. All pending bills are streamed through a single nlp.pipe call, so the tagging worker processes start once per update, and the counts are written every batch_size bills. Scores are (1 + log tf) * idf, computed with vectorized pandas operations over the sparse table. Keyword counts per state/session/status in tKeywordRollup are kept in step with tKeywords.
+
+    class parameters:
+
+    db: MyDB instance for legislation.db (default: MyDB())
+    model: spaCy pipeline used for part-of-speech tagging (default: str = 'en_core_web_sm')
+    keep_pos: coarse part-of-speech tags whose lemmas count as terms (default: tuple = ('NOUN', 'PROPN', 'ADJ'))
+    top_k: number of keywords stored per bill and per state/session (default: int = 20)
+    batch_size: number of bills tagged and written per transaction (default: int = 64)
+    n_process: number of tagging worker processes, -1 uses every core (default: int = -1)
+    '''
+
+    def __init__(self,
+                 db: MyDB = None,
+                 model: str = 'en_core_web_sm',
+                 keep_pos: tuple = ('NOUN', 'PROPN', 'ADJ'),
+                 top_k: int = 20,
+                 batch_size: int = 64,
+                 n_process: int = -1,
+                ):
+        self.db = db if db is not None else MyDB()
+        self.model = model
+        self.keep_pos = set(keep_pos)
+        self.top_k = top_k
+        self.batch_size = batch_size
+        self.n_process = n_process
+        self._nlp = None
+        self._load_lock = threading.Lock()
+        self.build_tables()
+        self.rollups = Rollups(self.db)
+
+    @property
+    def nlp(self):
+        '''The spaCy pipeline, loaded on first use with only the components tagging needs'''
+        if self._nlp is None:
+            with self._load_lock:
+                if self._nlp is None:
+                    import spacy
+                    self._nlp = spacy.load(self.model, exclude=PIPELINE_PROFILES['pos'])
+        return self._nlp
+
+    def build_tables(self):
+        '''Create the term, keyword and checkpoint tables and their indexes if they do not exist'''
+        self.db.connect()
+        for sql in SQ.SQL_KEYWORDS_BUILD:
+            self.db.curs.execute(sql)
+        self.db.close()
+        return
+
+    def bill_terms(self, texts):
+        '''Yield a Counter of kept lemmas for each text. Long texts are tagged in chunks; tags do not need context across chunks, so there is no overlap'''
+        owners = collections.deque()
+
+        def pieces():
+            for text in texts:
+                chunks = chunk_text(text, max_chars=100000, overlap=0)
+                for k, (offset, chunk) in enumerate(chunks):
+                    owners.append(k == len(chunks) - 1)
+                    yield chunk
+
+        counts = collections.Counter()
+        for doc in self.nlp.pipe(pieces(), batch_size=self.batch_size, n_process=self.n_process):
+            counts.update(token.lemma_.lower() for token in doc
+                          if token.pos_ in self.keep_pos and token.is_alpha and not token.is_stop and len(token) > 2)
+            if owners.popleft():
+                yield counts
+                counts = collections.Counter()
+
+    def pending_bills(self, limit: int = None) -> list:
+        '''bill_ids with text whose terms have not been counted since the text last changed'''
+        self.db.connect()
+        sql = SQ.SQL_PENDING_KEYWORD_BILLS + ('' if limit is None else ' LIMIT ' + str(int(limit)))
+        bill_ids = [row[0] for row in self.db.curs.execute(sql)]
+        self.db.close()
+        return bill_ids
+
+    def bills_without_text(self) -> list:
+        '''bill_ids whose terms are counted (or checkpointed) although their text is gone'''
+        self.db.connect()
+        bill_ids = [row[0] for row in self.db.curs.execute(SQ.SQL_KEYWORD_BILLS_WITHOUT_TEXT)]
+        self.db.close()
+        return bill_ids
+
+    def write_terms(self, batch: list, retired: list = ()):
+        '''
+        Replace the term counts of a batch of (bill_id, Counter) and keep tTermDF in step, in one transaction. The counts and checkpoints of the retired bills, which have no text any more, are removed, and terms left in no bill are dropped from tTermDF.
+        '''
+        bill_ids = [bill_id for bill_id, counts in batch] + [int(bill_id) for bill_id in retired]
+        placeholders = ', '.join('?' * len(bill_ids))
+        self.db.curs.execute('BEGIN;')
+        try:
+            old_terms = self.db.curs.execute(SQ.SQL_SELECT_BILL_TERMS.format(placeholders), bill_ids).fetchall()
+            self.db.curs.executemany(SQ.SQL_DECREMENT_TERM_DF, [(term,) for bill_id, term, tf in old_terms])
+            self.db.curs.execute(SQ.SQL_DELETE_BILL_TERMS.format(placeholders), bill_ids)
+            rows = [(bill_id, term, tf) for bill_id, counts in batch for term, tf in counts.items()]
+            self.db.curs.executemany(SQ.SQL_INSERT_BILL_TERM, rows)
+            self.db.curs.executemany(SQ.SQL_INCREMENT_TERM_DF, [(term,) for bill_id, term, tf in rows])
+            self.db.curs.execute(SQ.SQL_DELETE_UNUSED_TERM_DF)
+            self.db.curs.executemany(SQ.SQL_UPSERT_KEYWORD_RUN, [(bill_id,) for bill_id, counts in batch])
+            self.db.curs.executemany(SQ.SQL_INVALIDATE_KEYWORD_RUN, [(int(bill_id),) for bill_id in retired])
+            self.db.curs.execute('COMMIT;')
+        except Exception:
+            self.db.curs.execute('ROLLBACK;')
+            raise
+        return
+
+    def update(self, limit: int = None) -> int:
+        '''
+        Count terms for every pending bill and remove the counts of bills whose text is gone, then rescore the keywords of those bills and of every state/session they belong to. Returns the number of bills tagged.
+        '''
+        self.rollups.move_changed('keyword')
+        retired = self.bills_without_text()
+        bill_ids = self.pending_bills(limit)
+        print(len(bill_ids), 'bills to tag,', len(retired), 'bills without text')
+        if len(bill_ids) == 0 and len(retired) == 0:
+            return 0
+
+        self.db.connect()
+        owners = collections.deque()
+        def texts():
+            # read batch_size bills at a time; bill_terms yields the counts in the same order
+            for i in range(0, len(bill_ids), self.batch_size):
+                chunk = bill_ids[i:i + self.batch_size]
+                for bill_id, content in self.db.curs.execute(SQ.SQL_SELECT_CLEAN_CONTENT.format(', '.join('?' * len(chunk))), chunk).fetchall():
+                    owners.append(bill_id)
+                    yield content
+
+        done = 0
+        try:
+            if len(retired) > 0:
+                self.write_terms([], retired)
+            batch = []
+            for counts in self.bill_terms(texts()):
+                batch.append((owners.popleft(), counts))
+                if len(batch) == self.batch_size:
+                    self.write_terms(batch)
+                    done += len(batch)
+                    batch = []
+                    print(done, 'of', len(bill_ids), 'bills tagged')
+            if len(batch) > 0:
+                self.write_terms(batch)
+                done += len(batch)
+        finally:
+            self.db.close()
+
+        changed = bill_ids + retired
+        self.score_bills(changed)
+        sessions = self.db.run_query(SQ.SQL_SELECT_SESSIONS_OF_BILLS.format(', '.join(str(int(b)) for b in changed)))
+        self.score_sessions(list(sessions.itertuples(index=False, name=None)))
+        return done
+
+    def idf(self, terms: pd.DataFrame) -> pd.Series:
+        '''Smoothed inverse document frequency for each row of a frame with a df column'''
+        n_docs = self.db.run_query('SELECT COUNT(*) AS n FROM tKeywordRuns;')['n'].iloc[0]
+        return np.log((1 + n_docs) / (1 + terms['df'])) + 1
+
+    def top_k_rows(self, scored: pd.DataFrame, keys: list) -> pd.DataFrame:
+        '''Keep the top_k highest scoring terms for each group of keys and number them'''
+        scored = scored.sort_values(keys + ['score'], ascending=[True] * len(keys) + [False])
+        scored['rank'] = scored.groupby(keys).cumcount() + 1
+        return scored.loc[scored['rank'] <= self.top_k]
+
+    def score_bills(self, bill_ids: list = None):
+        '''Recompute the top keywords of the given bills (all bills if None) from the stored term counts; spaCy is not run'''
+        where = '' if bill_ids is None else ' WHERE t.bill_id IN (' + ', '.join(str(int(b)) for b in bill_ids) + ')'
+        terms = self.db.run_query(SQ.SQL_SELECT_TERMS_WITH_DF + where + ';')
+        terms['score'] = (1 + np.log(terms['tf'])) * self.idf(terms)
+        keywords = self.top_k_rows(terms, ['bill_id'])[['bill_id', 'term', 'score', 'rank']]
+
+        self.db.connect()
+        self.db.curs.execute('BEGIN;')
+        if bill_ids is None:
+            self.db.curs.execute('DELETE FROM tKeywords;')
+            self.db.curs.executemany(SQ.SQL_INSERT_KEYWORD, keywords.itertuples(index=False, name=None))
+            self.rollups.rebuild(self.db.curs, 'keyword')
+        else:
+            self.rollups.remove(self.db.curs, 'keyword', bill_ids)
+            self.db.curs.execute('DELETE FROM tKeywords WHERE bill_id IN (' + ', '.join(str(int(b)) for b in bill_ids) + ');')
+            self.db.curs.executemany(SQ.SQL_INSERT_KEYWORD, keywords.itertuples(index=False, name=None))
+            self.rollups.add(self.db.curs, 'keyword', bill_ids)
+        self.db.curs.execute('COMMIT;')
+        self.db.close()
+        return keywords
+
+    def score_sessions(self, sessions: list = None):
+        '''Recompute the top keywords of the given (state, session) pairs (all if None) by summing term counts over their bills'''
+        if sessions is None:
+            sessions = list(self.db.run_query('SELECT DISTINCT state, session FROM tBills;').itertuples(index=False, name=None))
+        rows = []
+        for state, session in sessions:
+            terms = self.db.run_query(SQ.SQL_SELECT_SESSION_TERMS, (state, session))
+            terms['score'] = (1 + np.log(terms['tf'])) * self.idf(terms)
+            terms = terms.nlargest(self.top_k, 'score')
+            terms['rank'] = range(1, len(terms) + 1)
+            rows.extend((state, session, term, score, rank) for term, score, rank in terms[['term', 'score', 'rank']].itertuples(index=False, name=None))
+
+        self.db.connect()
+        self.db.curs.execute('BEGIN;')
+        self.db.curs.executemany(SQ.SQL_DELETE_SESSION_KEYWORDS, sessions)
+        self.db.curs.executemany(SQ.SQL_INSERT_SESSION_KEYWORD, rows)
+        self.db.curs.execute('COMMIT;')
+        self.db.close()
+        return rows
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Count terms in new bill text and update the stored keyword summaries')
+    args.add_argument('--model', default='en_core_web_sm')
+    args.add_argument('--top-k', type=int, default=20)
+    args.add_argument('--batch-size', type=int, default=64)
+    args.add_argument('--n-process', type=int, default=-1)
+    args.add_argument('--limit', type=int, default=None)
+    args.add_argument('--rescore', action='store_true', help='recompute every stored keyword with the current document frequencies')
+    args = args.parse_args()
+    engine = KeywordEngine(model=args.model, top_k=args.top_k, batch_size=args.batch_size, n_process=args.n_process)
+    engine.update(args.limit)
+    if args.rescore:
+        engine.score_bills()
+        engine.score_sessions()
@@ -2,6 +2,7 @@
 
 import os
 import json
+import threading
 import requests
 from urllib.parse import urlencode
 from urllib.parse import quote_plus
@@ -192,4 +193,47 @@ class LegiScan(object):
         return '<LegiScan API {0}>'.format(self.key)
 
     def __repr__(self):
-        return str(self)
\ No newline at end of file
+        return str(self)
+
+class CachedLegiScan(LegiScan):
+    """LegiScan API client that keeps responses for operations whose result
+       never changes for a given id (bill texts, amendments, supplements and
+       roll calls) in a local directory, so repeated runs do not spend API
+       calls or bandwidth on the same documents.
+    """
+    CACHED_OPERATIONS = ('getBillText', 'getAmendment', 'getSupplement',
+                         'getRollcall')
+
+    def __init__(self, apikey=None, cache_dir=None):
+        super(CachedLegiScan, self).__init__(apikey)
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(__file__), 'data',
+                                     'legiscan_cache')
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _cache_path(self, url):
+        """Cache file for a url, or None if the operation is not cached."""
+        # everything after the api key: op=<operation>&<params>
+        query = url.split('&', 1)[1]
+        operation = query.split('&', 1)[0][len('op='):]
+        if operation not in self.CACHED_OPERATIONS:
+            return None
+        name = quote_plus(query) + '.json'
+        return os.path.join(self.cache_dir, name)
+
+    def _get(self, url):
+        """Return the cached response for a url if there is one, otherwise
+           query the API and cache the result."""
+        path = self._cache_path(url)
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                return json.load(f)
+        data = super(CachedLegiScan, self)._get(url)
+        if path is not None:
+            # write then rename so a concurrent reader never sees half a file
+            tmp_path = '{0}.{1}.tmp'.format(path, threading.get_ident())
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, path)
+        return data
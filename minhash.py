@@ -0,0 +1,419 @@
+from create_database import MyDB
+from shingles import shingle_set
+from array_store import ArrayStore
+import sql_queries as SQ
+import argparse
+import json
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+# universal hashing (a * x + b) mod p with the Mersenne prime 2**61 - 1, truncated to 32 bits
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+BAND_PRIME = np.uint64(1099511628211)
+
+def minhash_signature(shingles: np.ndarray, a: np.ndarray, b: np.ndarray, block: int = 2048) -> np.ndarray:
+    '''MinHash signature of a set of shingle hashes: for each of the len(a) hash functions, the minimum hash over the set'''
+    signature = np.full(len(a), MAX_HASH, dtype=np.uint64)
+    values = shingles & MAX_HASH
+    with np.errstate(over='ignore'):
+        # hash blocks of shingles at a time, so a long bill never needs a shingles x num_perm matrix in memory
+        for i in range(0, len(values), block):
+            hashed = ((values[i:i + block, None] * a + b) % MERSENNE_PRIME) & MAX_HASH
+            signature = np.minimum(signature, hashed.min(axis=0))
+    return signature.astype(np.uint32)
+
+def _signatures(args):
+    '''Signatures of a batch of texts, run in a worker process'''
+    texts, shingle_size, a, b = args
+    return [minhash_signature(shingle_set(text, shingle_size), a, b) for text in texts]
+
+def match(store: ArrayStore, band_index, signature: np.ndarray, threshold: float) -> list:
+    '''[(bill_id, estimated Jaccard similarity)] of the live rows of a signature store sharing a band with a signature, most similar first'''
+    rows = band_index.candidates(band_index.hashes(signature[None, :])[0])
+    rows = rows[store.live()[rows]]
+    scores = (store.matrix[rows] == signature).mean(axis=1)
+    keep = np.flatnonzero(scores >= threshold)
+    keep = keep[np.argsort(-scores[keep], kind='stable')]
+    return list(zip(store.ids[rows[keep]].tolist(), scores[keep].tolist()))
+
+def _pairs(args):
+    '''Near-duplicate pairs of a batch of indexed bills, run in a worker process on the index saved under path'''
+    path, bands, threshold, bill_ids = args
+    store = ArrayStore(os.path.join(path, 'signatures')).open()
+    band_index = BandIndex(os.path.join(path, 'band_index'), bands).open()
+    pairs = []
+    for bill_id in bill_ids:
+        row = store.row_of(bill_id)
+        if row >= 0:
+            pairs.extend((bill_id, other_id, score) for other_id, score in match(store, band_index, np.asarray(store.row(row)), threshold)
+                         if other_id != bill_id)
+    return pairs
+
+class BandIndex:
+    '''
+    The band keys of a MinHash index sorted within every band, with the row each key belongs to, saved under path and read through memory maps. Two bands x rows files hold the sorted keys and their rows, so a bill's candidates are found with a binary search per band and processes opening the index share its pages instead of each sorting the keys again.
+
+    update() merges the keys of rows appended since the last update into the saved order: the new keys are sorted on their own and inserted band by band, so only one band is in memory at a time and the existing keys are never sorted again. The files are written under a new generation number and meta.json, which names the generation, is replaced last, so readers keep a consistent index while it is updated. Equal keys stay in row order.
+
+    class parameters:
+
+    path: directory of the index
+    bands: number of LSH bands
+    '''
+
+    def __init__(self, path: str, bands: int):
+        self.path = path
+        self.bands = bands
+        self.meta = {'bands': bands, 'rows': 0, 'generation': 0}
+        self.keys = self.order = None
+
+    def file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def files(self, generation: int) -> tuple:
+        return self.file('keys.{0}.bin'.format(generation)), self.file('order.{0}.bin'.format(generation))
+
+    @property
+    def rows(self) -> int:
+        return self.meta['rows']
+
+    def hashes(self, signatures: np.ndarray) -> np.ndarray:
+        '''One 64-bit key per band of each signature'''
+        rows = signatures.reshape(len(signatures), self.bands, -1).astype(np.uint64)
+        keys = rows[:, :, 0].copy()
+        with np.errstate(over='ignore'):
+            for r in range(1, rows.shape[2]):
+                keys = keys * BAND_PRIME + rows[:, :, r]
+        return keys
+
+    def open(self):
+        '''Memory-map the sorted keys and their rows (bands x rows); nothing is read until they are searched'''
+        if os.path.exists(self.file('meta.json')):
+            with open(self.file('meta.json')) as f:
+                self.meta = json.load(f)
+            if self.meta['bands'] != self.bands:
+                raise ValueError('the band index in {0} has {1} bands'.format(self.path, self.meta['bands']))
+        else:
+            self.meta = {'bands': self.bands, 'rows': 0, 'generation': 0}
+        keys, order = self.files(self.meta['generation'])
+        count = self.bands * self.meta['rows']
+        self.keys = ArrayStore.map(keys, '<u8', count).reshape(self.bands, self.meta['rows'])
+        self.order = ArrayStore.map(order, '<i8', count).reshape(self.bands, self.meta['rows'])
+        return self
+
+    def write_meta(self, rows: int, generation: int):
+        '''Switch readers to the files of a generation and remove the ones of the previous generation'''
+        old = self.meta['generation']
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.file('meta.json.tmp'), 'w') as f:
+            json.dump({'bands': self.bands, 'rows': rows, 'generation': generation}, f)
+        os.replace(self.file('meta.json.tmp'), self.file('meta.json'))
+        for path in self.files(old):
+            if os.path.exists(path):
+                os.remove(path)
+        return self.open()
+
+    def clear(self):
+        '''Forget the saved order, so the next update() sorts every row again. Needed when row numbers change'''
+        if self.keys is None:
+            self.open()
+        return self.write_meta(0, self.meta['generation'] + 1)
+
+    def update(self, band_keys: np.ndarray) -> int:
+        '''Merge the rows of band_keys (rows x bands) after the ones already indexed into every band. Returns the number of rows added'''
+        if self.keys is None:
+            self.open()
+        first, total = self.meta['rows'], len(band_keys)
+        if total < first:
+            # the band keys were rewritten since the index was saved
+            self.clear()
+            first = 0
+        if total == first:
+            return 0
+        os.makedirs(self.path, exist_ok=True)
+        keys_path, order_path = self.files(self.meta['generation'] + 1)
+        with open(keys_path, 'wb') as keys_file, open(order_path, 'wb') as order_file:
+            for band in range(self.bands):
+                added = np.asarray(band_keys[first:, band], dtype=np.uint64)
+                added_order = np.argsort(added, kind='stable')
+                keys = np.asarray(self.keys[band])
+                at = np.searchsorted(keys, added[added_order], side='right')
+                keys_file.write(np.insert(keys, at, added[added_order]).astype('<u8').tobytes())
+                order_file.write(np.insert(np.asarray(self.order[band]), at, added_order + first).astype('<i8').tobytes())
+        self.write_meta(total, self.meta['generation'] + 1)
+        return total - first
+
+    def candidates(self, keys: np.ndarray) -> np.ndarray:
+        '''Rows sharing at least one band key with keys (one key per band), found by binary search in each band'''
+        rows = []
+        for band in range(self.bands):
+            lo = np.searchsorted(self.keys[band], keys[band], side='left')
+            hi = np.searchsorted(self.keys[band], keys[band], side='right')
+            if hi > lo:
+                rows.append(self.order[band, lo:hi])
+        if len(rows) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(rows))
+
+class MinHashLSH:
+    '''
+    Near-duplicate index over the bill texts in tBills. Every bill is reduced to the set of hashed word n-grams (shingles) of its normalized text and summarized by a MinHash signature of num_perm values, computed with vectorized NumPy arithmetic. The fraction of equal signature values estimates the Jaccard similarity of two bills' shingle sets.
+
+    Signatures are split into bands of rows; two bills whose signatures agree on every row of at least one band are candidates. For every band the band keys are kept sorted in a BandIndex, so query() finds candidates with a binary search per band instead of comparing against every bill, and only candidates are scored. With the defaults (32 bands of 4 rows), pairs with a Jaccard similarity of 0.5 are found with a probability of about 0.87, and of 0.7 with a probability above 0.999.
+
+    Signatures and band keys are kept in append-only, memory-mapped ArrayStores under path, and the sorted band keys in a memory-mapped BandIndex next to them, so opening the index reads and sorts nothing and the app and batch jobs share its pages. The index is updated incrementally: update() adds bills whose text is new or changed since they were indexed (tMinHashRuns is cleared by Bill.save), merges their band keys into the sorted bands and refreshes their pairs in tNearDuplicates. Hashing and pair scoring run on one process pool per update().
+
+    class parameters:
+
+    db: MyDB instance for legislation.db (default: MyDB())
+    num_perm: number of hash functions in a signature (default: int = 128)
+    bands: number of LSH bands, must divide num_perm (default: int = 32)
+    shingle_size: number of words per shingle (default: int = 5)
+    threshold: minimum estimated Jaccard similarity of the pairs stored in tNearDuplicates (default: float = 0.5)
+    max_bucket: bands shared by more bills than this are skipped when listing all pairs, since they hold boilerplate (default: int = 500)
+    batch_size: number of bills read and hashed per batch (default: int = 256)
+    max_workers: number of hashing processes, None uses every core (default: None)
+    seed: seed of the hash functions; an index can only be updated with the seed it was built with (default: int = 1)
+    path: directory the index is saved in (default: data/minhash)
+    '''
+
+    def __init__(self,
+                 db: MyDB = None,
+                 num_perm: int = 128,
+                 bands: int = 32,
+                 shingle_size: int = 5,
+                 threshold: float = 0.5,
+                 max_bucket: int = 500,
+                 batch_size: int = 256,
+                 max_workers: int = None,
+                 seed: int = 1,
+                 path: str = None,
+                ):
+        if num_perm % bands != 0:
+            raise ValueError('bands must divide num_perm')
+        self.db = db if db is not None else MyDB()
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.threshold = threshold
+        self.max_bucket = max_bucket
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.seed = seed
+        self.path = path or os.path.join(self.db.path_data, 'minhash')
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+
+        # one row per indexed bill; a bill that is indexed again gets a new row and its old row is no longer live
+        self.store = ArrayStore(os.path.join(self.path, 'signatures'), np.uint32, num_perm)
+        self.band_store = ArrayStore(os.path.join(self.path, 'band_keys'), np.uint64, bands)
+        self.band_index = BandIndex(os.path.join(self.path, 'band_index'), bands)
+        self.build_tables()
+        self.load()
+        self.sort_bands()
+
+    def build_tables(self):
+        '''Create the checkpoint and pair tables if they do not exist'''
+        self.db.connect()
+        for sql in SQ.SQL_MINHASH_BUILD:
+            self.db.curs.execute(sql)
+        self.db.close()
+        return
+
+    def load(self):
+        '''
+        Open the stores. The hash functions must match the ones the index was built with. Band keys missing after an interrupted add() are computed again from the signatures.
+        '''
+        meta = {'num_perm': self.num_perm, 'bands': self.bands, 'shingle_size': self.shingle_size, 'seed': self.seed}
+        if os.path.exists(os.path.join(self.path, 'meta.json')):
+            with open(os.path.join(self.path, 'meta.json')) as f:
+                saved = json.load(f)
+            if saved != meta:
+                raise ValueError('the index in {0} was built with {1}'.format(self.path, saved))
+        else:
+            os.makedirs(self.path, exist_ok=True)
+            with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+        self.store.open()
+        self.band_store.open()
+        missing = self.store.rows - self.band_store.rows
+        if missing > 0:
+            self.band_store.append(self.store.ids[-missing:], self.band_index.hashes(np.asarray(self.store.matrix[-missing:])))
+        self.band_index.open()
+        return
+
+    def sort_bands(self):
+        '''Take views of the stored signatures and merge band keys added since the last call into the sorted bands'''
+        self.signatures = self.store.matrix
+        self.band_index.update(self.band_store.matrix)
+        return
+
+    def signature(self, text: str) -> np.ndarray:
+        return minhash_signature(shingle_set(text, self.shingle_size), self.a, self.b)
+
+    def query_signature(self, signature: np.ndarray, threshold: float = None) -> list:
+        '''[(bill_id, estimated Jaccard similarity)] of indexed bills similar to a signature, most similar first'''
+        return match(self.store, self.band_index, signature, self.threshold if threshold is None else threshold)
+
+    def query(self, bill_id: int, threshold: float = None) -> list:
+        '''[(bill_id, estimated Jaccard similarity)] of the near-duplicates of an indexed bill, most similar first'''
+        row = self.store.row_of(bill_id)
+        if row < 0:
+            raise KeyError('bill {0} is not in the index, run update() first'.format(bill_id))
+        return [(other_id, score) for other_id, score in self.query_signature(self.signatures[row], threshold)
+                if other_id != bill_id]
+
+    def query_text(self, text: str, threshold: float = None) -> list:
+        '''[(bill_id, estimated Jaccard similarity)] of indexed bills similar to any text'''
+        return self.query_signature(self.signature(text), threshold)
+
+    def add(self, bill_ids: list, signatures: np.ndarray, index: bool = True):
+        '''
+        Append bills to the stores; the rows of bills that were indexed before are no longer live. With index=False the bills are only written, and become searchable after the next indexed add() or finish_adding(), so a bulk load indexes and sorts once.
+        '''
+        self.store.append(bill_ids, signatures, index=False)
+        self.band_store.append(bill_ids, self.band_index.hashes(signatures), index=False)
+        if index:
+            self.finish_adding()
+        return
+
+    def finish_adding(self, retired: list = ()):
+        '''Index the rows added with index=False, drop retired bills from the index and merge the new band keys into the sorted bands'''
+        self.store.update_index()
+        self.band_store.update_index()
+        if len(retired) > 0:
+            self.store.retire(retired)
+            self.band_store.retire(retired)
+        self.sort_bands()
+        return
+
+    def split(self, items: list) -> list:
+        '''Split items into about four batches per worker process'''
+        step = max(1, len(items) // (4 * (self.max_workers or os.cpu_count() or 1)))
+        return [items[i:i + step] for i in range(0, len(items), step)]
+
+    def hash_contents(self, rows: list, pool: ProcessPoolExecutor = None) -> list:
+        '''Signatures of (bill_id, content) rows, hashed in parallel batches on pool (in this process if None)'''
+        batches = [(texts, self.shingle_size, self.a, self.b) for texts in self.split([content for bill_id, content in rows])]
+        results = map(_signatures, batches) if pool is None else pool.map(_signatures, batches)
+        return [signature for batch in results for signature in batch]
+
+    def update(self, limit: int = None) -> int:
+        '''
+        Index every bill whose text is new or changed since it was indexed and store the near-duplicate pairs of those bills. Returns the number of bills indexed.
+        '''
+        self.db.connect()
+        sql = SQ.SQL_PENDING_MINHASH_BILLS + ('' if limit is None else ' LIMIT ' + str(int(limit)))
+        pending = [row[0] for row in self.db.curs.execute(sql)]
+        self.db.close()
+        print(len(pending), 'bills to index')
+        if len(pending) == 0:
+            return 0
+
+        too_short = []
+        # one pool for every batch and for the pairs, so worker processes start once per update
+        with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+            for i in range(0, len(pending), self.batch_size):
+                chunk = pending[i:i + self.batch_size]
+                self.db.connect()
+                rows = self.db.curs.execute(SQ.SQL_SELECT_CLEAN_CONTENT.format(', '.join('?' * len(chunk))), chunk).fetchall()
+                self.db.close()
+                signatures = self.hash_contents(rows, pool)
+                # texts shorter than one shingle have no signature: an older signature of the bill must not stay live
+                keep = [k for k, signature in enumerate(signatures) if signature[0] != MAX_HASH]
+                too_short.extend(rows[k][0] for k in range(len(rows)) if signatures[k][0] == MAX_HASH)
+                self.add([rows[k][0] for k in keep], np.array([signatures[k] for k in keep], dtype=np.uint32).reshape(-1, self.num_perm), index=False)
+                print(min(i + self.batch_size, len(pending)), 'of', len(pending), 'bills hashed')
+            self.finish_adding(retired=too_short)
+            # bills without a signature now have no pairs either
+            self.write_pairs(pending, pool)
+
+        self.db.connect()
+        self.db.curs.execute('BEGIN;')
+        self.db.curs.executemany(SQ.SQL_UPSERT_MINHASH_RUN, [(bill_id,) for bill_id in pending])
+        self.db.curs.execute('COMMIT;')
+        self.db.close()
+        return len(pending)
+
+    def write_pairs(self, bill_ids: list, pool: ProcessPoolExecutor = None):
+        '''
+        Replace the stored pairs of these bills with their current near-duplicates (both directions are stored). Batches of bills are scored on pool (in this process if None); the workers open the saved index, so it must be up to date.
+        '''
+        batches = [(self.path, self.bands, self.threshold, batch) for batch in self.split(list(bill_ids))]
+        results = map(_pairs, batches) if pool is None else pool.map(_pairs, batches)
+        pairs = [pair for batch in results for pair in batch]
+        self.replace_pairs(bill_ids, pairs)
+        return len(pairs)
+
+    def replace_pairs(self, bill_ids: list, pairs: list):
+        ids = ', '.join(str(int(b)) for b in bill_ids)
+        self.db.connect()
+        self.db.curs.execute('BEGIN;')
+        if ids != '':
+            self.db.curs.execute(SQ.SQL_DELETE_NEAR_DUPLICATES.format(ids))
+        self.db.curs.executemany(SQ.SQL_INSERT_NEAR_DUPLICATE, pairs + [(other_id, bill_id, score) for bill_id, other_id, score in pairs])
+        self.db.curs.execute('COMMIT;')
+        self.db.close()
+        return
+
+    def all_pairs(self, threshold: float = None) -> list:
+        '''
+        Every pair of indexed bills sharing a band, scored: [(bill_id, other_id, estimated Jaccard)] with bill_id < other_id. Candidates come from runs of equal keys in the sorted bands, so bills are never compared against the whole corpus.
+        '''
+        threshold = self.threshold if threshold is None else threshold
+        live, ids, n = self.store.live(), self.store.ids, self.store.rows
+        found = []
+        for band in range(self.bands):
+            keys = np.asarray(self.band_index.keys[band])
+            starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+            sizes = np.diff(np.r_[starts, len(keys)])
+            for start, size in zip(starts[(sizes > 1) & (sizes <= self.max_bucket)], sizes[(sizes > 1) & (sizes <= self.max_bucket)]):
+                rows = np.asarray(self.band_index.order[band, start:start + size])
+                rows = rows[live[rows]]
+                i, j = np.triu_indices(len(rows), k=1)
+                found.append(np.minimum(rows[i], rows[j]) * n + np.maximum(rows[i], rows[j]))
+        if len(found) == 0:
+            return []
+        found = np.unique(np.concatenate(found))
+        left, right = found // n, found % n
+        pairs = []
+        for i in range(0, len(found), 100000):
+            scores = (self.signatures[left[i:i + 100000]] == self.signatures[right[i:i + 100000]]).mean(axis=1)
+            keep = np.flatnonzero(scores >= threshold)
+            pairs.extend(zip(ids[left[i:i + 100000][keep]].tolist(), ids[right[i:i + 100000][keep]].tolist(), scores[keep].tolist()))
+        return [(min(a, b), max(a, b), score) for a, b, score in pairs]
+
+    def compact(self):
+        '''Drop the rows of bills that were indexed again from both stores and sort the bands of the remaining rows'''
+        # row numbers change, so the saved order is dropped first: an interrupted compact() is sorted again on the next open
+        self.band_index.clear()
+        self.store.compact()
+        self.band_store.compact()
+        self.sort_bands()
+        return
+
+    def rebuild_pairs(self, threshold: float = None) -> int:
+        '''Recompute tNearDuplicates for the whole corpus'''
+        pairs = self.all_pairs(threshold)
+        self.db.connect()
+        self.db.curs.execute('DELETE FROM tNearDuplicates;')
+        self.db.close()
+        self.replace_pairs([], pairs)
+        print(len(pairs), 'near-duplicate pairs')
+        return len(pairs)
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Add new bill text to the MinHash index and store near-duplicate pairs')
+    args.add_argument('--threshold', type=float, default=0.5)
+    args.add_argument('--max-workers', type=int, default=None)
+    args.add_argument('--limit', type=int, default=None)
+    args.add_argument('--rebuild-pairs', action='store_true', help='recompute the pairs of the whole corpus')
+    args = args.parse_args()
+    index = MinHashLSH(threshold=args.threshold, max_workers=args.max_workers)
+    index.update(args.limit)
+    if args.rebuild_pairs:
+        index.rebuild_pairs()
@@ -0,0 +1,222 @@
+from create_database import MyDB
+from shingles import shingle_set
+from normalize import normalize_text
+import sql_queries as SQ
+import argparse
+import hashlib
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+# file types read from a model legislation folder; everything except plain text goes through Tika
+MODEL_EXTENSIONS = ('.txt', '.pdf', '.doc', '.docx', '.rtf', '.htm', '.html')
+
+# shingle index of the model corpus, set in every matching process by _init_worker
+_index = {}
+
+def _init_worker(keys, owners, sizes, shingle_size):
+    _index.update(keys=keys, owners=owners, sizes=sizes, shingle_size=shingle_size)
+
+def _match_batch(rows):
+    '''Score a batch of (bill_id, content) against the model corpus. Returns [(bill_id, model index, shared, containment, jaccard)]'''
+    keys, owners, sizes = _index['keys'], _index['owners'], _index['sizes']
+    matches = []
+    for bill_id, content in rows:
+        shingles = shingle_set(content, _index['shingle_size'])
+        lo = np.searchsorted(keys, shingles, side='left')
+        hi = np.searchsorted(keys, shingles, side='right')
+        counts = hi - lo
+        if counts.sum() == 0:
+            continue
+        # every position of the index holding one of the bill's shingles
+        positions = np.repeat(lo, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        shared = np.bincount(owners[positions], minlength=len(sizes))
+        for model in np.flatnonzero(shared):
+            matches.append((bill_id, int(model), int(shared[model]), shared[model] / sizes[model],
+                            shared[model] / (sizes[model] + len(shingles) - shared[model])))
+    return matches
+
+class ModelBills:
+    '''
+    Store for model legislation (bills written by industry groups and introduced in several states) and a matching engine that scores every bill in tBills against it.
+
+    ingest() reads a folder of text/PDF/Word/HTML files into tModelBills, parsing everything except plain text with Tika like bill_text.Bill does. match() builds an inverted index from the word shingles of the model corpus to the models they occur in (a sorted NumPy array), so for each bill only the models that share shingles with it are candidates. Candidates are scored exactly: containment is the share of a model's shingles found in the bill, which stays high when a model section is inserted into a long bill, and jaccard is the overlap of the two shingle sets. Bills are scored in batches on a process pool, every batch is checkpointed in tModelMatchRuns, and the top_k matches of each bill are written to tModelMatches. Adding or changing a model document queues every bill to be matched again.
+
+    class parameters:
+
+    db: MyDB instance for legislation.db (default: MyDB())
+    shingle_size: number of words per shingle (default: int = 5)
+    min_shared: minimum number of shingles a bill and a model must share to be scored (default: int = 10)
+    min_containment: minimum containment of a stored match (default: float = 0.1)
+    top_k: number of matches stored per bill (default: int = 10)
+    batch_size: number of bills per worker task (default: int = 64)
+    max_workers: number of matching processes, None uses every core (default: None)
+    '''
+
+    def __init__(self,
+                 db: MyDB = None,
+                 shingle_size: int = 5,
+                 min_shared: int = 10,
+                 min_containment: float = 0.1,
+                 top_k: int = 10,
+                 batch_size: int = 64,
+                 max_workers: int = None,
+                ):
+        self.db = db if db is not None else MyDB()
+        self.shingle_size = shingle_size
+        self.min_shared = min_shared
+        self.min_containment = min_containment
+        self.top_k = top_k
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.build_tables()
+
+    def build_tables(self):
+        '''Create the model corpus, match and checkpoint tables if they do not exist'''
+        self.db.connect()
+        for sql in SQ.SQL_MODEL_BILLS_BUILD:
+            self.db.curs.execute(sql)
+        self.db.close()
+        return
+
+    @staticmethod
+    def read_document(path: str):
+        '''Text of a model legislation file. Returns (content, error) like bill_text.parse_document'''
+        with open(path, 'rb') as f:
+            buffer = f.read()
+        if path.lower().endswith('.txt'):
+            return buffer.decode('utf-8', errors='replace').strip() or None, None
+        from bill_text import parse_document
+        return parse_document(buffer)
+
+    def ingest(self, folder: str, source: str = None) -> int:
+        '''
+        Add every model legislation file under folder (recursively) to tModelBills. source names the organization the documents come from (default: the folder name). Files that were ingested before are only parsed again if they changed. Returns the number of documents added or updated.
+        '''
+        source = source or os.path.basename(os.path.normpath(folder))
+        self.db.connect()
+        known = dict(self.db.curs.execute('SELECT path, file_hash FROM tModelBills;').fetchall())
+        self.db.close()
+
+        rows = []
+        for root, dirs, files in os.walk(folder):
+            for name in sorted(files):
+                if not name.lower().endswith(MODEL_EXTENSIONS):
+                    continue
+                path = os.path.abspath(os.path.join(root, name))
+                with open(path, 'rb') as f:
+                    file_hash = hashlib.sha1(f.read()).hexdigest()
+                if known.get(path) == file_hash:
+                    continue
+                content, error = self.read_document(path)
+                rows.append({'source': source, 'title': os.path.splitext(name)[0], 'path': path,
+                             'file_hash': file_hash, 'content': content, 'error': error})
+                print(path, 'ingested' if error is None else 'failed: ' + error)
+
+        if len(rows) > 0:
+            self.db.connect()
+            self.db.curs.execute('BEGIN;')
+            self.db.curs.executemany(SQ.SQL_UPSERT_MODEL_BILL, rows)
+            self.db.curs.execute('COMMIT;')
+            self.db.close()
+        print(len(rows), 'model documents added or updated')
+        return len(rows)
+
+    def corpus_version(self) -> str:
+        '''Hash of the model corpus; bills matched against another version are matched again'''
+        self.db.connect()
+        hashes = [row[0] for row in self.db.curs.execute('SELECT file_hash FROM tModelBills WHERE content IS NOT NULL ORDER BY model_id;')]
+        self.db.close()
+        return hashlib.sha1('\n'.join(hashes).encode()).hexdigest()
+
+    def model_index(self):
+        '''(model_ids, sorted shingle keys, model index of every key, number of shingles per model) for the model corpus'''
+        self.db.connect()
+        models = self.db.curs.execute('SELECT model_id, content FROM tModelBills WHERE content IS NOT NULL ORDER BY model_id;').fetchall()
+        self.db.close()
+        # model documents get the same boilerplate removal as the bills they are compared with
+        shingles = [shingle_set(normalize_text(content), self.shingle_size) for model_id, content in models]
+        keys = np.concatenate(shingles) if len(shingles) > 0 else np.zeros(0, dtype=np.uint64)
+        owners = np.repeat(np.arange(len(shingles)), [len(s) for s in shingles])
+        order = np.argsort(keys, kind='stable')
+        sizes = np.array([max(len(s), 1) for s in shingles])
+        return [model_id for model_id, content in models], keys[order], owners[order], sizes
+
+    def ranked(self, matches: list, model_ids: list) -> list:
+        '''Keep the top_k matches of each bill above the thresholds, numbered by containment'''
+        by_bill = {}
+        for bill_id, model, shared, containment, jaccard in matches:
+            if shared >= self.min_shared and containment >= self.min_containment:
+                by_bill.setdefault(bill_id, []).append((model_ids[model], shared, containment, jaccard))
+        rows = []
+        for bill_id, found in by_bill.items():
+            found.sort(key=lambda match: (-match[2], -match[1]))
+            rows.extend((bill_id, model_id, shared, containment, jaccard, rank + 1)
+                        for rank, (model_id, shared, containment, jaccard) in enumerate(found[:self.top_k]))
+        return rows
+
+    def write_matches(self, bill_ids: list, rows: list, version: str):
+        '''Replace the matches of a batch of bills and checkpoint them, in one transaction'''
+        self.db.connect()
+        self.db.curs.execute('BEGIN;')
+        try:
+            self.db.curs.execute('DELETE FROM tModelMatches WHERE bill_id IN (' + ', '.join(str(int(b)) for b in bill_ids) + ');')
+            self.db.curs.executemany(SQ.SQL_INSERT_MODEL_MATCH, rows)
+            self.db.curs.executemany(SQ.SQL_UPSERT_MODEL_MATCH_RUN, [(bill_id, version) for bill_id in bill_ids])
+            self.db.curs.execute('COMMIT;')
+        except Exception:
+            self.db.curs.execute('ROLLBACK;')
+            raise
+        finally:
+            self.db.close()
+        return
+
+    def match(self, limit: int = None) -> int:
+        '''
+        Score every bill that has not been matched against the current model corpus. Interrupted runs resume with the bills that were not checkpointed yet. Returns the number of bills scored.
+        '''
+        version = self.corpus_version()
+        self.db.connect()
+        sql = SQ.SQL_PENDING_MODEL_MATCH_BILLS + ('' if limit is None else ' LIMIT ' + str(int(limit)))
+        pending = [row[0] for row in self.db.curs.execute(sql, (version,))]
+        self.db.close()
+        print(len(pending), 'bills to match')
+        if len(pending) == 0:
+            return 0
+
+        model_ids, keys, owners, sizes = self.model_index()
+        print(len(model_ids), 'model documents,', len(keys), 'shingles')
+        workers = self.max_workers or os.cpu_count() or 1
+        window = self.batch_size * workers
+        done = 0
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(keys, owners, sizes, self.shingle_size)) as pool:
+            for i in range(0, len(pending), window):
+                chunk = pending[i:i + window]
+                self.db.connect()
+                rows = self.db.curs.execute(SQ.SQL_SELECT_CLEAN_CONTENT.format(', '.join('?' * len(chunk))), chunk).fetchall()
+                self.db.close()
+                batches = [rows[j:j + self.batch_size] for j in range(0, len(rows), self.batch_size)]
+                matches = [match for batch in pool.map(_match_batch, batches) for match in batch]
+                self.write_matches(chunk, self.ranked(matches, model_ids), version)
+                done += len(chunk)
+                print(done, 'of', len(pending), 'bills matched')
+        return done
+
+    def matches_for_bill(self, bill_id: int):
+        '''Ranked model documents matching a bill'''
+        return self.db.run_query(SQ.SQL_SELECT_MODEL_MATCHES, (bill_id,))
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Ingest model legislation and match bills against it')
+    commands = args.add_subparsers(dest='command', required=True)
+    ingest = commands.add_parser('ingest', help='add a folder of text/PDF/Word/HTML files to tModelBills')
+    ingest.add_argument('folder')
+    ingest.add_argument('--source', default=None, help='organization the documents come from (default: the folder name)')
+    match = commands.add_parser('match', help='score bills against the model corpus')
+    match.add_argument('--max-workers', type=int, default=None)
+    match.add_argument('--limit', type=int, default=None)
+    args = args.parse_args()
+    if args.command == 'ingest':
+        ModelBills().ingest(args.folder, args.source)
+    else:
+        ModelBills(max_workers=args.max_workers).match(args.limit)
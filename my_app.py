@@ -2,20 +2,38 @@ import create_database
 from create_database import MyDB
 from bill_text import Bill
 import bill_text
+from legiscan import CachedLegiScan
+import os
 import pandas as pd
 import streamlit as st
 import streamlit_scrollable_textbox as stx
-import streamlit_nested_layout
 import io
+import logging
 import time
-import spacy
-#from spacy import displacy
-from spacy_streamlit import visualize_ner
+import difflib
+import html
+from ner import NERService
+from alignment import PassageAligner, align_texts
+import sql_queries as SQ
 
 class MyApp:
-    def __init__(self):
+    '''
+    class parameters:
+    
+    ner_model: spaCy pipeline used for NER (default: str = 'en_core_web_sm')
+    ner_profile: pipeline profile from ner.PIPELINE_PROFILES, 'ner' loads only the components NER needs (default: str = 'ner')
+    ner_batch_size: number of bill texts spaCy processes per batch (default: int = 4)
+    ner_processes: number of processes used for NER, -1 uses every core. The app runs NER in its own process: a worker pool would be started on every rerun, and whole-corpus NER belongs to batch_ner.py (default: int = 1)
+    '''
+    def __init__(self, 
+                 ner_model: str = 'en_core_web_sm', 
+                 ner_profile: str = 'ner', 
+                 ner_batch_size: int = 4, 
+                 ner_processes: int = 1
+                ):
         self.db = self.build_database()
-        self.nlp = self.build_model()
+        # the model itself is only loaded the first time a bill is run through NER
+        self.ner = self.build_ner_service(ner_model, ner_profile, ner_batch_size, ner_processes)
         self.build_page()
         return
 
@@ -35,6 +53,10 @@ class MyApp:
         # dropboxes for state and session selection
         self.select_state()
         self.select_session()
+        self.show_session_keywords()
+        self.show_session_topics()
+        self.show_session_summary()
+        self.show_state_share()
         
         # initalize the main screen by emptying all elements
         main_screen = st.empty()
@@ -76,12 +98,25 @@ class MyApp:
         return _self.db
     
     @st.cache_resource(show_spinner=False)
-    def build_model(_self): 
+    def build_ner_service(_self, model, profile, batch_size, n_process): 
+        '''
+        Cache the batch NER service that runs all bills of a session through the spaCy model in one pass and keeps the results in legislation.db -- "_sm" indicates that we are using a smaller version of the model for runtime but other versions are available
+        '''
+        return NERService(model=model, profile=profile, batch_size=batch_size, n_process=n_process, db=_self.db)
+    
+    @st.cache_resource(show_spinner=False)
+    def build_legiscan(_self): 
         '''
-        Cache an instance of the spaCy NER model -- "_sm" indicates that we are using a smaller version of the model for runtime but other versions are available
+        Cache a Legiscan client that keeps downloaded bill texts on disk, so reruns never download the same document twice
         '''
-        _self.nlp = spacy.load("en_core_web_sm")
-        return _self.nlp
+        return CachedLegiScan()
+    
+    @st.cache_resource(show_spinner=False)
+    def build_aligner(_self): 
+        '''
+        Cache the passage aligner used for the shared passages of a selected bill pair; stored alignments (alignment.py) are read, pairs that were never aligned are aligned on request
+        '''
+        return PassageAligner(db=_self.db)
     
     def create_ner_info_table(_self): 
         '''
@@ -110,6 +145,81 @@ class MyApp:
         self.session_choice = st.sidebar.selectbox('Select a session:', self.sessions)
         return self.session_choice
     
+    def show_session_keywords(self): 
+        '''
+        Show the precomputed keywords of the selected state and session (written by keywords.py) in the sidebar. Nothing is computed here, so the table is empty until the keyword engine has run.
+        '''
+        try: 
+            keywords = self.db.run_query(SQ.SQL_SELECT_SESSION_KEYWORDS, (self.state_choice, self.session_choice))
+        except Exception: # keyword tables have not been built yet
+            return
+        if len(keywords) > 0: 
+            with st.sidebar.expander('Session keywords'): 
+                st.dataframe(keywords, hide_index=True)
+        return
+    
+    def show_session_topics(self): 
+        '''
+        Show the topics of the selected state and session from the stored topic weights (written by topics.py) in the sidebar
+        '''
+        try: 
+            topics = self.db.run_query(SQ.SQL_SELECT_SESSION_TOPICS, {'state': self.state_choice, 'session': self.session_choice})
+        except Exception: # topic tables have not been built yet
+            return
+        if len(topics) > 0: 
+            with st.sidebar.expander('Session topics'): 
+                st.dataframe(topics, hide_index=True)
+        return
+    
+    def show_session_summary(self): 
+        '''
+        Show the most mentioned entities and the keywords shared by the most bills in the selected state and session. Both come from the materialized rollup tables, so this is a lookup rather than NER over every bill.
+        '''
+        try: 
+            labels = ['All'] + self.db.run_query('SELECT DISTINCT label FROM tEntityRollup WHERE state = (?) AND session = (?) ORDER BY label;', 
+                                                 (self.state_choice, self.session_choice))['label'].tolist()
+        except Exception: # rollup tables have not been built yet
+            return
+        with st.sidebar.expander('Session entity and keyword summary'): 
+            label = st.selectbox('Entity label:', labels)
+            st.dataframe(self.db.top_entities(self.state_choice, self.session_choice, label=None if label == 'All' else label), hide_index=True)
+            st.dataframe(self.db.top_keywords(self.state_choice, self.session_choice), hide_index=True)
+        return
+    
+    def show_state_share(self): 
+        '''
+        Heatmap of the number of bills of each state that share text with another state, from the precomputed matrix of state_share.py. Picking a state pair (and optionally a pair of sessions) lists the bill pairs behind the cell; every table here is an indexed lookup, nothing reads the pair tables.
+        '''
+        import altair as alt
+        try: 
+            share = self.db.state_share()
+        except Exception: # the matrix has not been built yet
+            return
+        # bills sharing text within their own state would drown out the rest of the scale
+        share = share.loc[share['state'] != share['other_state']]
+        if len(share) == 0: 
+            return
+        with st.expander('Shared text between states'): 
+            st.altair_chart(alt.Chart(share).mark_rect().encode(
+                x=alt.X('other_state:N', title='shares text with'), 
+                y=alt.Y('state:N', title='bills of'), 
+                color=alt.Color('bills:Q', title='bills'), 
+                tooltip=['state', 'other_state', 'bills', 'other_bills', 'pairs']), use_container_width=True)
+            states = sorted(share['state'].unique())
+            state = st.selectbox('Bills of:', states, index=states.index(self.state_choice) if self.state_choice in states else 0, key='share_state')
+            others = share.loc[share['state'] == state].sort_values('bills', ascending=False)['other_state'].tolist()
+            other_state = st.selectbox('Sharing text with:', others, key='share_other_state')
+            sessions = self.db.state_session_share(state, other_state)
+            st.dataframe(sessions, hide_index=True)
+            labels = ['All sessions'] + [str(session) + ' / ' + str(other_session) for session, other_session in sessions[['session', 'other_session']].itertuples(index=False)]
+            choice = st.selectbox('Sessions:', range(len(labels)), format_func=lambda row: labels[row], key='share_sessions')
+            if choice == 0: 
+                st.dataframe(self.db.state_pairs(state, other_state), hide_index=True)
+            else: 
+                row = sessions.iloc[choice - 1]
+                st.dataframe(self.db.state_pairs(state, other_state, row['session'], row['other_session']), hide_index=True)
+        return
+    
     def get_bills(self): 
         '''
         Using the class variables self.session_choice and self.state_choice, we are running a query on the sqlite3 database to retrieve all relevant bills, which we are saving as a class variable (self.results) and displaying as a streamlit dataframe.
@@ -143,9 +253,11 @@ class MyApp:
                                         con=self.db.conn, params=(self.state_choice, self.session_choice))
         id_nums = still_unprocessed['bill_id'].tolist()
         if len(id_nums)!=0: # get text for any bills in the unprocessed list
-            for i in id_nums: 
-                bill = Bill.get(self.db.conn, i)
-                bill.update_content()
+            # with a Legiscan API key, pull documents through getBillText first and fall back to the state website
+            if os.environ.get('LEGISCAN_API_KEY'): 
+                Bill.process_bills(self.db.conn, id_nums, sources=('api', 'url'), legis=self.build_legiscan())
+            else: 
+                Bill.process_bills(self.db.conn, id_nums)
         self.db.close()
         return 
     
@@ -154,8 +266,12 @@ class MyApp:
         Retrieve the bill text for the bills in the chosen state and session, then query the database for the bill texts (or errors if the bill could not be retrieved). If there is only one bill for a given session, run the NER and visualize the summary statistics. If there are multiple bills per session per state, create nested streamlit expanders to condense the length of the webpage. Each expander contains the NER category selection box, labeled text, and summary table. Bills that errored out through Tika will display a string describing the error message.
         '''
         
+        # deferred so the page can render before these (and spaCy) are imported
+        import streamlit_nested_layout # allows the nested expanders below
+        from spacy_streamlit import visualize_ner
+        
         self.retrieve_bill_text()
-        self.query = """ SELECT title, content 
+        self.query = """ SELECT bill_id, title, content 
                         FROM tBills
                         WHERE state = (?) AND session = (?)
                         ;"""
@@ -166,6 +282,15 @@ class MyApp:
         results = self.db.run_query(sql=self.query, params=(self.state_choice, self.session_choice))
         errors = self.db.run_query(sql=self.errors_query, params=(self.state_choice, self.session_choice))
         
+        # run NER over every bill in the session that has text in one pass (or read it from the cache), then render the Docs below
+        has_content = results['content'].notnull()
+        try: 
+            self.docs = dict(zip(results.index[has_content], 
+                                 self.ner.docs_for_bills(results.loc[has_content, 'bill_id'], results.loc[has_content, 'content'])))
+        except Exception: # fall back to one bill at a time so a single bad text does not hide the others
+            logging.exception('NER over %s %s failed, running the bills one at a time', self.state_choice, self.session_choice)
+            self.docs = {}
+        
         # if there's one bill for a given legislative session...
         if results.shape[0] == 1:
             if (results.iloc[0]['content'] is None): # if there is no content, check for the specific errors we have handled
@@ -188,8 +313,9 @@ class MyApp:
                     pass
             else: 
                 text = results.iloc[0]['content']
-                doc = self.nlp(text)
-                visualize_ner(doc, labels=self.nlp.get_pipe("ner").labels, title = ' ')
+                doc = self.docs[0] if 0 in self.docs else self.ner.docs([text])[0]
+                visualize_ner(doc, labels=self.ner.labels, title = ' ')
+                self.show_similar_bills(int(results.iloc[0]['bill_id']), text, key=0)
         # if there is more than one bill for a given legislative session, this block runs: 
         else: 
             for i, x in enumerate(range(results.shape[0])): 
@@ -216,10 +342,68 @@ class MyApp:
                     else: # content is available and we can visualize it
                         try: 
                             text = results.iloc[i]['content']
-                            doc = self.nlp(text)
-                            visualize_ner(doc, labels=self.nlp.get_pipe("ner").labels, key=x, title= ' ')
+                            doc = self.docs[i] if i in self.docs else self.ner.docs([text])[0]
+                            visualize_ner(doc, labels=self.ner.labels, key=x, title= ' ')
                         except: # for any reason spaCy cannot visualize the bill content, throw this error message
                             st.error('The bill titled "' + str(results.iloc[i]['title']) + '" could not be visualized.')
+                        self.show_similar_bills(int(results.iloc[i]['bill_id']), results.iloc[i]['content'], key=x)
+
+    def show_similar_bills(self, bill_id: int, content: str, key, limit: int = 10): 
+        '''
+        Show the copy family, near duplicates, related bills and possible model sources of a bill under its text. The list is a lookup on the tables written by minhash.py, similar.py and model_bills.py, so nothing is computed while the page loads. The shared passages of a pair are only loaded once a pair is selected and "Show shared passages" is ticked.
+        '''
+        family = self.db.copy_family(bill_id)
+        if len(family) > 0: 
+            family = family.iloc[0]
+            st.info('This text was introduced in ' + str(family['states']) + ' states (' + str(family['bills']) + ' bills). Representative bill: ' +
+                    ' '.join(str(part) for part in (family['state'], family['session'], family['code'], family['title']) if part is not None))
+        matches = self.db.similar_bills(bill_id, limit=limit)
+        if len(matches) == 0: 
+            return
+        st.write('**Similar bills and possible model sources**')
+        st.dataframe(matches, hide_index=True)
+        labels = [match + ': ' + ' '.join(str(part) for part in (state, session, code) if part is not None) + ' ' + str(title)
+                  for match, state, session, code, title in matches[['match', 'state', 'session', 'code', 'title']].itertuples(index=False)]
+        choice = st.selectbox('Compare with:', range(len(matches)), format_func=lambda row: labels[row], key='similar_' + str(key))
+        if not st.checkbox('Show shared passages', key='passages_' + str(key)): 
+            return
+        other = matches.iloc[choice]
+        with st.spinner('Aligning...'): 
+            if other['match'] == 'model source': 
+                other_content = self.db.run_query(SQ.SQL_SELECT_MODEL_CONTENT, (int(other['id']),))['content'].iloc[0]
+                passages = align_texts(content, other_content)
+            else: 
+                other_content = self.db.run_query('SELECT content FROM tBills WHERE bill_id = (?);', (int(other['id']),))['content'].iloc[0]
+                passages = self.build_aligner().passages(bill_id, int(other['id']))
+        if len(passages) == 0: 
+            return st.write('No shared passages were found.')
+        for start, end, other_start, other_end, tokens, score in passages[:5]: 
+            left, right = st.columns(2)
+            a, b = self.passage_diff(content[start:end], other_content[other_start:other_end])
+            left.markdown(a, unsafe_allow_html=True)
+            right.markdown(b, unsafe_allow_html=True)
+            st.caption(str(tokens) + ' shared words')
+        return
+    
+    @staticmethod
+    def passage_diff(a: str, b: str, max_words: int = 400) -> tuple:
+        '''
+        Word diff of two passages as HTML: words only in the first are struck through on the left, words only in the second are highlighted on the right. Long passages are cut to max_words words.
+        '''
+        words_a, words_b = a.split()[:max_words], b.split()[:max_words]
+        left, right = [], []
+        for op, i1, i2, j1, j2 in difflib.SequenceMatcher(None, words_a, words_b, autojunk=False).get_opcodes(): 
+            part_a, part_b = html.escape(' '.join(words_a[i1:i2])), html.escape(' '.join(words_b[j1:j2]))
+            if op == 'equal': 
+                left.append(part_a)
+                right.append(part_b)
+                continue
+            if part_a: 
+                left.append('<del style="background-color:#fdd">' + part_a + '</del>')
+            if part_b: 
+                right.append('<ins style="background-color:#dfd">' + part_b + '</ins>')
+        # inside a <div> the text is rendered as HTML and not as markdown
+        return '<div>' + ' '.join(left) + '</div>', '<div>' + ' '.join(right) + '</div>'
 
     def streamlit_defaults(self):
         '''
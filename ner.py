@@ -0,0 +1,224 @@
+import os
+import re
+import collections
+import hashlib
+import threading
+import sql_queries as SQ
+
+# pipeline components each profile leaves out when the model is loaded. The ner component of the
+# en_core_web CNN pipelines has its own embedding layer, so the shared tok2vec is not needed either.
+# 'pos' keeps what part-of-speech tags and lemmas need (tok2vec, tagger, attribute_ruler, lemmatizer)
+PIPELINE_PROFILES = {
+    'ner': ['tok2vec', 'tagger', 'parser', 'senter', 'attribute_ruler', 'lemmatizer'],
+    'pos': ['parser', 'senter', 'ner'],
+    'full': [],
+}
+
+# places a long bill can be split, most preferred first: before a section heading ("Section 1.", "SEC. 2.", "§ 3"),
+# at a blank line (paragraph), at a line break, at any whitespace
+CHUNK_BOUNDARIES = [
+    re.compile(r'\n(?=[ \t]*(?:section|sec\.|§)\s*\d)', re.IGNORECASE),
+    re.compile(r'\n[ \t]*\n'),
+    re.compile(r'\n'),
+    re.compile(r'\s'),
+]
+
+def chunk_text(text: str, max_chars: int = 100000, overlap: int = 1000) -> list:
+    '''
+    Split text into (offset, chunk) pairs of at most max_chars characters. Each chunk ends on the best boundary in CHUNK_BOUNDARIES found in the second half of the window, and the next chunk starts about overlap characters earlier so entities cut at a seam are seen whole by one of the two chunks.
+    '''
+    overlap = min(overlap, max_chars // 4)
+    chunks = []
+    start = 0
+    while len(text) - start > max_chars:
+        end = start + max_chars
+        for pattern in CHUNK_BOUNDARIES:
+            matches = list(pattern.finditer(text, start + max_chars // 2, start + max_chars))
+            if len(matches) > 0:
+                end = matches[-1].end()
+                break
+        chunks.append((start, text[start:end]))
+        # start the next chunk on whitespace inside the overlap
+        space = CHUNK_BOUNDARIES[-1].search(text, end - overlap, end)
+        start = space.end() if space is not None else end - overlap
+    chunks.append((start, text[start:]))
+    return chunks
+
+class NERService:
+    '''
+    Runs spaCy named entity recognition over many bill texts in one pass. Texts are streamed through nlp.pipe, which batches documents and can spread them over several worker processes, instead of calling nlp(text) once per bill.
+
+    Texts longer than max_chars are split with chunk_text, the chunks go through the model like any other text, and the entities are merged back into one Doc for the whole bill, so the memory spaCy needs per document stays bounded however long the bill is.
+
+    When a database is given, results are cached in tNerCache as serialized DocBins keyed by bill_id, model name/version and a hash of the bill content, so a bill is only run through the model again when its text or the model changes.
+
+    The model is loaded (and spacy imported) the first time it is needed, not when the service is created.
+
+    class parameters:
+
+    model: name or path of the spaCy pipeline to load (default: str = 'en_core_web_sm')
+    profile: key of PIPELINE_PROFILES naming the components to leave out; 'ner' keeps only what NER needs, 'full' loads everything (default: str = 'ner')
+    batch_size: number of texts spaCy buffers per batch (default: int = 4)
+    n_process: number of worker processes, -1 uses every core (default: int = -1)
+    db: MyDB instance used for the result cache (default: None, no caching)
+    nlp: an already loaded pipeline to use instead of loading model (default: None)
+    max_chars: texts longer than this are split into chunks for NER (default: int = 100000)
+    overlap: characters shared by neighbouring chunks (default: int = 1000)
+    '''
+
+    def __init__(self,
+                 model: str = 'en_core_web_sm',
+                 profile: str = 'ner',
+                 batch_size: int = 4,
+                 n_process: int = -1,
+                 db = None,
+                 nlp = None,
+                 max_chars: int = 100000,
+                 overlap: int = 1000,
+                ):
+        if profile not in PIPELINE_PROFILES:
+            raise ValueError("profile must be one of " + str(list(PIPELINE_PROFILES)))
+        self.model = model
+        self.profile = profile
+        self._nlp = nlp
+        self._load_lock = threading.Lock()
+        self.batch_size = batch_size
+        self.n_process = n_process
+        self.db = db
+        self.max_chars = max_chars
+        self.overlap = overlap
+        if self.db is not None:
+            self.db.connect()
+            self.db.curs.execute(SQ.SQL_NER_CACHE_BUILD)
+            self.db.close()
+
+    @property
+    def nlp(self):
+        '''The spaCy pipeline, loaded on first use with the components of the profile excluded'''
+        if self._nlp is None:
+            with self._load_lock:
+                if self._nlp is None:
+                    import spacy
+                    self._nlp = spacy.load(self.model, exclude=PIPELINE_PROFILES[self.profile])
+        return self._nlp
+
+    @property
+    def labels(self):
+        '''Entity labels the model can predict, for visualize_ner'''
+        return self.nlp.get_pipe('ner').labels
+
+    @property
+    def model_name(self):
+        '''Name and version of the loaded pipeline, e.g. en_core_web_sm-3.7.1'''
+        return '{0}_{1}-{2}'.format(self.nlp.meta.get('lang'), self.nlp.meta.get('name'), self.nlp.meta.get('version'))
+
+    @staticmethod
+    def content_hash(text: str) -> str:
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def processes_for(self, n_texts: int) -> int:
+        '''Worker processes to use for n_texts texts; starting processes costs more than it saves for a single text'''
+        n_process = (os.cpu_count() or 1) if self.n_process == -1 else self.n_process
+        return max(1, min(n_process, n_texts))
+
+    def docs(self, texts: list) -> list:
+        '''
+        Run NER over all texts in one pass and return the Docs in the same order. Long texts are chunked, and the chunks of every text share the same nlp.pipe call, so a single long bill is also spread over the worker processes.
+        '''
+        texts = list(texts)
+        if len(texts) == 0:
+            return []
+        n_pieces = sum(len(text) // self.max_chars + 1 for text in texts)
+        return list(self.iter_docs(texts, n_process=self.processes_for(n_pieces)))
+
+    def iter_docs(self, texts, n_process: int = None):
+        '''
+        Generator version of docs: texts can be any iterable (e.g. rows streamed from the database) and each Doc is yielded as soon as all chunks of its text are done, so callers can write results out while the model keeps running.
+        '''
+        if n_process is None:
+            n_process = self.processes_for(os.cpu_count() or 1)
+        # nlp.pipe returns results in input order, so chunk bookkeeping is a FIFO queue filled as pieces are handed to spaCy
+        owners = collections.deque()
+
+        def pieces():
+            for text in texts:
+                chunks = [(0, text)] if len(text) <= self.max_chars else chunk_text(text, self.max_chars, self.overlap)
+                for k, (offset, chunk) in enumerate(chunks):
+                    owners.append((text, len(chunks), offset, len(chunk)))
+                    yield chunk
+
+        chunk_entities = []
+        for doc in self.nlp.pipe(pieces(), batch_size=self.batch_size, n_process=n_process):
+            text, n_chunks, offset, length = owners.popleft()
+            if n_chunks == 1:
+                yield doc
+                continue
+            # keep only the entities of a chunk, not its Doc, until the whole bill is done
+            chunk_entities.append((offset, length, [(ent.start_char, ent.end_char, ent.label_) for ent in doc.ents]))
+            if len(chunk_entities) == n_chunks:
+                yield self.merge_chunks(text, chunk_entities)
+                chunk_entities = []
+
+    def merge_chunks(self, text: str, chunk_entities: list):
+        '''
+        Build one Doc for a chunked text from the entities found in each chunk. Offsets are shifted to the full text; where chunks overlap, each chunk keeps the entities starting in its half of the overlap and any entities still overlapping are resolved in favour of the longest.
+        '''
+        from spacy.util import filter_spans
+
+        entities = []
+        for k, (offset, length, ents) in enumerate(chunk_entities):
+            own_start = 0 if k == 0 else (offset + chunk_entities[k - 1][0] + chunk_entities[k - 1][1]) // 2
+            own_end = len(text) if k == len(chunk_entities) - 1 else (offset + length + chunk_entities[k + 1][0]) // 2
+            for start, end, label in ents:
+                if own_start <= offset + start < own_end:
+                    entities.append((offset + start, offset + end, label))
+
+        # the tokenizer alone has no max_length limit and is cheap compared to the pipeline
+        doc = self.nlp.tokenizer(text)
+        spans = [doc.char_span(start, end, label=label, alignment_mode='expand') for start, end, label in entities]
+        doc.set_ents(filter_spans([span for span in spans if span is not None]))
+        return doc
+
+    def docs_for_bills(self, bill_ids: list, texts: list) -> list:
+        '''
+        Same as docs, but Docs cached in tNerCache for the same bill, content and model are deserialized instead of being run through the model. New results are written back to the cache.
+        '''
+        from spacy.tokens import DocBin
+
+        bill_ids = [int(bill_id) for bill_id in bill_ids]
+        texts = list(texts)
+        if self.db is None or len(texts) == 0:
+            return self.docs(texts)
+        hashes = [self.content_hash(text) for text in texts]
+
+        cached = {}
+        self.db.connect()
+        for i in range(0, len(bill_ids), 500):
+            chunk = bill_ids[i:i + 500]
+            sql = SQ.SQL_SELECT_NER_CACHE.format(', '.join('?' * len(chunk)))
+            for bill_id, content_hash, docbin in self.db.curs.execute(sql, [self.model_name] + chunk):
+                cached[bill_id] = (content_hash, docbin)
+        self.db.close()
+
+        docs = [None] * len(texts)
+        misses = []
+        for i, (bill_id, content_hash) in enumerate(zip(bill_ids, hashes)):
+            if bill_id in cached and cached[bill_id][0] == content_hash:
+                docs[i] = next(DocBin().from_bytes(cached[bill_id][1]).get_docs(self.nlp.vocab))
+            else:
+                misses.append(i)
+
+        rows = []
+        for i, doc in zip(misses, self.docs(texts[i] for i in misses)):
+            docs[i] = doc
+            # only the entity annotation is needed to render the bill again
+            docbin = DocBin(attrs=['ENT_IOB', 'ENT_TYPE', 'ENT_KB_ID'], docs=[doc])
+            rows.append({'bill_id': bill_ids[i], 'model': self.model_name, 'content_hash': hashes[i], 'docbin': docbin.to_bytes()})
+
+        if len(rows) > 0:
+            self.db.connect()
+            self.db.curs.execute('BEGIN;')
+            self.db.curs.executemany(SQ.SQL_UPSERT_NER_CACHE, rows)
+            self.db.curs.execute('COMMIT;')
+            self.db.close()
+        return docs
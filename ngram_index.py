@@ -0,0 +1,208 @@
+from create_database import MyDB
+from shingles import tokenize, hash_tokens, shingle_hashes
+import sql_queries as SQ
+import argparse
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+# one posting while building: n-gram hash, bill and word position of its first occurrence in the bill
+RUN_DTYPE = np.dtype([('key', '<u8'), ('bill', '<i8'), ('pos', '<i4')])
+
+def bill_ngrams(text: str, n: int) -> tuple:
+    '''(hashes, positions) of the distinct word n-grams of a text, each at its first position'''
+    hashes = shingle_hashes(hash_tokens(tokenize(text)), n)
+    hashes, positions = np.unique(hashes, return_index=True)
+    return hashes, positions.astype(np.int32)
+
+class NgramIndex:
+    '''
+    Inverted index from rare word n-grams to the bills containing them, for finding short passages copied into long bills (a model section inserted into an omnibus bill) that MinHash similarity of whole bills misses.
+
+    build() hashes every n-gram of every bill (normalized text where it exists) and writes (hash, bill_id, position) postings to sorted runs on disk whenever run_size postings are in memory. The runs are then merged one hash bucket at a time, so memory holds one bucket and not the corpus. Only n-grams found in at most max_df bills are kept; anything more common is boilerplate. The result is stored as flat binary arrays (sorted keys, posting offsets, posting bill ids and positions) that are memory-mapped when the index is opened. A lookup is a binary search per n-gram of the query, so queries touch a few pages of the files.
+
+    The index is rebuilt in bulk; a build writes to a new directory and replaces the old index when it is complete.
+
+    class parameters:
+
+    db: MyDB instance for legislation.db (default: MyDB())
+    n: number of words per n-gram (default: int = 8)
+    max_df: n-grams found in more bills than this are not indexed (default: int = 5)
+    run_size: postings held in memory before a sorted run is written (default: int = 20000000)
+    buckets: number of hash ranges the runs are merged in (default: int = 256)
+    batch_size: number of bills read from the database at once (default: int = 256)
+    path: directory the index is saved in (default: data/ngram_index)
+    '''
+
+    FILES = {'keys': '<u8', 'offsets': '<i8', 'bills': '<i8', 'positions': '<i4'}
+
+    def __init__(self,
+                 db: MyDB = None,
+                 n: int = 8,
+                 max_df: int = 5,
+                 run_size: int = 20000000,
+                 buckets: int = 256,
+                 batch_size: int = 256,
+                 path: str = None,
+                ):
+        self.db = db if db is not None else MyDB()
+        self.n = n
+        self.max_df = max_df
+        self.run_size = run_size
+        self.buckets = buckets
+        self.batch_size = batch_size
+        self.path = path or os.path.join(self.db.path_data, 'ngram_index')
+        self.arrays = None
+        self.build_tables()
+
+    def build_tables(self):
+        '''The index reads normalized text, so tCleanText has to exist even if normalize.py never ran'''
+        self.db.connect()
+        self.db.curs.execute(SQ.SQL_CLEAN_TEXT_BUILD)
+        self.db.close()
+        return
+
+    def open(self):
+        '''Memory-map the index files; nothing is read until a query touches it'''
+        with open(os.path.join(self.path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['n'] != self.n:
+            raise ValueError('the index in {0} was built with n = {1}'.format(self.path, meta['n']))
+        self.arrays = {}
+        for name, dtype in self.FILES.items():
+            size = os.path.getsize(os.path.join(self.path, name + '.bin'))
+            # np.memmap cannot map an empty file
+            self.arrays[name] = np.memmap(os.path.join(self.path, name + '.bin'), dtype=dtype, mode='r') if size > 0 else np.zeros(0, dtype=dtype)
+        return self
+
+    def write_run(self, postings: list, run_dir: str, runs: list):
+        '''Sort the postings in memory by hash and write them as one run'''
+        run = np.concatenate(postings)
+        run = run[np.argsort(run['key'], kind='stable')]
+        path = os.path.join(run_dir, 'run{0:05d}.npy'.format(len(runs)))
+        np.save(path, run)
+        runs.append(path)
+        return
+
+    def build(self) -> int:
+        '''Build the index from every bill with text. Returns the number of n-grams indexed'''
+        self.db.connect()
+        bill_ids = [row[0] for row in self.db.curs.execute(SQ.SQL_SELECT_BILLS_WITH_CONTENT)]
+        self.db.close()
+
+        build_dir = self.path + '.build'
+        run_dir = os.path.join(build_dir, 'runs')
+        shutil.rmtree(build_dir, ignore_errors=True)
+        os.makedirs(run_dir)
+        runs = []
+        postings = []
+        held = 0
+        for i in range(0, len(bill_ids), self.batch_size):
+            chunk = bill_ids[i:i + self.batch_size]
+            self.db.connect()
+            rows = self.db.curs.execute(SQ.SQL_SELECT_CLEAN_CONTENT.format(', '.join('?' * len(chunk))), chunk).fetchall()
+            self.db.close()
+            for bill_id, content in rows:
+                hashes, positions = bill_ngrams(content, self.n)
+                block = np.empty(len(hashes), dtype=RUN_DTYPE)
+                block['key'], block['bill'], block['pos'] = hashes, bill_id, positions
+                postings.append(block)
+                held += len(block)
+            if held >= self.run_size:
+                self.write_run(postings, run_dir, runs)
+                postings, held = [], 0
+            print(min(i + self.batch_size, len(bill_ids)), 'of', len(bill_ids), 'bills hashed')
+        if held > 0:
+            self.write_run(postings, run_dir, runs)
+        print(len(runs), 'sorted runs written')
+        return self.merge(runs, build_dir)
+
+    def merge(self, runs: list, build_dir: str) -> int:
+        '''Merge the sorted runs one hash bucket at a time into the index files, dropping common n-grams, then swap the new index in'''
+        opened = [np.load(run, mmap_mode='r') for run in runs]
+        files = {name: open(os.path.join(build_dir, name + '.bin'), 'wb') for name in self.FILES}
+        bounds = [np.uint64(b * (2**64 // self.buckets)) for b in range(self.buckets)]
+        n_keys = n_postings = 0
+        files['offsets'].write(np.zeros(1, dtype='<i8').tobytes())
+        for b in range(self.buckets):
+            pieces = []
+            for run in opened:
+                lo = np.searchsorted(run['key'], bounds[b], side='left')
+                hi = len(run) if b == self.buckets - 1 else np.searchsorted(run['key'], bounds[b + 1], side='left')
+                if hi > lo:
+                    pieces.append(np.asarray(run[lo:hi]))
+            if len(pieces) == 0:
+                continue
+            bucket = np.concatenate(pieces)
+            # runs are in bill order, so a stable sort keeps the postings of a key in bill order
+            bucket = bucket[np.argsort(bucket['key'], kind='stable')]
+            keys, df = np.unique(bucket['key'], return_counts=True)
+            rare = df <= self.max_df
+            keep = np.repeat(rare, df)
+            files['keys'].write(keys[rare].astype('<u8').tobytes())
+            files['offsets'].write((n_postings + np.cumsum(df[rare])).astype('<i8').tobytes())
+            files['bills'].write(bucket['bill'][keep].astype('<i8').tobytes())
+            files['positions'].write(bucket['pos'][keep].astype('<i4').tobytes())
+            n_keys += int(rare.sum())
+            n_postings += int(keep.sum())
+        for f in files.values():
+            f.close()
+        del opened
+        shutil.rmtree(os.path.join(build_dir, 'runs'))
+        with open(os.path.join(build_dir, 'meta.json'), 'w') as f:
+            json.dump({'n': self.n, 'max_df': self.max_df, 'keys': n_keys, 'postings': n_postings}, f)
+
+        old = self.path + '.old'
+        shutil.rmtree(old, ignore_errors=True)
+        if os.path.exists(self.path):
+            os.rename(self.path, old)
+        os.rename(build_dir, self.path)
+        shutil.rmtree(old, ignore_errors=True)
+        self.arrays = None
+        print(n_keys, 'rare n-grams,', n_postings, 'postings')
+        return n_keys
+
+    def postings(self, hashes: np.ndarray) -> tuple:
+        '''(query index, bill_ids, positions) of every posting of the given n-gram hashes'''
+        if self.arrays is None:
+            self.open()
+        keys, offsets = self.arrays['keys'], self.arrays['offsets']
+        if len(keys) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32)
+        found = np.minimum(np.searchsorted(keys, hashes), len(keys) - 1)
+        hit = np.flatnonzero(keys[found] == hashes)
+        starts, ends = offsets[found[hit]], offsets[found[hit] + 1]
+        counts = ends - starts
+        rows = np.repeat(starts, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return np.repeat(hit, counts), np.asarray(self.arrays['bills'][rows]), np.asarray(self.arrays['positions'][rows])
+
+    def query_text(self, text: str, min_shared: int = 1, exclude: int = None) -> pd.DataFrame:
+        '''
+        Bills sharing rare n-grams with a text: bill_id, number of shared rare n-grams, and the word positions where the shared passage starts in the bill and in the text. Most shared first.
+        '''
+        hashes, positions = bill_ngrams(text, self.n)
+        query, bills, bill_positions = self.postings(hashes)
+        found = pd.DataFrame({'bill_id': bills, 'position': bill_positions, 'query_position': positions[query]})
+        if exclude is not None:
+            found = found.loc[found['bill_id'] != exclude]
+        found = found.groupby('bill_id').agg(shared=('position', 'size'), position=('position', 'min'), query_position=('query_position', 'min'))
+        return found.loc[found['shared'] >= min_shared].sort_values('shared', ascending=False).reset_index()
+
+    def query(self, bill_id: int, min_shared: int = 1) -> pd.DataFrame:
+        '''Other bills sharing rare n-grams with a bill in tBills'''
+        self.db.connect()
+        rows = self.db.curs.execute(SQ.SQL_SELECT_CLEAN_CONTENT.format('?'), (bill_id,)).fetchall()
+        self.db.close()
+        if len(rows) == 0:
+            raise KeyError('bill {0} has no text'.format(bill_id))
+        return self.query_text(rows[0][1], min_shared, exclude=bill_id)
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Build the rare n-gram index over all bill text')
+    args.add_argument('--n', type=int, default=8)
+    args.add_argument('--max-df', type=int, default=5)
+    args.add_argument('--run-size', type=int, default=20000000)
+    args = args.parse_args()
+    NgramIndex(n=args.n, max_df=args.max_df, run_size=args.run_size).build()
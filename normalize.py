@@ -0,0 +1,200 @@
+from create_database import MyDB
+import sql_queries as SQ
+import argparse
+import functools
+import os
+import re
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+def strip_line_numbers(match) -> str:
+    '''
+    Remove margin line numbers from a block of lines that start with a number. Only numbers that count up by one over at least three numbered lines in a row are line numbers; a quantity that starts a wrapped line ("30 days after notice") is kept.
+    '''
+    lines = match.group(0).split('\n')
+    numbered = []
+    for i, line in enumerate(lines):
+        number = re.match(r'[ \t]*(\d{1,3})(?=[ \t]|$)', line)
+        if number is not None:
+            numbered.append((i, int(number.group(1))))
+    run = []
+    for k, (i, number) in enumerate(numbered):
+        run.append(i)
+        if k + 1 == len(numbered) or numbered[k + 1][1] != number + 1:
+            if len(run) >= 3:
+                for j in run:
+                    lines[j] = re.sub(r'^[ \t]*\d{1,3}[ \t]*', '', lines[j])
+            run = []
+    return '\n'.join(lines)
+
+# Tika keeps the non-breaking and other fixed-width spaces of HTML and PDF text; the rules below only look for spaces and tabs
+SPACE_RULES = [
+    (r'[\xa0\u2000-\u200a\u202f\u3000]', ' '),
+]
+
+# boilerplate found in bills of every state: (pattern, replacement), applied in order
+COMMON_RULES = [
+    # line numbers in the margin: blocks of lines starting with a number (blank lines in between), checked by strip_line_numbers
+    (r'(?:^[ \t]*\d{1,3}(?:[ \t][^\n]*)?(?:\n|\Z)(?:[ \t]*\n)*)+', strip_line_numbers),
+    # words hyphenated across a line break
+    (r'(\w)-[ \t]*\n[ \t]*(\w)', r'\1\2'),
+    # page headers and footers
+    (r'^[ \t]*(?:Page[ \t]+\d+(?:[ \t]+of[ \t]+\d+)?|-[ \t]*\d+[ \t]*-)[ \t]*$', ''),
+    (r'^[ \t]*[_=\-*]{3,}[ \t]*$', ''),
+    # enacting clauses
+    (r'BE IT ENACTED BY THE [A-Z ,]*?(?:LEGISLATURE|GENERAL ASSEMBLY|GENERAL COURT|SENATE AND HOUSE OF REPRESENTATIVES|PEOPLE)(?:[A-Z ,]*?OF[ \t\n]+[A-Z ]+?)?[ \t]*[:.,]', ''),
+    (r'THE PEOPLE OF THE STATE OF [A-Z ]+? (?:DO )?ENACT AS FOLLOWS[ \t]*:', ''),
+]
+
+# formatting notes, draft numbers and page headers particular to one state (or 'US' for Congress)
+STATE_RULES = {
+    'CO': [
+        (r'^[ \t]*Capital letters or bold & italic numbers indicate new material.*$', ''),
+        (r'^[ \t]*Dashes through the words or numbers indicate deletions.*$', ''),
+        (r'^[ \t]*(?:HOUSE|SENATE) BILL \d+-\d+[ \t]*$', ''),
+    ],
+    'TX': [
+        (r'^[ \t]*\d{2}[RS]\d+[ \t]+[A-Z]{2,4}-[A-Z][ \t]*$', ''),
+        (r'^[ \t]*[HS]\.[BJCR]\.[ \t]+No\.[ \t]+\d+[ \t]*$', ''),
+    ],
+    'NY': [
+        (r'^[ \t]*EXPLANATION--Matter in italics \(underscored\) is new; matter in brackets.*$', ''),
+        (r'^[ \t]*\[ ?\] is old law to be omitted\.?[ \t]*$', ''),
+        (r'^[ \t]*LBD\d+-\d+-\d+[ \t]*$', ''),
+    ],
+    'FL': [
+        (r'^[ \t]*CODING: Words stricken are deletions; words underlined are additions\.?[ \t]*$', ''),
+        (r'^[ \t]*Florida (?:Senate|House of Representatives) - \d{4}.*$', ''),
+    ],
+    'CA': [
+        (r'^[ \t]*Vote: (?:majority|2/3)[ \t]+Appropriation:.*$', ''),
+    ],
+    'WI': [
+        (r'^[ \t]*\d{4} - \d{4} LEGISLATURE[ \t]*$', ''),
+        (r'^[ \t]*LRB-\d+/\d+[ \t]*$', ''),
+    ],
+    'US': [
+        (r'^[ \t]*VerDate .*$', ''),
+        (r'^[ \t]*Jkt \d+ .*$', ''),
+        (r'^[ \t]*•?[HS]\.? ?R?\.? ?\d+ [IER][HSNC][ \t]*$', ''),
+    ],
+}
+
+# runs of spaces and blank lines left behind by the rules above
+WHITESPACE_RULES = [
+    (r'[ \t]+', ' '),
+    (r' ?\n ?', '\n'),
+    (r'\n{3,}', '\n\n'),
+]
+
+@functools.lru_cache(maxsize=None)
+def rules_for(state: str = None) -> list:
+    '''Compiled rules for a state: spaces, its own rules, the common rules, then whitespace clean up. Compiled once per process'''
+    rules = SPACE_RULES + STATE_RULES.get(state, []) + COMMON_RULES + WHITESPACE_RULES
+    return [(re.compile(pattern, re.MULTILINE | re.IGNORECASE), replacement) for pattern, replacement in rules]
+
+def normalize_text(text: str, state: str = None) -> str:
+    '''Strip line numbers, headers/footers, enacting clauses and the state's formatting notes from bill text'''
+    for pattern, replacement in rules_for(state):
+        text = pattern.sub(replacement, text)
+    return text.strip()
+
+def _normalize_batch(rows):
+    '''Normalize a batch of (bill_id, state, content), run in a worker process'''
+    return [(bill_id, normalize_text(content, state)) for bill_id, state, content in rows]
+
+class Normalizer:
+    '''
+    Batch stage that removes legislative boilerplate from the Tika output in tBills.content and stores the normalized text in tCleanText next to it. Line numbering, page headers and footers and enacting clauses are stripped for every bill; STATE_RULES adds formatting notes and draft numbers of single states. Rule sets are compiled once per state in each process.
+
+    Keywords, topics, the MinHash index, tf-idf similarity and model legislation matching read the normalized text when it exists (SQL_SELECT_CLEAN_CONTENT). NER and passage alignment keep reading tBills.content, since their character offsets point into the raw text. Bill.save drops a bill's normalized text when the raw text changes, and writing normalized text queues the bill for the steps that read it again.
+
+    class parameters:
+
+    db: MyDB instance for legislation.db (default: MyDB())
+    batch_size: number of bills per worker task (default: int = 256)
+    max_workers: number of processes, None uses every core (default: None)
+    '''
+
+    def __init__(self,
+                 db: MyDB = None,
+                 batch_size: int = 256,
+                 max_workers: int = None,
+                ):
+        self.db = db if db is not None else MyDB()
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.build_tables()
+
+    def build_tables(self):
+        '''Create tCleanText if it does not exist'''
+        self.db.connect()
+        self.db.curs.execute(SQ.SQL_CLEAN_TEXT_BUILD)
+        self.db.close()
+        return
+
+    def pending_bills(self, limit: int = None) -> list:
+        '''bill_ids with text that has not been normalized since it last changed'''
+        self.db.connect()
+        sql = SQ.SQL_PENDING_CLEAN_TEXT_BILLS + ('' if limit is None else ' LIMIT ' + str(int(limit)))
+        bill_ids = [row[0] for row in self.db.curs.execute(sql)]
+        self.db.close()
+        return bill_ids
+
+    def write(self, rows: list):
+        '''Store normalized text and queue the bills for the steps that read it, in one transaction'''
+        self.db.connect()
+        self.db.curs.execute('BEGIN;')
+        try:
+            self.db.curs.executemany(SQ.SQL_UPSERT_CLEAN_TEXT, rows)
+            for sql in SQ.SQL_INVALIDATE_ON_CLEAN_TEXT:
+                try:
+                    self.db.curs.executemany(sql, [(bill_id,) for bill_id, content in rows])
+                except sqlite3.OperationalError: # the table has not been created yet
+                    pass
+            self.db.curs.execute('COMMIT;')
+        except Exception:
+            self.db.curs.execute('ROLLBACK;')
+            raise
+        finally:
+            self.db.close()
+        return
+
+    def run(self, limit: int = None) -> int:
+        '''Normalize every pending bill. Returns the number of bills normalized'''
+        pending = self.pending_bills(limit)
+        print(len(pending), 'bills to normalize')
+        workers = self.max_workers or os.cpu_count() or 1
+        window = self.batch_size * workers
+        raw_chars = clean_chars = 0
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for i in range(0, len(pending), window):
+                chunk = pending[i:i + window]
+                self.db.connect()
+                rows = self.db.curs.execute(SQ.SQL_SELECT_CONTENT_WITH_STATE.format(', '.join('?' * len(chunk))), chunk).fetchall()
+                self.db.close()
+                batches = [rows[j:j + self.batch_size] for j in range(0, len(rows), self.batch_size)]
+                cleaned = [row for batch in pool.map(_normalize_batch, batches) for row in batch]
+                self.write(cleaned)
+                raw_chars += sum(len(content) for bill_id, state, content in rows)
+                clean_chars += sum(len(content) for bill_id, content in cleaned)
+                print(min(i + window, len(pending)), 'of', len(pending), 'bills normalized')
+        if raw_chars > 0:
+            print('normalized text is {0:.0%} of the raw text'.format(clean_chars / raw_chars))
+        return len(pending)
+
+    def rebuild(self) -> int:
+        '''Normalize every bill again, after the rules changed. Each bill is queued for the steps that read its normalized text when it is written'''
+        self.db.connect()
+        self.db.curs.execute('DELETE FROM tCleanText;')
+        self.db.close()
+        return self.run()
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Strip boilerplate from new bill text and store the normalized text')
+    args.add_argument('--max-workers', type=int, default=None)
+    args.add_argument('--limit', type=int, default=None)
+    args.add_argument('--rebuild', action='store_true', help='normalize every bill again, after the rules changed')
+    args = args.parse_args()
+    normalizer = Normalizer(max_workers=args.max_workers)
+    normalizer.rebuild() if args.rebuild else normalizer.run(args.limit)
@@ -0,0 +1,98 @@
+import sql_queries as SQ
+
+class Rollups:
+    '''
+    Materialized entity and keyword counts per state, session and bill status, so summaries over thousands of bills are a lookup in a small table instead of a scan over tEntities/tKeywords.
+
+    The tables are maintained incrementally by the writers: batch_ner.BatchNER and keywords.KeywordEngine call remove() for a batch of bills before replacing their rows and add() afterwards, inside the same transaction. tRollupMembers remembers which (state, session, status) group a bill was counted under, so its counts are always subtracted from the group they were added to; move_changed() moves the counts of bills whose status (or session) changed since.
+
+    class parameters:
+
+    db: MyDB instance for legislation.db
+    '''
+
+    # kind -> statement applying +/- the counts of a list of bills, and the rollup table
+    KINDS = {
+        'entity': (SQ.SQL_ROLLUP_ENTITIES_DELTA, 'tEntityRollup'),
+        'keyword': (SQ.SQL_ROLLUP_KEYWORDS_DELTA, 'tKeywordRollup'),
+    }
+
+    def __init__(self, db):
+        self.db = db
+        self.build_tables()
+
+    def build_tables(self):
+        '''Create the rollup tables and their indexes if they do not exist'''
+        self.db.connect()
+        for sql in SQ.SQL_ROLLUPS_BUILD:
+            self.db.curs.execute(sql)
+        self.db.close()
+        return
+
+    @staticmethod
+    def id_list(bill_ids) -> str:
+        return ', '.join(str(int(bill_id)) for bill_id in bill_ids)
+
+    def remove(self, curs, kind: str, bill_ids: list):
+        '''Subtract the current rows of these bills from the rollup of kind. Call before the rows are deleted'''
+        delta, table = self.KINDS[kind]
+        ids = self.id_list(bill_ids)
+        if ids == '':
+            return
+        curs.execute(delta.format(ids), (kind, -1))
+        curs.execute(SQ.SQL_ROLLUP_MEMBERS_REMOVE.format(ids), (kind,))
+        curs.execute(SQ.SQL_ROLLUP_CLEANUP.format(table))
+        return
+
+    def add(self, curs, kind: str, bill_ids: list):
+        '''Add the current rows of these bills to the rollup of kind, under the bills' current state, session and status'''
+        delta, table = self.KINDS[kind]
+        ids = self.id_list(bill_ids)
+        if ids == '':
+            return
+        curs.execute(SQ.SQL_ROLLUP_MEMBERS_ADD.format(ids), (kind,))
+        curs.execute(delta.format(ids), (kind, 1))
+        return
+
+    def rebuild(self, curs, kind: str):
+        '''Recount a rollup from scratch, for writers that replace every row at once'''
+        delta, table = self.KINDS[kind]
+        source = {'entity': 'tEntities', 'keyword': 'tKeywords'}[kind]
+        curs.execute('DELETE FROM ' + table + ';')
+        curs.execute('DELETE FROM tRollupMembers WHERE kind = (?);', (kind,))
+        bill_ids = [row[0] for row in curs.execute('SELECT DISTINCT bill_id FROM ' + source + ';').fetchall()]
+        self.add(curs, kind, bill_ids)
+        return
+
+    def move_changed(self, kind: str = None) -> int:
+        '''Move the counts of bills whose state, session or status changed since they were counted. Returns the number of bills moved'''
+        moved = 0
+        self.db.connect()
+        try:
+            for kind in ([kind] if kind is not None else list(self.KINDS)):
+                bill_ids = [row[0] for row in self.db.curs.execute(SQ.SQL_ROLLUP_MOVED, (kind,)).fetchall()]
+                if len(bill_ids) == 0:
+                    continue
+                self.db.curs.execute('BEGIN;')
+                self.remove(self.db.curs, kind, bill_ids)
+                self.add(self.db.curs, kind, bill_ids)
+                self.db.curs.execute('COMMIT;')
+                moved += len(bill_ids)
+        except Exception:
+            if self.db.conn.in_transaction:
+                self.db.curs.execute('ROLLBACK;')
+            raise
+        finally:
+            self.db.close()
+        return moved
+
+if __name__ == '__main__':
+    # recount both rollups from tEntities and tKeywords, e.g. for rows written before the rollup tables existed
+    from create_database import MyDB
+    rollups = Rollups(MyDB())
+    rollups.db.connect()
+    rollups.db.curs.execute('BEGIN;')
+    for kind in rollups.KINDS:
+        rollups.rebuild(rollups.db.curs, kind)
+    rollups.db.curs.execute('COMMIT;')
+    rollups.db.close()
@@ -0,0 +1,368 @@
+from create_database import MyDB
+from shingles import shingle_set
+from array_store import ArrayStore
+import model_bills
+import sql_queries as SQ
+import argparse
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+def state_shingles(db: MyDB, state: str, shingle_size: int, cache_dir: str) -> tuple:
+    '''
+    (bill_ids, offsets, keys) with the shingle sets of every bill of a state with text, keys[offsets[k]:offsets[k + 1]] belonging to bill_ids[k]. Stored in cache_dir as an ArrayStore, so a state is only shingled once per job run even though it appears in many shards, and the arrays are memory-mapped views every worker shares.
+    '''
+    path = os.path.join(cache_dir, state)
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        rows = db.run_query(SQ.SQL_SELECT_STATE_CLEAN_CONTENT, (state,))
+        # several processes may shingle the same state at once; each writes its own store and the first one finished is kept
+        tmp = path + '.' + socket.gethostname() + '.' + str(os.getpid()) + '.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        store = ArrayStore(tmp, np.uint64)
+        os.makedirs(tmp)
+        store.write_meta()
+        store.append(rows['bill_id'].to_numpy(dtype=np.int64), [shingle_set(content, shingle_size) for content in rows['content']])
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+    store = ArrayStore(path).open()
+    return store.ids, store.offsets, store.data
+
+class StatePairJob:
+    '''
+    Bill x bill comparison sharded by pair of states: a shard compares every bill of one state with every bill of another (or of the same) state by exact Jaccard similarity of their shingle sets, using an inverted index of the second state's shingles. Merging a shard replaces every pair between the bills of its two states in tJaccardPairs with the pairs at or above threshold. The exact scores are kept apart from the MinHash estimates in tNearDuplicates.
+
+    class parameters:
+
+    shingle_size: number of words per shingle (default: int = 5)
+    threshold: minimum Jaccard similarity of a stored pair (default: float = 0.5)
+    states: only compare bills of these states (default: None, every state)
+    '''
+    name = 'state_pairs'
+
+    def __init__(self, shingle_size: int = 5, threshold: float = 0.5, states: list = None):
+        self.shingle_size = shingle_size
+        self.threshold = threshold
+        self.states = states
+
+    def build_tables(self, db: MyDB):
+        db.connect()
+        for sql in SQ.SQL_MINHASH_BUILD + SQ.SQL_JACCARD_PAIRS_BUILD:
+            db.curs.execute(sql)
+        db.close()
+        return
+
+    def shards(self, db: MyDB) -> list:
+        '''[(shard, work)] for every pair of states, work being the number of bill comparisons'''
+        counts = db.run_query(SQ.SQL_COUNT_BILLS_WITH_CONTENT_BY_STATE)
+        counts = dict(zip(counts['state'], counts['n']))
+        states = sorted(state for state in counts if self.states is None or state in self.states)
+        return [(first + '-' + second, counts[first] * counts[second])
+                for k, first in enumerate(states) for second in states[k:]]
+
+    def run_shard(self, db: MyDB, shard: str, cache_dir: str) -> dict:
+        first, second = shard.split('-')
+        ids_a, offsets_a, keys_a = state_shingles(db, first, self.shingle_size, cache_dir)
+        ids_b, offsets_b, keys_b = state_shingles(db, second, self.shingle_size, cache_dir)
+        sizes_b = np.diff(offsets_b)
+        owners_b = np.repeat(np.arange(len(ids_b)), sizes_b)
+        order = np.argsort(keys_b, kind='stable')
+        keys_b, owners_b = keys_b[order], owners_b[order]
+
+        found = {'bill_id': [], 'other_id': [], 'score': []}
+        for k, bill_id in enumerate(ids_a):
+            shingles = keys_a[offsets_a[k]:offsets_a[k + 1]]
+            lo = np.searchsorted(keys_b, shingles, side='left')
+            hi = np.searchsorted(keys_b, shingles, side='right')
+            counts = hi - lo
+            if counts.sum() == 0:
+                continue
+            positions = np.repeat(lo, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            shared = np.bincount(owners_b[positions], minlength=len(ids_b))
+            score = shared / np.maximum(len(shingles) + sizes_b - shared, 1)
+            keep = np.flatnonzero((score >= self.threshold) & (ids_b != bill_id) & ((first != second) | (ids_b > bill_id)))
+            found['bill_id'].append(np.full(len(keep), bill_id))
+            found['other_id'].append(ids_b[keep])
+            found['score'].append(score[keep])
+        output = {key: np.concatenate(value) if len(value) > 0 else np.zeros(0) for key, value in found.items()}
+        output['shard'] = np.array(shard)
+        return output
+
+    def merge(self, db: MyDB, output: dict):
+        # pairs that no longer reach the threshold, or of bills that lost their text, are dropped with the shard's old pairs
+        first, second = str(output['shard']).split('-')
+        db.curs.execute(SQ.SQL_DELETE_JACCARD_PAIRS_OF_STATES, (first, second))
+        if first != second:
+            db.curs.execute(SQ.SQL_DELETE_JACCARD_PAIRS_OF_STATES, (second, first))
+        pairs = list(zip(output['bill_id'].astype(np.int64).tolist(), output['other_id'].astype(np.int64).tolist(), output['score'].tolist()))
+        db.curs.executemany(SQ.SQL_INSERT_JACCARD_PAIR, pairs + [(other_id, bill_id, score) for bill_id, other_id, score in pairs])
+        return len(pairs)
+
+class ModelMatchJob:
+    '''
+    Bill x model legislation comparison sharded by state, scored like model_bills.ModelBills.match. Merging replaces the model matches of the shard's bills in tModelMatches.
+
+    class parameters: the parameters of model_bills.ModelBills, passed through as keywords
+    '''
+    name = 'model_matches'
+
+    def __init__(self, **options):
+        self.options = options
+
+    def build_tables(self, db: MyDB):
+        model_bills.ModelBills(db, **self.options)
+        return
+
+    def shards(self, db: MyDB) -> list:
+        counts = db.run_query(SQ.SQL_COUNT_BILLS_WITH_CONTENT_BY_STATE)
+        return list(zip(counts['state'], counts['n']))
+
+    def run_shard(self, db: MyDB, shard: str, cache_dir: str) -> dict:
+        matcher = model_bills.ModelBills(db, **self.options)
+        version = matcher.corpus_version()
+        # the model index is built once per process and reused for the following shards
+        if model_bills._index.get('version') != version:
+            model_ids, keys, owners, sizes = matcher.model_index()
+            model_bills._init_worker(keys, owners, sizes, matcher.shingle_size)
+            model_bills._index.update(version=version, model_ids=model_ids)
+        rows = db.run_query(SQ.SQL_SELECT_STATE_CLEAN_CONTENT, (shard,))
+        matches = model_bills._match_batch(list(rows.itertuples(index=False, name=None)))
+        ranked = matcher.ranked(matches, model_bills._index['model_ids'])
+        return {'bill_ids': rows['bill_id'].to_numpy(dtype=np.int64), 'matches': np.array(ranked, dtype=float).reshape(-1, 6),
+                'version': np.array(version)}
+
+    def merge(self, db: MyDB, output: dict):
+        bill_ids = output['bill_ids'].tolist()
+        rows = [(int(b), int(m), int(shared), containment, jaccard, int(rank)) for b, m, shared, containment, jaccard, rank in output['matches']]
+        for i in range(0, len(bill_ids), 500):
+            db.curs.execute('DELETE FROM tModelMatches WHERE bill_id IN (' + ', '.join(str(int(b)) for b in bill_ids[i:i + 500]) + ');')
+        db.curs.executemany(SQ.SQL_INSERT_MODEL_MATCH, rows)
+        db.curs.executemany(SQ.SQL_UPSERT_MODEL_MATCH_RUN, [(bill_id, str(output['version'])) for bill_id in bill_ids])
+        return len(rows)
+
+JOBS = {'state_pairs': StatePairJob, 'model_matches': ModelMatchJob}
+
+def _run_shard(args):
+    '''Claim, run and checkpoint one shard in a worker process. Returns the shard, or None if another worker has it'''
+    runner, shard = args
+    if not runner.claim(shard):
+        return None
+    # touch the lock while the shard runs, so a shard that takes longer than lock_timeout is not taken over
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=runner.heartbeat, args=(shard, stop), daemon=True)
+    heartbeat.start()
+    try:
+        db = runner.open_db()
+        output = runner.job.run_shard(db, shard, runner.cache_dir)
+        tmp = runner.shard_path(shard, '.npz.' + runner.owner() + '.tmp')
+        with open(tmp, 'wb') as f:
+            np.savez(f, **output)
+        os.replace(tmp, runner.shard_path(shard, '.npz'))
+        # the .done marker is written last: a shard without it is run again
+        with open(runner.shard_path(shard, '.done'), 'w') as f:
+            f.write(socket.gethostname())
+    finally:
+        stop.set()
+        heartbeat.join()
+        runner.release(shard)
+    return shard
+
+class ShardRunner:
+    '''
+    Runs a comparison job split into independent shards, on a local process pool or on several machines sharing a filesystem. Every machine runs the same command on the same work_dir; a shard is claimed by creating its lock file with O_CREAT | O_EXCL, which only one process can do, and finished shards get a .done marker next to their output. The lock holds the host:pid of its worker, which touches it every lock_timeout / 10 seconds while the shard runs and only removes it while it still holds it. Interrupted runs resume with the shards that have no marker, and locks that were not touched for lock_timeout (from a crashed worker) are taken over. Since shards share nothing, wall time drops with the number of workers until there are fewer shards left than workers; shards are started largest first.
+
+    merge() writes the output of finished shards to the results table, each shard in its own transaction, and marks them .merged so merging can be repeated while shards are still running.
+
+    class parameters:
+
+    job: a job with name, build_tables(db), shards(db), run_shard(db, shard, cache_dir) and merge(db, output), e.g. StatePairJob() or ModelMatchJob()
+    run: name of the run; a new name starts the job over (default: str = 'default')
+    db: MyDB instance for legislation.db (default: MyDB())
+    max_workers: number of processes on this machine, None uses every core (default: None)
+    lock_timeout: seconds after which the lock of an unfinished shard is considered abandoned (default: int = 6 * 3600)
+    path: directory on the shared filesystem for locks, markers and shard output (default: data/shards)
+    '''
+
+    def __init__(self,
+                 job,
+                 run: str = 'default',
+                 db: MyDB = None,
+                 max_workers: int = None,
+                 lock_timeout: int = 6 * 3600,
+                 path: str = None,
+                ):
+        self.job = job
+        self.db = db if db is not None else MyDB()
+        self.max_workers = max_workers
+        self.lock_timeout = lock_timeout
+        self.work_dir = os.path.join(path or os.path.join(self.db.path_data, 'shards'), job.name, run)
+        self.cache_dir = os.path.join(self.work_dir, 'cache')
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.job.build_tables(self.db)
+
+    def __getstate__(self):
+        # workers open their own database connection, to the same database
+        state = dict(self.__dict__)
+        state['db'] = None
+        state['db_paths'] = (self.db.path_data, self.db.path_db)
+        return state
+
+    def open_db(self) -> MyDB:
+        '''The runner's MyDB, or in a worker process a new MyDB for the same database'''
+        if self.db is not None:
+            return self.db
+        db = MyDB()
+        db.path_data, db.path_db = self.db_paths
+        return db
+
+    def shard_path(self, shard: str, suffix: str) -> str:
+        return os.path.join(self.work_dir, shard + suffix)
+
+    def plan(self) -> list:
+        '''The shards of the run, largest first. Listed once and saved, so every machine works on the same shards'''
+        path = os.path.join(self.work_dir, 'shards.json')
+        if not os.path.exists(path):
+            shards = sorted(self.job.shards(self.db), key=lambda shard: -shard[1])
+            tmp = path + '.' + socket.gethostname() + '.' + str(os.getpid()) + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump([shard for shard, work in shards], f)
+            # the first machine to finish planning wins, the others read its list
+            try:
+                os.link(tmp, path)
+            except FileExistsError:
+                pass
+            os.remove(tmp)
+        with open(path) as f:
+            return json.load(f)
+
+    @staticmethod
+    def owner() -> str:
+        '''host:pid of this worker, written into the locks it holds'''
+        return '{0}:{1}'.format(socket.gethostname(), os.getpid())
+
+    def holds(self, shard: str) -> bool:
+        '''Whether this worker holds the shard's lock'''
+        try:
+            with open(self.shard_path(shard, '.lock')) as f:
+                return f.read() == self.owner()
+        except FileNotFoundError:
+            return False
+
+    def heartbeat(self, shard: str, stop: threading.Event):
+        '''Touch the shard's lock every lock_timeout / 10 seconds until stop is set, or until the lock was taken over'''
+        while not stop.wait(max(1, self.lock_timeout / 10)):
+            if not self.holds(shard):
+                return
+            try:
+                os.utime(self.shard_path(shard, '.lock'))
+            except FileNotFoundError:
+                return
+        return
+
+    def release(self, shard: str):
+        '''Remove the shard's lock, unless another worker took it over'''
+        if self.holds(shard):
+            try:
+                os.remove(self.shard_path(shard, '.lock'))
+            except FileNotFoundError:
+                pass
+        return
+
+    def claim(self, shard: str) -> bool:
+        '''Create the shard's lock file, unless the shard is done or another live worker holds it'''
+        if os.path.exists(self.shard_path(shard, '.done')):
+            return False
+        lock = self.shard_path(shard, '.lock')
+        for attempt in range(2):
+            try:
+                fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                try:
+                    abandoned = time.time() - os.path.getmtime(lock) > self.lock_timeout
+                    if abandoned:
+                        os.remove(lock)
+                        continue
+                except FileNotFoundError: # released in the meantime
+                    continue
+                return False
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.owner())
+            # a shard finished between the check above and the lock
+            if os.path.exists(self.shard_path(shard, '.done')):
+                self.release(shard)
+                return False
+            return True
+        return False
+
+    def status(self) -> dict:
+        shards = self.plan()
+        done = sum(os.path.exists(self.shard_path(shard, '.done')) for shard in shards)
+        running = sum(os.path.exists(self.shard_path(shard, '.lock')) for shard in shards)
+        merged = sum(os.path.exists(self.shard_path(shard, '.merged')) for shard in shards)
+        return {'shards': len(shards), 'done': done, 'running': running, 'pending': len(shards) - done - running, 'merged': merged}
+
+    def run(self) -> int:
+        '''Run every shard that is not done or claimed, on max_workers processes. Returns the number of shards this machine ran'''
+        shards = [shard for shard in self.plan() if not os.path.exists(self.shard_path(shard, '.done'))]
+        print(len(shards), 'shards to run')
+        ran = 0
+        with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+            for shard in pool.map(_run_shard, [(self, shard) for shard in shards]):
+                if shard is not None:
+                    ran += 1
+                    print(shard, 'done,', ran, 'shards run here')
+        return ran
+
+    def merge(self) -> int:
+        '''Write the output of every finished shard that was not merged yet to the results table. Returns the number of rows written'''
+        written = 0
+        for shard in self.plan():
+            if not os.path.exists(self.shard_path(shard, '.done')) or os.path.exists(self.shard_path(shard, '.merged')):
+                continue
+            with np.load(self.shard_path(shard, '.npz')) as output:
+                output = dict(output)
+            self.db.connect()
+            self.db.curs.execute('BEGIN;')
+            try:
+                written += self.job.merge(self.db, output)
+                self.db.curs.execute('COMMIT;')
+            except Exception:
+                self.db.curs.execute('ROLLBACK;')
+                raise
+            finally:
+                self.db.close()
+            open(self.shard_path(shard, '.merged'), 'w').close()
+        print(written, 'rows merged')
+        return written
+
+    def reset(self):
+        '''Delete the run's locks, markers and output'''
+        shutil.rmtree(self.work_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        return
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Run a sharded comparison job on this machine; start the same command on every machine sharing the data directory')
+    args.add_argument('command', choices=['run', 'status', 'merge', 'reset'])
+    args.add_argument('--job', default='state_pairs', choices=list(JOBS))
+    args.add_argument('--run', default='default', help='name of the run; a new name starts over')
+    args.add_argument('--max-workers', type=int, default=None)
+    args.add_argument('--path', default=None, help='shared directory for shard locks and output (default: data/shards)')
+    args.add_argument('--threshold', type=float, default=0.5, help='minimum Jaccard similarity for state_pairs')
+    args = args.parse_args()
+    job = StatePairJob(threshold=args.threshold) if args.job == 'state_pairs' else ModelMatchJob()
+    runner = ShardRunner(job, run=args.run, max_workers=args.max_workers, path=args.path)
+    if args.command == 'run':
+        runner.run()
+    elif args.command == 'status':
+        print(runner.status())
+    elif args.command == 'merge':
+        runner.merge()
+    else:
+        runner.reset()
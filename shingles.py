@@ -0,0 +1,46 @@
+'''
+Text normalization and hashing shared by the similarity modules (minhash.py, model_bills.py, alignment.py and the others). Bill text is lowercased and split into word tokens, every token is hashed to a stable 64-bit integer, and word n-grams ("shingles") are hashed from the token hashes with vectorized NumPy arithmetic.
+'''
+import re
+import hashlib
+import numpy as np
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+# multiplier for combining token hashes into n-gram hashes (arithmetic wraps modulo 2**64)
+SHINGLE_PRIME = np.uint64(1099511628211)
+
+def tokenize(text: str) -> list:
+    '''Lowercased word tokens of a text'''
+    return TOKEN_RE.findall(text.lower())
+
+def tokenize_with_offsets(text: str) -> tuple:
+    '''Lowercased word tokens with the character offsets of each token in the original text'''
+    tokens = []
+    starts = []
+    ends = []
+    for match in TOKEN_RE.finditer(text.lower()):
+        tokens.append(match.group())
+        starts.append(match.start())
+        ends.append(match.end())
+    return tokens, np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64)
+
+def hash_tokens(tokens: list) -> np.ndarray:
+    '''Stable 64-bit hash of every token (Python's hash() is salted per process, so it cannot be stored)'''
+    return np.fromiter((int.from_bytes(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest(), 'little') for token in tokens),
+                       dtype=np.uint64, count=len(tokens))
+
+def shingle_hashes(token_hashes: np.ndarray, k: int = 5) -> np.ndarray:
+    '''Hash of every run of k consecutive tokens, in text order (len(tokens) - k + 1 values)'''
+    n = len(token_hashes) - k + 1
+    if n <= 0:
+        return np.zeros(0, dtype=np.uint64)
+    shingles = token_hashes[:n].copy()
+    with np.errstate(over='ignore'):
+        for j in range(1, k):
+            shingles = shingles * SHINGLE_PRIME + token_hashes[j:j + n]
+    return shingles
+
+def shingle_set(text: str, k: int = 5) -> np.ndarray:
+    '''Sorted unique shingle hashes of a text'''
+    return np.unique(shingle_hashes(hash_tokens(tokenize(text)), k))
@@ -0,0 +1,215 @@
+from create_database import MyDB
+import sql_queries as SQ
+import argparse
+import os
+import numpy as np
+import scipy.sparse as sp
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.preprocessing import normalize
+
+# the tf-idf matrix, opened (memory-mapped) once in every worker process by _init_worker
+_matrix = {}
+
+# files of a matrix written by SimilarBills.write_matrix, with their element types
+MATRIX_FILES = (('data', np.float32), ('indices', np.int32), ('indptr', np.int64))
+
+def load_matrix(path: str) -> sp.csr_matrix:
+    '''Open a matrix written by SimilarBills.write_matrix without reading it into memory'''
+    data, indices, indptr = (np.memmap(os.path.join(path, name + '.bin'), dtype=dtype, mode='r') if os.path.getsize(os.path.join(path, name + '.bin')) > 0
+                             else np.zeros(0, dtype=dtype) for name, dtype in MATRIX_FILES)
+    return sp.csr_matrix((data, indices, indptr), shape=(len(indptr) - 1, int(np.load(os.path.join(path, 'shape.npy'))[1])), copy=False)
+
+def _init_worker(path):
+    _matrix['X'] = load_matrix(path)
+
+def _top_k_block(args):
+    '''
+    Top k cosine similarities of the rows [start, stop) against every row, one column block at a time. Only a rows x columns block of scores exists at once; the best k of each row so far are merged with each new block with argpartition.
+    '''
+    start, stop, columns, k, min_score = args
+    X = _matrix['X']
+    n = X.shape[0]
+    rows = X[start:stop]
+    best_scores = np.full((stop - start, k), -1.0, dtype=np.float32)
+    best_ids = np.full((stop - start, k), -1, dtype=np.int64)
+    for col in range(0, n, columns):
+        scores = (rows @ X[col:col + columns].T).toarray().astype(np.float32)
+        # a bill is not similar to itself
+        own = np.arange(start, stop)
+        inside = (own >= col) & (own < col + columns)
+        scores[np.flatnonzero(inside), own[inside] - col] = -1.0
+        merged_scores = np.concatenate([best_scores, scores], axis=1)
+        merged_ids = np.concatenate([best_ids, np.broadcast_to(np.arange(col, col + scores.shape[1]), scores.shape)], axis=1)
+        if merged_scores.shape[1] > k:
+            keep = np.argpartition(-merged_scores, k - 1, axis=1)[:, :k]
+            merged_scores = np.take_along_axis(merged_scores, keep, axis=1)
+            merged_ids = np.take_along_axis(merged_ids, keep, axis=1)
+        best_scores, best_ids = merged_scores, merged_ids
+    order = np.argsort(-best_scores, axis=1, kind='stable')
+    best_scores = np.take_along_axis(best_scores, order, axis=1)
+    best_ids = np.take_along_axis(best_ids, order, axis=1)
+    row, rank = np.nonzero(best_scores >= min_score)
+    return start + row, best_ids[row, rank], best_scores[row, rank], rank + 1
+
+class SimilarBills:
+    '''
+    All-pairs "related bills" job: the top_k most similar bills of every bill in tBills by cosine similarity of tf-idf vectors of their text, stored in tSimilar(bill_id, other_id, score, rank).
+
+    The n x n similarity matrix is never built. Rows are split into blocks that are spread over a process pool, and each block is multiplied against the matrix one column block at a time; after every column block only the best top_k scores of each row are kept (argpartition). Block sizes follow from memory_mb, so peak memory of the products does not grow with the number of bills. The sparse tf-idf matrix is saved under path and memory-mapped by the workers instead of copied into each of them.
+
+    The matrix itself is never in memory either. Words are hashed into n_features columns (HashingVectorizer), so there is no vocabulary to fit: a first pass over the texts, batch_size bills at a time, counts document frequencies, and a second pass weights each batch by tf-idf and appends it to the files under path. Words of a single bill or of more than half of the bills are dropped once there are enough bills for those bounds to leave any words. The pairs of each row block are written in their own transaction, so readers of tSimilar are never blocked for the whole job.
+
+    class parameters:
+
+    db: MyDB instance for legislation.db (default: MyDB())
+    top_k: number of similar bills stored per bill (default: int = 10)
+    min_score: smallest cosine similarity stored (default: float = 0.2)
+    memory_mb: memory budget for the score blocks of all workers together, in MB (default: int = 512)
+    n_features: number of hashed tf-idf columns (default: int = 2**20)
+    batch_size: number of bills read from the database at once (default: int = 256)
+    max_workers: number of processes, None uses every core (default: None)
+    path: directory the tf-idf matrix is saved in (default: data/similar)
+    '''
+
+    def __init__(self,
+                 db: MyDB = None,
+                 top_k: int = 10,
+                 min_score: float = 0.2,
+                 memory_mb: int = 512,
+                 n_features: int = 2**20,
+                 batch_size: int = 256,
+                 max_workers: int = None,
+                 path: str = None,
+                ):
+        self.db = db if db is not None else MyDB()
+        self.top_k = top_k
+        self.min_score = min_score
+        self.memory_mb = memory_mb
+        self.n_features = n_features
+        self.vectorizer = HashingVectorizer(n_features=n_features, stop_words='english', alternate_sign=False, norm=None, dtype=np.float32)
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.path = path or os.path.join(self.db.path_data, 'similar')
+        self.build_tables()
+
+    def build_tables(self):
+        '''Create tSimilar and its index if they do not exist'''
+        self.db.connect()
+        for sql in SQ.SQL_SIMILAR_BUILD:
+            self.db.curs.execute(sql)
+        self.db.close()
+        return
+
+    def texts(self, bill_ids: list):
+        '''Yield bill texts in the order of bill_ids, reading batch_size bills at a time'''
+        for i in range(0, len(bill_ids), self.batch_size):
+            chunk = bill_ids[i:i + self.batch_size]
+            self.db.connect()
+            rows = self.db.curs.execute(SQ.SQL_SELECT_CLEAN_CONTENT.format(', '.join('?' * len(chunk))), chunk).fetchall()
+            self.db.close()
+            for bill_id, content in rows:
+                yield content
+
+    def batches(self, bill_ids: list):
+        '''Yield hashed term counts of batch_size bills at a time'''
+        texts = []
+        for content in self.texts(bill_ids):
+            texts.append(content)
+            if len(texts) == self.batch_size:
+                yield self.vectorizer.transform(texts)
+                texts = []
+        if len(texts) > 0:
+            yield self.vectorizer.transform(texts)
+
+    def idf(self, bill_ids: list) -> np.ndarray:
+        '''Smoothed idf of every hashed column from a pass over the texts, 0 for columns outside the document frequency bounds'''
+        df = np.zeros(self.n_features, dtype=np.int64)
+        for counts in self.batches(bill_ids):
+            df += np.bincount(counts.indices, minlength=self.n_features)
+        n = len(bill_ids)
+        idf = (np.log((1 + n) / (1 + df)) + 1).astype(np.float32)
+        # min_df=2, max_df=0.5 only once max_df leaves room for words of two bills
+        keep = (df >= 2) & (df <= 0.5 * n) if 0.5 * n >= 2 else df >= 1
+        idf[~keep] = 0
+        return idf
+
+    def write_matrix(self, bill_ids: list) -> tuple:
+        '''Weight the texts by sublinear tf-idf, normalize them and append them batch by batch to the matrix files. Returns the shape'''
+        idf = self.idf(bill_ids)
+        os.makedirs(self.path, exist_ok=True)
+        files = {name: open(os.path.join(self.path, name + '.bin'), 'wb') for name, dtype in MATRIX_FILES}
+        try:
+            files['indptr'].write(np.zeros(1, dtype=np.int64).tobytes())
+            nnz = 0
+            for counts in self.batches(bill_ids):
+                counts.data = np.log(counts.data) + 1
+                X = normalize(counts @ sp.diags(idf)).astype(np.float32).tocsr()
+                X.eliminate_zeros()
+                files['data'].write(X.data.tobytes())
+                files['indices'].write(X.indices.astype(np.int32).tobytes())
+                files['indptr'].write((X.indptr[1:].astype(np.int64) + nnz).tobytes())
+                nnz += X.nnz
+        finally:
+            for f in files.values():
+                f.close()
+        np.save(os.path.join(self.path, 'shape.npy'), np.array([len(bill_ids), self.n_features]))
+        return len(bill_ids), self.n_features
+
+    def block_sizes(self, n: int, workers: int) -> tuple:
+        '''(rows, columns) of a score block so that the blocks of all workers, with their merge buffers, fit in memory_mb'''
+        cells = max(1, self.memory_mb * 2**20 // (workers * 4 * 3))
+        columns = min(n, max(1, int(cells ** 0.5) * 4))
+        rows = min(n, max(1, cells // columns))
+        return rows, columns
+
+    def run(self) -> int:
+        '''Recompute tSimilar for every bill with text. Returns the number of pairs stored'''
+        self.db.connect()
+        bill_ids = [row[0] for row in self.db.curs.execute(SQ.SQL_SELECT_BILLS_WITH_CONTENT)]
+        self.db.close()
+        if len(bill_ids) < 2:
+            return 0
+
+        n, n_features = self.write_matrix(bill_ids)
+        print('tf-idf matrix:', (n, n_features))
+
+        workers = self.max_workers or os.cpu_count() or 1
+        rows, columns = self.block_sizes(n, workers)
+        tasks = [(start, min(start + rows, n), columns, self.top_k, self.min_score) for start in range(0, n, rows)]
+        bill_ids = np.asarray(bill_ids)
+        pairs = 0
+        self.db.connect()
+        self.db.curs.execute(SQ.SQL_DELETE_SIMILAR_WITHOUT_CONTENT)
+        self.db.close()
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(self.path,)) as pool:
+            for done, ((start, stop, *params), (row, other, score, rank)) in enumerate(zip(tasks, pool.map(_top_k_block, tasks))):
+                # the pairs of this block's bills are replaced in one short transaction
+                self.db.connect()
+                self.db.curs.execute('BEGIN;')
+                try:
+                    self.db.curs.execute(SQ.SQL_DELETE_SIMILAR_RANGE, (int(bill_ids[start]), int(bill_ids[stop - 1])))
+                    self.db.curs.executemany(SQ.SQL_INSERT_SIMILAR, zip(bill_ids[row].tolist(), bill_ids[other].tolist(),
+                                                                        score.tolist(), rank.tolist()))
+                    self.db.curs.execute('COMMIT;')
+                except Exception:
+                    self.db.curs.execute('ROLLBACK;')
+                    raise
+                finally:
+                    self.db.close()
+                pairs += len(row)
+                print(done + 1, 'of', len(tasks), 'blocks done')
+        return pairs
+
+    def similar(self, bill_id: int):
+        '''The stored most similar bills of a bill'''
+        return self.db.run_query(SQ.SQL_SELECT_SIMILAR, (bill_id,))
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Store the most similar bills of every bill by tf-idf cosine similarity')
+    args.add_argument('--top-k', type=int, default=10)
+    args.add_argument('--min-score', type=float, default=0.2)
+    args.add_argument('--memory-mb', type=int, default=512)
+    args.add_argument('--max-workers', type=int, default=None)
+    args = args.parse_args()
+    SimilarBills(top_k=args.top_k, min_score=args.min_score, memory_mb=args.memory_mb, max_workers=args.max_workers).run()
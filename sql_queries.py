@@ -35,6 +35,11 @@ SQL_FULL_BILLS_BUILD = """
                 url TEXT 
             );"""
 
+# the app and every per state/session summary filter bills by state and session
+SQL_BILLS_STATE_SESSION_INDEX = """
+            CREATE INDEX IF NOT EXISTS idx_bills_state_session ON tBills (state, session)
+            ;"""
+
 SQL_CHECK_BILLS = """
             SELECT bill_id
             FROM tBills
@@ -81,3 +86,1132 @@ SQL_INSERT_TBILLS = """
                     :content
                     )
             ;"""
+
+# bills are keyed by bill_id, so a re-synced dataset updates rows in place.
+# If the text url moved, the old content is stale, so clear processed_at to queue the bill for Tika again
+SQL_UPSERT_TBILLS = """
+            INSERT INTO tBills (
+                            bill_id,
+                            code,
+                            bill_number,
+                            title,
+                            description, 
+                            state,
+                            session,
+                            filename, 
+                            status, 
+                            status_date,
+                            url)
+            VALUES (:bill_id,
+                    :code,
+                    :bill_number,
+                    :title,
+                    :description,
+                    :state, 
+                    :session, 
+                    :filename, 
+                    :status, 
+                    :status_date, 
+                    :url
+                    )
+            ON CONFLICT(bill_id) DO UPDATE SET
+                code = excluded.code,
+                bill_number = excluded.bill_number,
+                title = excluded.title,
+                description = excluded.description,
+                state = excluded.state,
+                session = excluded.session,
+                filename = excluded.filename,
+                status = excluded.status,
+                status_date = excluded.status_date,
+                processed_at = CASE WHEN tBills.url IS excluded.url THEN tBills.processed_at ELSE NULL END,
+                url = excluded.url
+            ;"""
+
+# last Legiscan change_hash and newest text document seen for each bill, used by bill_sync.DeltaSync
+SQL_BILL_HASHES_BUILD = """
+            CREATE TABLE IF NOT EXISTS tBillHashes
+            (
+                bill_id INTEGER NOT NULL PRIMARY KEY,
+                change_hash TEXT NOT NULL,
+                text_doc_id INTEGER,
+                synced_at TIMESTAMP
+            );"""
+
+SQL_SELECT_BILL_HASHES = """
+            SELECT bill_id, change_hash, text_doc_id
+            FROM tBillHashes
+            WHERE bill_id IN ({0})
+            ;"""
+
+SQL_UPSERT_BILL_HASH = """
+            INSERT INTO tBillHashes (bill_id, change_hash, text_doc_id, synced_at)
+            VALUES (:bill_id, :change_hash, :text_doc_id, datetime('now','localtime'))
+            ON CONFLICT(bill_id) DO UPDATE SET
+                change_hash = excluded.change_hash,
+                text_doc_id = excluded.text_doc_id,
+                synced_at = excluded.synced_at
+            ;"""
+
+# a new text version exists, so queue the bill for text retrieval again
+SQL_MARK_TEXT_STALE = """
+            UPDATE tBills SET processed_at = NULL, error = NULL
+            WHERE bill_id = :bill_id
+            ;"""
+
+# partitions written by FetchData.df_to_partitions that have been loaded into tBills
+SQL_PARTITIONS_BUILD = """
+            CREATE TABLE IF NOT EXISTS tPartitions
+            (
+                filename TEXT NOT NULL PRIMARY KEY,
+                state TEXT,
+                session TEXT,
+                rows INTEGER,
+                sha256 TEXT NOT NULL,
+                loaded_at TIMESTAMP
+            );"""
+
+SQL_UPSERT_PARTITION = """
+            INSERT INTO tPartitions (filename, state, session, rows, sha256, loaded_at)
+            VALUES (:filename, :state, :session, :rows, :sha256, datetime('now','localtime'))
+            ON CONFLICT(filename) DO UPDATE SET
+                rows = excluded.rows,
+                sha256 = excluded.sha256,
+                loaded_at = excluded.loaded_at
+            ;"""
+
+# serialized spaCy results (DocBin bytes) per bill and model, used by ner.NERService
+SQL_NER_CACHE_BUILD = """
+            CREATE TABLE IF NOT EXISTS tNerCache
+            (
+                bill_id INTEGER NOT NULL,
+                model TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                docbin BLOB NOT NULL,
+                created_at TIMESTAMP,
+                PRIMARY KEY (bill_id, model)
+            );"""
+
+SQL_SELECT_NER_CACHE = """
+            SELECT bill_id, content_hash, docbin
+            FROM tNerCache
+            WHERE model = ? AND bill_id IN ({0})
+            ;"""
+
+SQL_UPSERT_NER_CACHE = """
+            INSERT INTO tNerCache (bill_id, model, content_hash, docbin, created_at)
+            VALUES (:bill_id, :model, :content_hash, :docbin, datetime('now','localtime'))
+            ON CONFLICT(bill_id, model) DO UPDATE SET
+                content_hash = excluded.content_hash,
+                docbin = excluded.docbin,
+                created_at = excluded.created_at
+            ;"""
+
+# cached NER results are stale once a bill gets new content
+SQL_INVALIDATE_NER_CACHE = """
+            DELETE FROM tNerCache WHERE bill_id = (?)
+            ;"""
+
+# normalized named entities for every processed bill, written by batch_ner.BatchNER.
+# tEntityRuns records which bills (and with which model) are done, so interrupted runs can resume
+SQL_ENTITIES_BUILD = [
+    """
+            CREATE TABLE IF NOT EXISTS tEntities
+            (
+                bill_id INTEGER NOT NULL,
+                label TEXT NOT NULL,
+                text TEXT NOT NULL,
+                "start" INTEGER NOT NULL,
+                "end" INTEGER NOT NULL
+            );""",
+    "CREATE INDEX IF NOT EXISTS idx_entities_bill ON tEntities (bill_id);",
+    "CREATE INDEX IF NOT EXISTS idx_entities_label_text ON tEntities (label, text);",
+    """
+            CREATE TABLE IF NOT EXISTS tEntityRuns
+            (
+                bill_id INTEGER NOT NULL PRIMARY KEY,
+                model TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                processed_at TIMESTAMP
+            );""",
+]
+
+SQL_PENDING_ENTITY_BILLS = """
+            SELECT b.bill_id
+            FROM tBills b
+            LEFT JOIN tEntityRuns r ON r.bill_id = b.bill_id
+            WHERE b.content IS NOT NULL
+                AND (r.bill_id IS NULL OR r.model IS NOT ?)
+            ORDER BY b.bill_id"""
+
+SQL_SELECT_CONTENT = """
+            SELECT bill_id, content
+            FROM tBills
+            WHERE bill_id IN ({0}) AND content IS NOT NULL
+            ORDER BY bill_id
+            ;"""
+
+# bill text with boilerplate removed (normalize.Normalizer), stored next to tBills.content
+SQL_CLEAN_TEXT_BUILD = """
+            CREATE TABLE IF NOT EXISTS tCleanText
+            (
+                bill_id INTEGER NOT NULL PRIMARY KEY,
+                content TEXT NOT NULL,
+                normalized_at TIMESTAMP
+            );"""
+
+# the normalized text of bills where it exists, else the raw text. Steps that store character offsets keep using SQL_SELECT_CONTENT
+SQL_SELECT_CLEAN_CONTENT = """
+            SELECT b.bill_id, COALESCE(c.content, b.content)
+            FROM tBills b
+            LEFT JOIN tCleanText c ON c.bill_id = b.bill_id
+            WHERE b.bill_id IN ({0}) AND b.content IS NOT NULL
+            ORDER BY b.bill_id
+            ;"""
+
+SQL_SELECT_CONTENT_WITH_STATE = """
+            SELECT bill_id, state, content
+            FROM tBills
+            WHERE bill_id IN ({0}) AND content IS NOT NULL
+            ORDER BY bill_id
+            ;"""
+
+SQL_SELECT_STATE_CLEAN_CONTENT = """
+            SELECT b.bill_id, COALESCE(c.content, b.content) AS content
+            FROM tBills b
+            LEFT JOIN tCleanText c ON c.bill_id = b.bill_id
+            WHERE b.state = (?) AND b.content IS NOT NULL
+            ORDER BY b.bill_id
+            ;"""
+
+SQL_COUNT_BILLS_WITH_CONTENT_BY_STATE = """
+            SELECT state, COUNT(*) AS n FROM tBills WHERE content IS NOT NULL GROUP BY state ORDER BY state
+            ;"""
+
+SQL_PENDING_CLEAN_TEXT_BILLS = """
+            SELECT b.bill_id
+            FROM tBills b
+            LEFT JOIN tCleanText c ON c.bill_id = b.bill_id
+            WHERE b.content IS NOT NULL AND c.bill_id IS NULL
+            ORDER BY b.bill_id"""
+
+SQL_UPSERT_CLEAN_TEXT = """
+            INSERT INTO tCleanText (bill_id, content, normalized_at) VALUES (?, ?, datetime('now','localtime'))
+            ON CONFLICT(bill_id) DO UPDATE SET content = excluded.content, normalized_at = excluded.normalized_at
+            ;"""
+
+SQL_INVALIDATE_CLEAN_TEXT = """
+            DELETE FROM tCleanText WHERE bill_id = (?)
+            ;"""
+
+SQL_DELETE_ENTITIES = """
+            DELETE FROM tEntities WHERE bill_id = :bill_id
+            ;"""
+
+SQL_INSERT_ENTITY = """
+            INSERT INTO tEntities (bill_id, label, text, "start", "end")
+            VALUES (:bill_id, :label, :text, :start, :end)
+            ;"""
+
+SQL_UPSERT_ENTITY_RUN = """
+            INSERT INTO tEntityRuns (bill_id, model, content_hash, processed_at)
+            VALUES (:bill_id, :model, :content_hash, datetime('now','localtime'))
+            ON CONFLICT(bill_id) DO UPDATE SET
+                model = excluded.model,
+                content_hash = excluded.content_hash,
+                processed_at = excluded.processed_at
+            ;"""
+
+SQL_INVALIDATE_ENTITY_RUN = """
+            DELETE FROM tEntityRuns WHERE bill_id = (?)
+            ;"""
+
+
+# keyword summaries written by keywords.KeywordEngine. tBillTerms holds sparse term counts per bill,
+# tTermDF the number of bills each term appears in, tKeywordRuns the bills whose current text is counted
+SQL_KEYWORDS_BUILD = [
+    """
+            CREATE TABLE IF NOT EXISTS tBillTerms
+            (
+                bill_id INTEGER NOT NULL,
+                term TEXT NOT NULL,
+                tf INTEGER NOT NULL,
+                PRIMARY KEY (bill_id, term)
+            );""",
+    """
+            CREATE TABLE IF NOT EXISTS tTermDF
+            (
+                term TEXT NOT NULL PRIMARY KEY,
+                df INTEGER NOT NULL
+            );""",
+    """
+            CREATE TABLE IF NOT EXISTS tKeywordRuns
+            (
+                bill_id INTEGER NOT NULL PRIMARY KEY,
+                processed_at TIMESTAMP
+            );""",
+    """
+            CREATE TABLE IF NOT EXISTS tKeywords
+            (
+                bill_id INTEGER NOT NULL,
+                term TEXT NOT NULL,
+                score REAL NOT NULL,
+                rank INTEGER NOT NULL,
+                PRIMARY KEY (bill_id, rank)
+            );""",
+    "CREATE INDEX IF NOT EXISTS idx_keywords_term ON tKeywords (term);",
+    """
+            CREATE TABLE IF NOT EXISTS tSessionKeywords
+            (
+                state TEXT NOT NULL,
+                session TEXT NOT NULL,
+                term TEXT NOT NULL,
+                score REAL NOT NULL,
+                rank INTEGER NOT NULL,
+                PRIMARY KEY (state, session, rank)
+            );""",
+    "CREATE INDEX IF NOT EXISTS idx_session_keywords_term ON tSessionKeywords (term);",
+    SQL_CLEAN_TEXT_BUILD,
+]
+
+SQL_PENDING_KEYWORD_BILLS = """
+            SELECT b.bill_id
+            FROM tBills b
+            LEFT JOIN tKeywordRuns r ON r.bill_id = b.bill_id
+            WHERE b.content IS NOT NULL AND b.content != '' AND r.bill_id IS NULL
+            ORDER BY b.bill_id"""
+
+SQL_SELECT_BILL_TERMS = """
+            SELECT bill_id, term, tf FROM tBillTerms WHERE bill_id IN ({0})
+            ;"""
+
+SQL_DELETE_BILL_TERMS = """
+            DELETE FROM tBillTerms WHERE bill_id IN ({0})
+            ;"""
+
+SQL_INSERT_BILL_TERM = """
+            INSERT INTO tBillTerms (bill_id, term, tf) VALUES (?, ?, ?)
+            ;"""
+
+SQL_INCREMENT_TERM_DF = """
+            INSERT INTO tTermDF (term, df) VALUES (?, 1)
+            ON CONFLICT(term) DO UPDATE SET df = df + 1
+            ;"""
+
+SQL_DECREMENT_TERM_DF = """
+            UPDATE tTermDF SET df = df - 1 WHERE term = ?
+            ;"""
+
+SQL_DELETE_UNUSED_TERM_DF = """
+            DELETE FROM tTermDF WHERE df <= 0
+            ;"""
+
+# bills with counted terms or a checkpoint whose text is gone
+SQL_KEYWORD_BILLS_WITHOUT_TEXT = """
+            SELECT t.bill_id
+            FROM tBillTerms t
+            LEFT JOIN tBills b ON b.bill_id = t.bill_id
+            WHERE b.content IS NULL OR b.content = ''
+            UNION
+            SELECT r.bill_id
+            FROM tKeywordRuns r
+            LEFT JOIN tBills b ON b.bill_id = r.bill_id
+            WHERE b.content IS NULL OR b.content = ''
+            ;"""
+
+SQL_UPSERT_KEYWORD_RUN = """
+            INSERT INTO tKeywordRuns (bill_id, processed_at) VALUES (?, datetime('now','localtime'))
+            ON CONFLICT(bill_id) DO UPDATE SET processed_at = excluded.processed_at
+            ;"""
+
+SQL_INVALIDATE_KEYWORD_RUN = """
+            DELETE FROM tKeywordRuns WHERE bill_id = (?)
+            ;"""
+
+SQL_SELECT_TERMS_WITH_DF = """
+            SELECT t.bill_id, t.term, t.tf, d.df
+            FROM tBillTerms t
+            JOIN tTermDF d ON d.term = t.term"""
+
+SQL_SELECT_SESSIONS_OF_BILLS = """
+            SELECT DISTINCT state, session FROM tBills WHERE bill_id IN ({0})
+            ;"""
+
+SQL_SELECT_SESSION_TERMS = """
+            SELECT t.term, SUM(t.tf) AS tf, d.df
+            FROM tBills b
+            JOIN tBillTerms t ON t.bill_id = b.bill_id
+            JOIN tTermDF d ON d.term = t.term
+            WHERE b.state = (?) AND b.session = (?)
+            GROUP BY t.term
+            ;"""
+
+SQL_INSERT_KEYWORD = """
+            INSERT INTO tKeywords (bill_id, term, score, rank) VALUES (?, ?, ?, ?)
+            ;"""
+
+SQL_DELETE_SESSION_KEYWORDS = """
+            DELETE FROM tSessionKeywords WHERE state = (?) AND session = (?)
+            ;"""
+
+SQL_INSERT_SESSION_KEYWORD = """
+            INSERT INTO tSessionKeywords (state, session, term, score, rank) VALUES (?, ?, ?, ?, ?)
+            ;"""
+
+SQL_SELECT_SESSION_KEYWORDS = """
+            SELECT rank, term, score
+            FROM tSessionKeywords
+            WHERE state = (?) AND session = (?)
+            ORDER BY rank
+            ;"""
+
+
+# topic model output written by topics.TopicModel
+SQL_TOPICS_BUILD = [
+    """
+            CREATE TABLE IF NOT EXISTS tTopics
+            (
+                topic_id INTEGER NOT NULL PRIMARY KEY,
+                terms TEXT NOT NULL
+            );""",
+    """
+            CREATE TABLE IF NOT EXISTS tBillTopics
+            (
+                bill_id INTEGER NOT NULL,
+                topic_id INTEGER NOT NULL,
+                weight REAL NOT NULL,
+                PRIMARY KEY (bill_id, topic_id)
+            );""",
+    "CREATE INDEX IF NOT EXISTS idx_bill_topics_topic ON tBillTopics (topic_id, weight DESC);",
+    """
+            CREATE TABLE IF NOT EXISTS tTopicRuns
+            (
+                bill_id INTEGER NOT NULL PRIMARY KEY,
+                processed_at TIMESTAMP
+            );""",
+    SQL_BILLS_STATE_SESSION_INDEX,
+    SQL_CLEAN_TEXT_BUILD,
+]
+
+SQL_SELECT_BILLS_WITH_CONTENT = """
+            SELECT bill_id FROM tBills WHERE content IS NOT NULL ORDER BY bill_id
+            ;"""
+
+SQL_COUNT_BILLS_WITH_CONTENT = """
+            SELECT COUNT(*) FROM tBills WHERE content IS NOT NULL
+            ;"""
+
+SQL_PENDING_TOPIC_BILLS = """
+            SELECT b.bill_id
+            FROM tBills b
+            LEFT JOIN tTopicRuns r ON r.bill_id = b.bill_id
+            WHERE b.content IS NOT NULL AND r.bill_id IS NULL
+            ORDER BY b.bill_id
+            ;"""
+
+SQL_INSERT_TOPIC = """
+            INSERT INTO tTopics (topic_id, terms) VALUES (?, ?)
+            ;"""
+
+SQL_INSERT_BILL_TOPIC = """
+            INSERT INTO tBillTopics (bill_id, topic_id, weight) VALUES (?, ?, ?)
+            ;"""
+
+SQL_UPSERT_TOPIC_RUN = """
+            INSERT INTO tTopicRuns (bill_id, processed_at) VALUES (?, datetime('now','localtime'))
+            ON CONFLICT(bill_id) DO UPDATE SET processed_at = excluded.processed_at
+            ;"""
+
+SQL_INVALIDATE_TOPIC_RUN = """
+            DELETE FROM tTopicRuns WHERE bill_id = (?)
+            ;"""
+
+# average over every modeled bill of the session (tTopicRuns): weights below min_weight are not stored and count as 0
+SQL_SELECT_SESSION_TOPICS = """
+            SELECT t.topic_id, t.terms, SUM(bt.weight) / (
+                SELECT COUNT(*) FROM tBills mb JOIN tTopicRuns r ON r.bill_id = mb.bill_id
+                WHERE mb.state = :state AND mb.session = :session) AS weight
+            FROM tBills b
+            JOIN tBillTopics bt ON bt.bill_id = b.bill_id
+            JOIN tTopics t ON t.topic_id = bt.topic_id
+            WHERE b.state = :state AND b.session = :session
+            GROUP BY t.topic_id
+            ORDER BY weight DESC
+            ;"""
+
+
+# materialized entity/keyword counts per state, session and status, maintained by rollups.Rollups.
+# tRollupMembers records the group each bill was counted under
+SQL_ROLLUPS_BUILD = [
+    """
+            CREATE TABLE IF NOT EXISTS tEntityRollup
+            (
+                state TEXT NOT NULL,
+                session TEXT NOT NULL,
+                status INTEGER NOT NULL,
+                label TEXT NOT NULL,
+                text TEXT NOT NULL,
+                n INTEGER NOT NULL,
+                bills INTEGER NOT NULL,
+                PRIMARY KEY (state, session, status, label, text)
+            );""",
+    "CREATE INDEX IF NOT EXISTS idx_entity_rollup_label ON tEntityRollup (label, text);",
+    """
+            CREATE TABLE IF NOT EXISTS tKeywordRollup
+            (
+                state TEXT NOT NULL,
+                session TEXT NOT NULL,
+                status INTEGER NOT NULL,
+                term TEXT NOT NULL,
+                bills INTEGER NOT NULL,
+                score REAL NOT NULL,
+                PRIMARY KEY (state, session, status, term)
+            );""",
+    "CREATE INDEX IF NOT EXISTS idx_keyword_rollup_term ON tKeywordRollup (term);",
+    """
+            CREATE TABLE IF NOT EXISTS tRollupMembers
+            (
+                kind TEXT NOT NULL,
+                bill_id INTEGER NOT NULL,
+                state TEXT NOT NULL,
+                session TEXT NOT NULL,
+                status INTEGER NOT NULL,
+                PRIMARY KEY (kind, bill_id)
+            );""",
+]
+
+SQL_ROLLUP_MEMBERS_ADD = """
+            INSERT OR REPLACE INTO tRollupMembers (kind, bill_id, state, session, status)
+            SELECT (?), bill_id, state, session, COALESCE(status, 0)
+            FROM tBills
+            WHERE bill_id IN ({0})
+            ;"""
+
+SQL_ROLLUP_MEMBERS_REMOVE = """
+            DELETE FROM tRollupMembers WHERE kind = (?) AND bill_id IN ({0})
+            ;"""
+
+# parameters: kind, sign (+1 to add the bills' rows, -1 to subtract them)
+SQL_ROLLUP_ENTITIES_DELTA = """
+            INSERT INTO tEntityRollup (state, session, status, label, text, n, bills)
+            SELECT m.state, m.session, m.status, e.label, e.text, COUNT(*) * (?2), COUNT(DISTINCT e.bill_id) * (?2)
+            FROM tEntities e
+            JOIN tRollupMembers m ON m.kind = (?1) AND m.bill_id = e.bill_id
+            WHERE e.bill_id IN ({0})
+            GROUP BY m.state, m.session, m.status, e.label, e.text
+            ON CONFLICT(state, session, status, label, text) DO UPDATE SET
+                n = n + excluded.n,
+                bills = bills + excluded.bills
+            ;"""
+
+SQL_ROLLUP_KEYWORDS_DELTA = """
+            INSERT INTO tKeywordRollup (state, session, status, term, bills, score)
+            SELECT m.state, m.session, m.status, k.term, COUNT(*) * (?2), SUM(k.score) * (?2)
+            FROM tKeywords k
+            JOIN tRollupMembers m ON m.kind = (?1) AND m.bill_id = k.bill_id
+            WHERE k.bill_id IN ({0})
+            GROUP BY m.state, m.session, m.status, k.term
+            ON CONFLICT(state, session, status, term) DO UPDATE SET
+                bills = bills + excluded.bills,
+                score = score + excluded.score
+            ;"""
+
+SQL_ROLLUP_CLEANUP = """
+            DELETE FROM {0} WHERE bills <= 0
+            ;"""
+
+SQL_ROLLUP_MOVED = """
+            SELECT m.bill_id
+            FROM tRollupMembers m
+            JOIN tBills b ON b.bill_id = m.bill_id
+            WHERE m.kind = (?)
+                AND (b.state IS NOT m.state OR b.session IS NOT m.session OR COALESCE(b.status, 0) IS NOT m.status)
+            ;"""
+
+# summaries for MyDB.top_entities / MyDB.top_keywords; status and label are optional filters
+SQL_TOP_ENTITIES = """
+            SELECT label, text, SUM(n) AS mentions, SUM(bills) AS bills
+            FROM tEntityRollup
+            WHERE state = :state
+                AND (:session IS NULL OR session = :session)
+                AND (:status IS NULL OR status = :status)
+                AND (:label IS NULL OR label = :label)
+            GROUP BY label, text
+            ORDER BY mentions DESC
+            LIMIT :limit
+            ;"""
+
+SQL_TOP_KEYWORDS = """
+            SELECT term, SUM(bills) AS bills, SUM(score) AS score
+            FROM tKeywordRollup
+            WHERE state = :state
+                AND (:session IS NULL OR session = :session)
+                AND (:status IS NULL OR status = :status)
+            GROUP BY term
+            ORDER BY bills DESC, score DESC
+            LIMIT :limit
+            ;"""
+
+# MinHash near-duplicate index (minhash.MinHashLSH): checkpoints and scored pairs, stored in both directions
+SQL_MINHASH_BUILD = [
+    """
+            CREATE TABLE IF NOT EXISTS tMinHashRuns
+            (
+                bill_id INTEGER NOT NULL PRIMARY KEY,
+                processed_at TIMESTAMP
+            );""",
+    """
+            CREATE TABLE IF NOT EXISTS tNearDuplicates
+            (
+                bill_id INTEGER NOT NULL,
+                other_id INTEGER NOT NULL,
+                score REAL NOT NULL,
+                PRIMARY KEY (bill_id, other_id)
+            );""",
+    SQL_CLEAN_TEXT_BUILD,
+]
+
+SQL_PENDING_MINHASH_BILLS = """
+            SELECT b.bill_id
+            FROM tBills b
+            LEFT JOIN tMinHashRuns r ON r.bill_id = b.bill_id
+            WHERE b.content IS NOT NULL AND r.bill_id IS NULL
+            ORDER BY b.bill_id"""
+
+SQL_UPSERT_MINHASH_RUN = """
+            INSERT INTO tMinHashRuns (bill_id, processed_at) VALUES (?, datetime('now','localtime'))
+            ON CONFLICT(bill_id) DO UPDATE SET processed_at = excluded.processed_at
+            ;"""
+
+SQL_INVALIDATE_MINHASH_RUN = """
+            DELETE FROM tMinHashRuns WHERE bill_id = (?)
+            ;"""
+
+SQL_DELETE_NEAR_DUPLICATES = """
+            DELETE FROM tNearDuplicates WHERE bill_id IN ({0}) OR other_id IN ({0})
+            ;"""
+
+SQL_INSERT_NEAR_DUPLICATE = """
+            INSERT OR REPLACE INTO tNearDuplicates (bill_id, other_id, score) VALUES (?, ?, ?)
+            ;"""
+
+# exact shingle Jaccard pairs from shard_jobs.StatePairJob, kept apart from the MinHash estimates in tNearDuplicates.
+# Same layout, so CopyFamilies and StateShareMatrix can read it with pairs_table='tJaccardPairs'
+SQL_JACCARD_PAIRS_BUILD = [
+    """
+            CREATE TABLE IF NOT EXISTS tJaccardPairs
+            (
+                bill_id INTEGER NOT NULL,
+                other_id INTEGER NOT NULL,
+                score REAL NOT NULL,
+                PRIMARY KEY (bill_id, other_id)
+            );""",
+    "CREATE INDEX IF NOT EXISTS idx_jaccard_pairs_other ON tJaccardPairs (other_id);",
+]
+
+# a shard replaces every pair between the bills of its two states
+SQL_DELETE_JACCARD_PAIRS_OF_STATES = """
+            DELETE FROM tJaccardPairs
+            WHERE bill_id IN (SELECT bill_id FROM tBills WHERE state = (?))
+                AND other_id IN (SELECT bill_id FROM tBills WHERE state = (?))
+            ;"""
+
+SQL_INSERT_JACCARD_PAIR = """
+            INSERT OR REPLACE INTO tJaccardPairs (bill_id, other_id, score) VALUES (?, ?, ?)
+            ;"""
+
+# model legislation corpus and matches (model_bills.ModelBills). tModelMatchRuns records the corpus version each bill was matched against
+SQL_MODEL_BILLS_BUILD = [
+    """
+            CREATE TABLE IF NOT EXISTS tModelBills
+            (
+                model_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                source TEXT,
+                title TEXT,
+                path TEXT NOT NULL UNIQUE,
+                file_hash TEXT NOT NULL,
+                content TEXT,
+                error TEXT,
+                added_at TIMESTAMP
+            );""",
+    """
+            CREATE TABLE IF NOT EXISTS tModelMatches
+            (
+                bill_id INTEGER NOT NULL,
+                model_id INTEGER NOT NULL,
+                shared INTEGER NOT NULL,
+                containment REAL NOT NULL,
+                jaccard REAL NOT NULL,
+                rank INTEGER NOT NULL,
+                PRIMARY KEY (bill_id, model_id)
+            );""",
+    "CREATE INDEX IF NOT EXISTS idx_model_matches_model ON tModelMatches (model_id, containment DESC);",
+    """
+            CREATE TABLE IF NOT EXISTS tModelMatchRuns
+            (
+                bill_id INTEGER NOT NULL PRIMARY KEY,
+                corpus TEXT NOT NULL,
+                processed_at TIMESTAMP
+            );""",
+    SQL_CLEAN_TEXT_BUILD,
+]
+
+SQL_UPSERT_MODEL_BILL = """
+            INSERT INTO tModelBills (source, title, path, file_hash, content, error, added_at)
+            VALUES (:source, :title, :path, :file_hash, :content, :error, datetime('now','localtime'))
+            ON CONFLICT(path) DO UPDATE SET
+                source = excluded.source,
+                title = excluded.title,
+                file_hash = excluded.file_hash,
+                content = excluded.content,
+                error = excluded.error,
+                added_at = excluded.added_at
+            ;"""
+
+SQL_PENDING_MODEL_MATCH_BILLS = """
+            SELECT b.bill_id
+            FROM tBills b
+            LEFT JOIN tModelMatchRuns r ON r.bill_id = b.bill_id
+            WHERE b.content IS NOT NULL AND (r.bill_id IS NULL OR r.corpus IS NOT (?))
+            ORDER BY b.bill_id"""
+
+SQL_INSERT_MODEL_MATCH = """
+            INSERT INTO tModelMatches (bill_id, model_id, shared, containment, jaccard, rank) VALUES (?, ?, ?, ?, ?, ?)
+            ;"""
+
+SQL_UPSERT_MODEL_MATCH_RUN = """
+            INSERT INTO tModelMatchRuns (bill_id, corpus, processed_at) VALUES (?, ?, datetime('now','localtime'))
+            ON CONFLICT(bill_id) DO UPDATE SET corpus = excluded.corpus, processed_at = excluded.processed_at
+            ;"""
+
+SQL_INVALIDATE_MODEL_MATCH_RUN = """
+            DELETE FROM tModelMatchRuns WHERE bill_id = (?)
+            ;"""
+
+SQL_SELECT_MODEL_MATCHES = """
+            SELECT m.model_id, mb.source, mb.title, m.shared, m.containment, m.jaccard, m.rank
+            FROM tModelMatches m
+            JOIN tModelBills mb ON mb.model_id = m.model_id
+            WHERE m.bill_id = (?)
+            ORDER BY m.rank
+            ;"""
+
+# passages shared by candidate pairs (alignment.PassageAligner), offsets are into tBills.content; pairs are stored with bill_id < other_id
+SQL_ALIGNMENTS_BUILD = [
+    """
+            CREATE TABLE IF NOT EXISTS tAlignments
+            (
+                bill_id INTEGER NOT NULL,
+                other_id INTEGER NOT NULL,
+                "start" INTEGER NOT NULL,
+                "end" INTEGER NOT NULL,
+                other_start INTEGER NOT NULL,
+                other_end INTEGER NOT NULL,
+                tokens INTEGER NOT NULL,
+                score INTEGER NOT NULL
+            );""",
+    "CREATE INDEX IF NOT EXISTS idx_alignments_pair ON tAlignments (bill_id, other_id);",
+    "CREATE INDEX IF NOT EXISTS idx_alignments_other ON tAlignments (other_id);",
+    """
+            CREATE TABLE IF NOT EXISTS tAlignmentRuns
+            (
+                bill_id INTEGER NOT NULL,
+                other_id INTEGER NOT NULL,
+                processed_at TIMESTAMP,
+                PRIMARY KEY (bill_id, other_id)
+            );""",
+    "CREATE INDEX IF NOT EXISTS idx_alignment_runs_other ON tAlignmentRuns (other_id);",
+]
+
+SQL_PENDING_ALIGNMENT_PAIRS = """
+            SELECT p.bill_id, p.other_id
+            FROM {0} p
+            LEFT JOIN tAlignmentRuns r ON r.bill_id = p.bill_id AND r.other_id = p.other_id
+            WHERE p.bill_id < p.other_id AND r.bill_id IS NULL
+            ORDER BY p.bill_id, p.other_id"""
+
+SQL_DELETE_ALIGNMENTS = """
+            DELETE FROM tAlignments WHERE bill_id = (?) AND other_id = (?)
+            ;"""
+
+SQL_INSERT_ALIGNMENT = """
+            INSERT INTO tAlignments (bill_id, other_id, "start", "end", other_start, other_end, tokens, score)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ;"""
+
+SQL_UPSERT_ALIGNMENT_RUN = """
+            INSERT INTO tAlignmentRuns (bill_id, other_id, processed_at) VALUES (?, ?, datetime('now','localtime'))
+            ON CONFLICT(bill_id, other_id) DO UPDATE SET processed_at = excluded.processed_at
+            ;"""
+
+SQL_INVALIDATE_ALIGNMENT_RUN = """
+            DELETE FROM tAlignmentRuns WHERE bill_id = ?1 OR other_id = ?1
+            ;"""
+
+# offsets point into the old text, so the passages go as well
+SQL_INVALIDATE_ALIGNMENTS = """
+            DELETE FROM tAlignments WHERE bill_id = ?1 OR other_id = ?1
+            ;"""
+
+# pairs that are no longer candidates keep neither passages nor a checkpoint
+SQL_DELETE_STALE_ALIGNMENTS = [
+    """
+            DELETE FROM tAlignments
+            WHERE NOT EXISTS (SELECT 1 FROM {0} p WHERE p.bill_id = tAlignments.bill_id AND p.other_id = tAlignments.other_id)
+            ;""",
+    """
+            DELETE FROM tAlignmentRuns
+            WHERE NOT EXISTS (SELECT 1 FROM {0} p WHERE p.bill_id = tAlignmentRuns.bill_id AND p.other_id = tAlignmentRuns.other_id)
+            ;""",
+]
+
+SQL_SELECT_ALIGNMENT_RUN = """
+            SELECT processed_at FROM tAlignmentRuns WHERE bill_id = (?) AND other_id = (?)
+            ;"""
+
+SQL_SELECT_ALIGNMENTS = """
+            SELECT "start", "end", other_start, other_end, tokens, score
+            FROM tAlignments
+            WHERE bill_id = (?) AND other_id = (?)
+            ORDER BY tokens DESC
+            ;"""
+
+# top-k tf-idf cosine similarity of every bill (similar.SimilarBills)
+SQL_SIMILAR_BUILD = [
+    """
+            CREATE TABLE IF NOT EXISTS tSimilar
+            (
+                bill_id INTEGER NOT NULL,
+                other_id INTEGER NOT NULL,
+                score REAL NOT NULL,
+                rank INTEGER NOT NULL,
+                PRIMARY KEY (bill_id, other_id)
+            );""",
+    "CREATE INDEX IF NOT EXISTS idx_similar_other ON tSimilar (other_id);",
+    SQL_CLEAN_TEXT_BUILD,
+]
+
+SQL_INSERT_SIMILAR = """
+            INSERT OR REPLACE INTO tSimilar (bill_id, other_id, score, rank) VALUES (?, ?, ?, ?)
+            ;"""
+
+# pairs of bills that no longer have text; every other bill's pairs are replaced block by block
+SQL_DELETE_SIMILAR_WITHOUT_CONTENT = """
+            DELETE FROM tSimilar
+            WHERE bill_id NOT IN (SELECT bill_id FROM tBills WHERE content IS NOT NULL)
+               OR other_id NOT IN (SELECT bill_id FROM tBills WHERE content IS NOT NULL)
+            ;"""
+
+SQL_DELETE_SIMILAR_RANGE = """
+            DELETE FROM tSimilar WHERE bill_id BETWEEN (?) AND (?)
+            ;"""
+
+SQL_SELECT_SIMILAR = """
+            SELECT s.other_id AS bill_id, b.state, b.session, b.code, b.title, s.score
+            FROM tSimilar s
+            JOIN tBills b ON b.bill_id = s.other_id
+            WHERE s.bill_id = (?)
+            ORDER BY s.rank
+            ;"""
+
+# the "similar bills / possible model source" panel of MyApp: indexed lookups by bill_id with the same columns
+SQL_SELECT_NEAR_DUPLICATES_OF_BILL = """
+            SELECT 'near duplicate' AS match, n.other_id AS id, b.state, b.session, b.code, b.title, n.score
+            FROM tNearDuplicates n
+            JOIN tBills b ON b.bill_id = n.other_id
+            WHERE n.bill_id = :bill_id
+            ORDER BY n.score DESC
+            LIMIT :limit
+            ;"""
+
+SQL_SELECT_SIMILAR_OF_BILL = """
+            SELECT 'related' AS match, s.other_id AS id, b.state, b.session, b.code, b.title, s.score
+            FROM tSimilar s
+            JOIN tBills b ON b.bill_id = s.other_id
+            WHERE s.bill_id = :bill_id
+            ORDER BY s.rank
+            LIMIT :limit
+            ;"""
+
+SQL_SELECT_MODEL_SOURCES_OF_BILL = """
+            SELECT 'model source' AS match, m.model_id AS id, NULL AS state, NULL AS session, mb.source AS code, mb.title, m.containment AS score
+            FROM tModelMatches m
+            JOIN tModelBills mb ON mb.model_id = m.model_id
+            WHERE m.bill_id = :bill_id
+            ORDER BY m.rank
+            LIMIT :limit
+            ;"""
+
+SQL_SELECT_MODEL_CONTENT = """
+            SELECT content FROM tModelBills WHERE model_id = (?)
+            ;"""
+
+SQL_COPY_FAMILIES_BUILD = [
+    """
+            CREATE TABLE IF NOT EXISTS tFamilyEdges
+            (
+                bill_id INTEGER NOT NULL,
+                other_id INTEGER NOT NULL,
+                score REAL,
+                kind TEXT NOT NULL DEFAULT 'pair',
+                PRIMARY KEY (bill_id, other_id)
+            );""",
+    "CREATE INDEX IF NOT EXISTS idx_family_edges_other ON tFamilyEdges (other_id);",
+    """
+            CREATE TABLE IF NOT EXISTS tFamilyMembers
+            (
+                bill_id INTEGER PRIMARY KEY,
+                family_id INTEGER NOT NULL
+            );""",
+    "CREATE INDEX IF NOT EXISTS idx_family_members_family ON tFamilyMembers (family_id);",
+    """
+            CREATE TABLE IF NOT EXISTS tCopyFamilies
+            (
+                family_id INTEGER PRIMARY KEY,
+                representative INTEGER NOT NULL,
+                bills INTEGER NOT NULL,
+                states INTEGER NOT NULL,
+                updated_at TEXT
+            );""",
+    "CREATE INDEX IF NOT EXISTS idx_copy_families_states ON tCopyFamilies (states DESC);",
+]
+
+# high-confidence pairs of a pair table that are not family edges yet; blocked pairs are in tFamilyEdges, so they stay out
+SQL_NEW_FAMILY_EDGES = """
+            SELECT p.bill_id, p.other_id, p.score
+            FROM {0} p
+            LEFT JOIN tFamilyEdges e ON e.bill_id = p.bill_id AND e.other_id = p.other_id
+            WHERE p.bill_id < p.other_id AND p.score >= (?) AND e.bill_id IS NULL
+            ;"""
+
+# family edges whose pair is gone from the pair table or fell below the threshold (the text of a bill changed)
+SQL_REMOVED_FAMILY_EDGES = """
+            SELECT e.bill_id, e.other_id
+            FROM tFamilyEdges e
+            LEFT JOIN {0} p ON p.bill_id = e.bill_id AND p.other_id = e.other_id AND p.score >= (?)
+            WHERE e.kind = 'pair' AND p.bill_id IS NULL
+            ;"""
+
+SQL_UPSERT_FAMILY_EDGE = """
+            INSERT OR REPLACE INTO tFamilyEdges (bill_id, other_id, score, kind) VALUES (?, ?, ?, ?)
+            ;"""
+
+SQL_DELETE_FAMILY_EDGE = """
+            DELETE FROM tFamilyEdges WHERE bill_id = (?) AND other_id = (?)
+            ;"""
+
+SQL_UPSERT_FAMILY_MEMBER = """
+            INSERT OR REPLACE INTO tFamilyMembers (bill_id, family_id) VALUES (?, ?)
+            ;"""
+
+# edges inside one family that still connect bills (blocked edges are kept only to stop the pair from coming back)
+SQL_SELECT_FAMILY_EDGES = """
+            SELECT e.bill_id, e.other_id
+            FROM tFamilyMembers m
+            JOIN tFamilyEdges e ON e.bill_id = m.bill_id
+            WHERE m.family_id = (?) AND e.kind != 'blocked'
+            ;"""
+
+# members of families with their state and number of edges, for the family summary and the representative
+SQL_SELECT_FAMILY_MEMBERS = """
+            SELECT m.family_id, m.bill_id, b.state,
+                (SELECT COUNT(*) FROM tFamilyEdges e WHERE e.bill_id = m.bill_id AND e.kind != 'blocked')
+                + (SELECT COUNT(*) FROM tFamilyEdges e WHERE e.other_id = m.bill_id AND e.kind != 'blocked') AS degree
+            FROM tFamilyMembers m
+            LEFT JOIN tBills b ON b.bill_id = m.bill_id
+            WHERE m.family_id IN ({0})
+            ;"""
+
+SQL_UPSERT_COPY_FAMILY = """
+            INSERT OR REPLACE INTO tCopyFamilies (family_id, representative, bills, states, updated_at)
+            VALUES (?, ?, ?, ?, datetime('now','localtime'))
+            ;"""
+
+SQL_SELECT_COPY_FAMILY_OF_BILL = """
+            SELECT f.family_id, f.representative, r.state, r.session, r.code, r.title, f.bills, f.states
+            FROM tFamilyMembers m
+            JOIN tCopyFamilies f ON f.family_id = m.family_id
+            LEFT JOIN tBills r ON r.bill_id = f.representative
+            WHERE m.bill_id = (?)
+            ;"""
+
+SQL_SELECT_FAMILY_BILLS = """
+            SELECT b.bill_id, b.state, b.session, b.code, b.title
+            FROM tFamilyMembers m
+            JOIN tBills b ON b.bill_id = m.bill_id
+            WHERE m.family_id = (?)
+            ORDER BY b.state, b.session, b.code
+            ;"""
+
+# checkpoints of the LSA embedding store (embeddings.LSAEmbeddings)
+SQL_EMBEDDINGS_BUILD = [
+    """
+            CREATE TABLE IF NOT EXISTS tEmbeddingRuns
+            (
+                bill_id INTEGER NOT NULL PRIMARY KEY,
+                processed_at TIMESTAMP
+            );""",
+    SQL_CLEAN_TEXT_BUILD,
+]
+
+SQL_PENDING_EMBEDDING_BILLS = """
+            SELECT b.bill_id
+            FROM tBills b
+            LEFT JOIN tEmbeddingRuns r ON r.bill_id = b.bill_id
+            WHERE b.content IS NOT NULL AND r.bill_id IS NULL
+            ORDER BY b.bill_id"""
+
+SQL_UPSERT_EMBEDDING_RUN = """
+            INSERT INTO tEmbeddingRuns (bill_id, processed_at) VALUES (?, datetime('now','localtime'))
+            ON CONFLICT(bill_id) DO UPDATE SET processed_at = excluded.processed_at
+            ;"""
+
+SQL_INVALIDATE_EMBEDDING_RUN = """
+            DELETE FROM tEmbeddingRuns WHERE bill_id = (?)
+            ;"""
+
+SQL_DELETE_EMBEDDING_RUNS = """
+            DELETE FROM tEmbeddingRuns
+            ;"""
+
+# bills saved while LSAEmbeddings.build() ran were embedded from their old text
+SQL_INVALIDATE_EMBEDDING_RUNS_SINCE = """
+            DELETE FROM tEmbeddingRuns
+            WHERE bill_id IN (SELECT bill_id FROM tBills WHERE processed_at >= (?))
+            ;"""
+
+# cross-state shared text (state_share.StateShareMatrix). tStatePairs holds the applied pairs in both directions with the state and session of both bills, so the matrix cells and their drill-down are indexed lookups
+SQL_STATE_SHARE_BUILD = [
+    """
+            CREATE TABLE IF NOT EXISTS tStatePairs
+            (
+                bill_id INTEGER NOT NULL,
+                other_id INTEGER NOT NULL,
+                score REAL NOT NULL,
+                state TEXT,
+                session TEXT,
+                other_state TEXT,
+                other_session TEXT,
+                PRIMARY KEY (bill_id, other_id)
+            );""",
+    "CREATE INDEX IF NOT EXISTS idx_state_pairs_states ON tStatePairs (state, other_state, score DESC);",
+    "CREATE INDEX IF NOT EXISTS idx_state_pairs_sessions ON tStatePairs (state, session, other_state, other_session, score DESC);",
+    """
+            CREATE TABLE IF NOT EXISTS tStateShare
+            (
+                state TEXT NOT NULL,
+                other_state TEXT NOT NULL,
+                pairs INTEGER NOT NULL,
+                bills INTEGER NOT NULL,
+                other_bills INTEGER NOT NULL,
+                score REAL,
+                PRIMARY KEY (state, other_state)
+            );""",
+    """
+            CREATE TABLE IF NOT EXISTS tStateSessionShare
+            (
+                state TEXT NOT NULL,
+                session TEXT NOT NULL,
+                other_state TEXT NOT NULL,
+                other_session TEXT NOT NULL,
+                pairs INTEGER NOT NULL,
+                bills INTEGER NOT NULL,
+                other_bills INTEGER NOT NULL,
+                score REAL,
+                PRIMARY KEY (state, other_state, session, other_session)
+            );""",
+]
+
+# applied pairs that are gone from the pair table, fell below the threshold, changed score, or whose bills moved to another state or session
+SQL_STALE_STATE_PAIRS = """
+            SELECT s.bill_id, s.other_id, s.state, s.session, s.other_state, s.other_session
+            FROM tStatePairs s
+            LEFT JOIN {0} p ON p.bill_id = s.bill_id AND p.other_id = s.other_id
+            LEFT JOIN tBills b ON b.bill_id = s.bill_id
+            LEFT JOIN tBills o ON o.bill_id = s.other_id
+            WHERE p.bill_id IS NULL OR p.score < (?) OR p.score != s.score
+                OR b.state IS NOT s.state OR b.session IS NOT s.session OR o.state IS NOT s.other_state OR o.session IS NOT s.other_session
+            ;"""
+
+SQL_NEW_STATE_PAIRS = """
+            SELECT p.bill_id, p.other_id, p.score, b.state, b.session, o.state, o.session
+            FROM {0} p
+            JOIN tBills b ON b.bill_id = p.bill_id
+            JOIN tBills o ON o.bill_id = p.other_id
+            LEFT JOIN tStatePairs s ON s.bill_id = p.bill_id AND s.other_id = p.other_id
+            WHERE p.score >= (?) AND s.bill_id IS NULL
+            ;"""
+
+SQL_DELETE_STATE_PAIR = """
+            DELETE FROM tStatePairs WHERE bill_id = (?) AND other_id = (?)
+            ;"""
+
+SQL_INSERT_STATE_PAIR = """
+            INSERT OR REPLACE INTO tStatePairs (bill_id, other_id, score, state, session, other_state, other_session)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ;"""
+
+# recount one cell of each matrix from its pairs (an index range of tStatePairs)
+SQL_REFRESH_STATE_SHARE = [
+    "DELETE FROM tStateShare WHERE state IS (?) AND other_state IS (?);",
+    """
+            INSERT INTO tStateShare (state, other_state, pairs, bills, other_bills, score)
+            SELECT state, other_state, COUNT(*), COUNT(DISTINCT bill_id), COUNT(DISTINCT other_id), AVG(score)
+            FROM tStatePairs
+            WHERE state IS (?1) AND other_state IS (?2)
+            GROUP BY state, other_state
+            ;""",
+]
+
+SQL_REFRESH_STATE_SESSION_SHARE = [
+    "DELETE FROM tStateSessionShare WHERE state IS (?) AND session IS (?) AND other_state IS (?) AND other_session IS (?);",
+    """
+            INSERT INTO tStateSessionShare (state, session, other_state, other_session, pairs, bills, other_bills, score)
+            SELECT state, session, other_state, other_session, COUNT(*), COUNT(DISTINCT bill_id), COUNT(DISTINCT other_id), AVG(score)
+            FROM tStatePairs
+            WHERE state IS (?1) AND session IS (?2) AND other_state IS (?3) AND other_session IS (?4)
+            GROUP BY state, session, other_state, other_session
+            ;""",
+]
+
+SQL_SELECT_STATE_SHARE = """
+            SELECT state, other_state, pairs, bills, other_bills, score FROM tStateShare
+            ;"""
+
+SQL_SELECT_STATE_SESSION_SHARE = """
+            SELECT session, other_session, pairs, bills, other_bills, score
+            FROM tStateSessionShare
+            WHERE state = :state AND other_state = :other_state
+            ORDER BY pairs DESC
+            ;"""
+
+SQL_SELECT_STATE_PAIRS = """
+            SELECT s.bill_id, b.session, b.code, b.title, s.other_id, o.session AS other_session, o.code AS other_code, o.title AS other_title, s.score
+            FROM tStatePairs s
+            JOIN tBills b ON b.bill_id = s.bill_id
+            JOIN tBills o ON o.bill_id = s.other_id
+            WHERE s.state = :state AND s.other_state = :other_state
+            ORDER BY s.score DESC
+            LIMIT :limit
+            ;"""
+
+SQL_SELECT_STATE_SESSION_PAIRS = """
+            SELECT s.bill_id, b.session, b.code, b.title, s.other_id, o.session AS other_session, o.code AS other_code, o.title AS other_title, s.score
+            FROM tStatePairs s
+            JOIN tBills b ON b.bill_id = s.bill_id
+            JOIN tBills o ON o.bill_id = s.other_id
+            WHERE s.state = :state AND s.session = :session AND s.other_state = :other_state AND s.other_session = :other_session
+            ORDER BY s.score DESC
+            LIMIT :limit
+            ;"""
+
+# run by Bill.save when a bill gets new content: everything derived from the old text is stale
+SQL_INVALIDATE_ON_CONTENT = [SQL_INVALIDATE_NER_CACHE, SQL_INVALIDATE_ENTITY_RUN, SQL_INVALIDATE_KEYWORD_RUN,
+                             SQL_INVALIDATE_TOPIC_RUN, SQL_INVALIDATE_MINHASH_RUN,
+                             SQL_INVALIDATE_MODEL_MATCH_RUN, SQL_INVALIDATE_ALIGNMENT_RUN, SQL_INVALIDATE_ALIGNMENTS,
+                             SQL_INVALIDATE_CLEAN_TEXT,
+                             SQL_INVALIDATE_EMBEDDING_RUN]
+
+# run by normalize.Normalizer when it writes normalized text: the steps that read it have to run again
+SQL_INVALIDATE_ON_CLEAN_TEXT = [SQL_INVALIDATE_KEYWORD_RUN, SQL_INVALIDATE_TOPIC_RUN, SQL_INVALIDATE_MINHASH_RUN,
+                                SQL_INVALIDATE_MODEL_MATCH_RUN, SQL_INVALIDATE_EMBEDDING_RUN]
@@ -0,0 +1,85 @@
+from create_database import MyDB
+import sql_queries as SQ
+import argparse
+
+class StateShareMatrix:
+    '''
+    Rollup of bill-level similarity pairs into a state x state matrix (tStateShare) and a state/session x state/session matrix (tStateSessionShare): for every cell the number of pairs, the number of bills on each side that share text with the other, and the mean score. "How many WY bills share text with UT" is the bills column of the (WY, UT) cell.
+
+    The pairs that make up the matrix are kept in tStatePairs, in both directions and with the state and session of both bills, indexed by (state, other_state) and by (state, session, other_state, other_session). A drill-down from a cell to its bill pairs is therefore an index range of tStatePairs and never a scan of the pair table.
+
+    update() is incremental: it compares the pair table with tStatePairs, removes pairs that are gone, fell below min_score, changed score or whose bills moved to another state or session, adds the new ones, and recounts only the cells those pairs belong to.
+
+    class parameters:
+
+    db: MyDB instance for legislation.db (default: MyDB())
+    pairs_table: table of (bill_id, other_id, score) pairs, stored in both directions (default: str = 'tNearDuplicates')
+    min_score: smallest score of a pair that is counted (default: float = 0.5)
+    '''
+
+    def __init__(self,
+                 db: MyDB = None,
+                 pairs_table: str = 'tNearDuplicates',
+                 min_score: float = 0.5,
+                ):
+        self.db = db if db is not None else MyDB()
+        self.pairs_table = pairs_table
+        self.min_score = min_score
+        self.build_tables()
+
+    def build_tables(self):
+        '''Create the matrix and pair tables and their indexes if they do not exist'''
+        self.db.connect()
+        for sql in SQ.SQL_STATE_SHARE_BUILD:
+            self.db.curs.execute(sql)
+        self.db.close()
+        return
+
+    def refresh(self, cells: set):
+        '''Recount the given (state, session, other_state, other_session) cells of both matrices'''
+        for state, other_state in {(state, other_state) for state, session, other_state, other_session in cells}:
+            for sql in SQ.SQL_REFRESH_STATE_SHARE:
+                self.db.curs.execute(sql, (state, other_state))
+        for state, session, other_state, other_session in cells:
+            for sql in SQ.SQL_REFRESH_STATE_SESSION_SHARE:
+                self.db.curs.execute(sql, (state, session, other_state, other_session))
+        return
+
+    def update(self) -> int:
+        '''Apply the pairs added to and removed from the pair table since the last update. Returns the number of cells recounted'''
+        self.db.connect()
+        self.db.curs.execute('BEGIN;')
+        try:
+            stale = self.db.curs.execute(SQ.SQL_STALE_STATE_PAIRS.format(self.pairs_table), (self.min_score,)).fetchall()
+            self.db.curs.executemany(SQ.SQL_DELETE_STATE_PAIR, [(bill_id, other_id) for bill_id, other_id, *cell in stale])
+            # read after the delete, so pairs whose score or bills changed come back with their current values
+            new = self.db.curs.execute(SQ.SQL_NEW_STATE_PAIRS.format(self.pairs_table), (self.min_score,)).fetchall()
+            self.db.curs.executemany(SQ.SQL_INSERT_STATE_PAIR, new)
+            cells = {tuple(cell) for bill_id, other_id, *cell in stale}
+            cells |= {(state, session, other_state, other_session) for bill_id, other_id, score, state, session, other_state, other_session in new}
+            self.refresh(cells)
+            self.db.curs.execute('COMMIT;')
+        except Exception:
+            self.db.curs.execute('ROLLBACK;')
+            raise
+        finally:
+            self.db.close()
+        print(len(stale), 'pairs removed,', len(new), 'pairs added,', len(cells), 'cells recounted')
+        return len(cells)
+
+    def rebuild(self) -> int:
+        '''Drop every applied pair and count the matrix again from the pair table'''
+        self.db.connect()
+        for table in ('tStatePairs', 'tStateShare', 'tStateSessionShare'):
+            self.db.curs.execute('DELETE FROM ' + table + ';')
+        self.db.close()
+        return self.update()
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Roll bill similarity pairs up into state x state and state/session x state/session matrices')
+    args.add_argument('--pairs-table', default='tNearDuplicates')
+    args.add_argument('--min-score', type=float, default=0.5)
+    args.add_argument('--rebuild', action='store_true', help='count the matrices from scratch')
+    args = args.parse_args()
+    matrix = StateShareMatrix(pairs_table=args.pairs_table, min_score=args.min_score)
+    matrix.rebuild() if args.rebuild else matrix.update()
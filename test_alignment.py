@@ -0,0 +1,35 @@
+import random
+from alignment import PassageAligner
+from conftest import random_text, edit_text, add_bills, save_content, set_pairs
+
+def aligned(db) -> tuple:
+    '''Pairs with stored passages, and pairs with a checkpoint'''
+    db.connect()
+    passages = set(db.curs.execute('SELECT DISTINCT bill_id, other_id FROM tAlignments;').fetchall())
+    runs = set(db.curs.execute('SELECT bill_id, other_id FROM tAlignmentRuns;').fetchall())
+    db.close()
+    return passages, runs
+
+def test_stale_alignments_are_dropped(db):
+    rng = random.Random(0)
+    text = random_text(rng)
+    add_bills(db, [(1, 'TX', '2023', text), (2, 'TX', '2023', edit_text(rng, text)), (3, 'CO', '2023', edit_text(rng, text))])
+    aligner = PassageAligner(db, pairs_table='tPairs', max_workers=1)
+    set_pairs(db, {(1, 2): 0.9, (1, 3): 0.9})
+    assert aligner.run() == 2
+    assert aligned(db) == ({(1, 2), (1, 3)}, {(1, 2), (1, 3)})
+
+    # (1, 2) is no longer a candidate
+    set_pairs(db, {(1, 3): 0.9})
+    assert aligner.run() == 0
+    assert aligned(db) == ({(1, 3)}, {(1, 3)})
+    assert aligner.passages(1, 2) != []
+
+    # the text of bill 3 is fetched again: its passages point into the old text
+    save_content(db, 3, 'new text ' + text)
+    assert aligned(db) == (set(), set())
+    assert aligner.run() == 1
+    passages, runs = aligned(db)
+    assert passages == {(1, 3)} and runs == {(1, 3)}
+    start, end, other_start, other_end, tokens, score = aligner.passages(1, 3)[0]
+    assert text[start:end].split()[:3] == ('new text ' + text)[other_start:other_end].split()[:3]
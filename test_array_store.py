@@ -0,0 +1,76 @@
+import os
+import numpy as np
+import pytest
+from array_store import ArrayStore
+
+def current(store: ArrayStore) -> dict:
+    '''bill_id -> current row of a reopened store, as lists'''
+    store = ArrayStore(store.path).open()
+    return {int(bill_id): np.asarray(store.get(bill_id)).tolist() for bill_id in store.bill_ids}
+
+def test_append_replaces_and_retires(tmp_path):
+    store = ArrayStore(str(tmp_path / 'store'), np.uint32, 3)
+    store.append([5, 1, 9], np.arange(9).reshape(3, 3))
+    # bill 1 again, and bill 7 twice in one batch: the last row wins
+    rows = store.append([1, 7, 7], [[10, 10, 10], [20, 20, 20], [21, 21, 21]])
+    assert rows.tolist() == [3, 4, 5]
+    assert current(store) == {1: [10, 10, 10], 5: [0, 1, 2], 7: [21, 21, 21], 9: [6, 7, 8]}
+    assert store.live().tolist() == [True, False, True, True, False, True]
+    assert store.rows_of([9, 2, 1]).tolist() == [2, -1, 3]
+    store.retire([5, 2])
+    assert current(store) == {1: [10, 10, 10], 7: [21, 21, 21], 9: [6, 7, 8]}
+    with pytest.raises(KeyError):
+        store.get(5)
+    # only the index files of the newest generation are kept
+    assert sorted(name for name in os.listdir(store.path) if name.startswith('keys.')) == ['keys.{0}.bin'.format(store.meta['generation'])]
+
+def test_unindexed_rows_are_live_after_update_index(tmp_path):
+    store = ArrayStore(str(tmp_path / 'store'), np.float32, 2)
+    store.append([1, 2], [[1, 1], [2, 2]])
+    store.append([2, 3], [[20, 20], [3, 3]], index=False)
+    store.append([3, 4], [[30, 30], [4, 4]], index=False)
+    assert current(store) == {1: [1, 1], 2: [2, 2]}
+    assert store.update_index() == 4
+    assert current(store) == {1: [1, 1], 2: [20, 20], 3: [30, 30], 4: [4, 4]}
+    assert store.update_index() == 0
+
+def test_ragged_store(tmp_path):
+    store = ArrayStore(str(tmp_path / 'store'), np.uint64)
+    store.append([3, 1], [np.array([1, 2, 3]), np.array([], dtype=np.uint64)])
+    store.append([2, 3], [np.array([7]), np.array([8, 9])])
+    assert current(store) == {1: [], 2: [7], 3: [8, 9]}
+    assert ArrayStore(store.path).open().offsets.tolist() == [0, 3, 3, 4, 6]
+
+def test_compact_keeps_the_live_rows(tmp_path):
+    store = ArrayStore(str(tmp_path / 'store'), np.uint64)
+    store.append([3, 1, 2], [np.array([1, 2, 3]), np.array([4]), np.array([5, 6])])
+    store.append([3], [np.array([7])])
+    store.retire([2])
+    before = current(store)
+    # leftovers of an interrupted compact() do not end up in the store
+    os.makedirs(store.path + '.compact')
+    ArrayStore(store.path + '.compact', np.uint64).append([99], [np.array([99])])
+    store.compact(batch_size=1)
+    assert current(store) == before
+    assert store.rows == 2
+    assert np.asarray(store.ids).tolist() == [1, 3]
+    assert sorted(os.listdir(tmp_path)) == ['store']
+
+def test_a_torn_append_is_cut_off(tmp_path):
+    store = ArrayStore(str(tmp_path / 'store'), np.int32, 2)
+    store.append([1], [[1, 1]])
+    # a writer that died before replacing meta.json left bytes behind
+    for name in ('data.bin', 'ids.bin'):
+        with open(store.file(name), 'ab') as f:
+            f.write(b'\xff' * 12)
+    assert current(store) == {1: [1, 1]}
+    store.append([2], [[2, 2]])
+    assert current(store) == {1: [1, 1], 2: [2, 2]}
+    assert os.path.getsize(store.file('ids.bin')) == 16
+
+def test_width_and_type_are_checked(tmp_path):
+    ArrayStore(str(tmp_path / 'store'), np.float32, 4).append([1], np.zeros((1, 4)))
+    with pytest.raises(ValueError):
+        ArrayStore(str(tmp_path / 'store'), np.float32, 8)
+    with pytest.raises(FileNotFoundError):
+        ArrayStore(str(tmp_path / 'missing'))
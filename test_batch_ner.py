@@ -0,0 +1,41 @@
+import random
+from conftest import add_bills, save_content, ruler_pipeline
+from batch_ner import BatchNER
+
+PHRASES = ['the board', 'Texas Water Development Board', 'Travis County', 'shall issue a permit', 'fee']
+
+def bill_text(rng: random.Random) -> str:
+    return ' '.join(rng.choice(PHRASES) for _ in range(30)) + '.'
+
+def entities(db) -> dict:
+    db.connect()
+    rows = db.curs.execute('SELECT bill_id, label, text, "start", "end" FROM tEntities ORDER BY bill_id, "start";').fetchall()
+    db.close()
+    found = {}
+    for bill_id, *entity in rows:
+        found.setdefault(bill_id, []).append(tuple(entity))
+    return found
+
+def expected(texts: dict) -> dict:
+    nlp = ruler_pipeline()
+    found = {bill_id: [(e.label_, e.text, e.start_char, e.end_char) for e in nlp(text).ents] for bill_id, text in texts.items()}
+    return {bill_id: ents for bill_id, ents in found.items() if len(ents) > 0}
+
+def test_batch_ner_resumes_and_redoes_changed_bills(db):
+    rng = random.Random(0)
+    texts = {i: bill_text(rng) for i in range(7)}
+    add_bills(db, [(i, 'TX', '2023', text) for i, text in texts.items()] + [(7, 'TX', '2023', None)])
+    batch = BatchNER(db, batch_size=2, n_process=1)
+    batch.ner._nlp = ruler_pipeline()
+
+    # an interrupted run leaves the remaining bills pending
+    assert batch.run(limit=3) == 3
+    assert batch.run() == 4
+    assert entities(db) == expected(texts)
+    assert batch.run() == 0
+
+    texts[2] = 'Travis County and the Texas Water Development Board.'
+    save_content(db, 2, texts[2])
+    assert batch.run() == 1
+    assert entities(db) == expected(texts)
+    assert db.top_entities('TX')['mentions'].sum() == sum(len(ents) for ents in expected(texts).values())
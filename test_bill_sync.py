@@ -0,0 +1,48 @@
+from conftest import legiscan_bill
+from bill_sync import DeltaSync
+
+class FakeLegiScan:
+    '''A master list and getBill served from memory; every getBill call is recorded'''
+    def __init__(self, bills: list):
+        self.bills = {bill['bill_id']: bill for bill in bills}
+        self.fetched = []
+
+    def get_master_list(self, state = None, session_id = None):
+        # the master list starts with an entry for the session itself
+        return [{'session_id': 1}] + [{'bill_id': bill_id, 'change_hash': bill['change_hash']} for bill_id, bill in self.bills.items()]
+
+    def get_bill(self, bill_id):
+        self.fetched.append(bill_id)
+        return dict(self.bills[bill_id])
+
+def processed(db) -> dict:
+    db.connect()
+    rows = dict(db.curs.execute('SELECT bill_id, processed_at FROM tBills;').fetchall())
+    db.close()
+    return rows
+
+def mark_processed(db):
+    db.connect()
+    db.curs.execute("UPDATE tBills SET processed_at = '2024-01-01';")
+    db.close()
+
+def test_only_changed_bills_are_fetched(db):
+    legis = FakeLegiScan([legiscan_bill(1), legiscan_bill(2), legiscan_bill(3)])
+    sync = DeltaSync(api_key='test', db=db)
+    sync.legis = legis
+    assert sync.sync(state='TX') == 3
+    mark_processed(db)
+
+    legis.fetched = []
+    assert sync.sync(state='TX') == 0
+    assert legis.fetched == []
+    assert set(processed(db).values()) == {'2024-01-01'}
+
+    # bill 1 changed status only, bill 2 has a new text version
+    legis.bills[1] = legiscan_bill(1, change_hash='b', status=2)
+    legis.bills[2] = legiscan_bill(2, change_hash='b', doc_id=2)
+    assert sync.sync(state='TX') == 2
+    assert sorted(legis.fetched) == [1, 2]
+    assert processed(db) == {1: '2024-01-01', 2: None, 3: '2024-01-01'}
+    assert db.run_query('SELECT status FROM tBills WHERE bill_id = 1')['status'][0] == 2
+    assert sorted(db.run_query('SELECT change_hash FROM tBillHashes')['change_hash']) == ['a', 'b', 'b']
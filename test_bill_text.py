@@ -0,0 +1,75 @@
+import base64
+import pytest
+import requests
+import sql_queries as SQ
+import bill_text
+from bill_text import Bill
+from conftest import add_bills
+from legiscan import LegiScanError
+
+class FakeLegiScan:
+    '''getBill and getBillText served from a dict of bill_id: text; bills missing from it fail like the API does'''
+    def __init__(self, texts: dict):
+        self.texts = texts
+
+    def get_bill(self, bill_id):
+        if bill_id not in self.texts:
+            raise LegiScanError('unknown bill')
+        return {'texts': [{'doc_id': bill_id * 10}]}
+
+    def get_bill_text(self, doc_id):
+        return {'doc': base64.b64encode(self.texts[doc_id // 10].encode('utf-8')), 'mime': 'text/plain'}
+
+@pytest.fixture
+def conn(db, monkeypatch):
+    '''Connection to the test database; documents are "parsed" by decoding them, and every website is unreachable'''
+    monkeypatch.setattr(bill_text, 'parse_document', lambda buffer, headers=None: (buffer.decode('utf-8'), None) if buffer else (None, 'tika'))
+    def unreachable(*args, **kwargs):
+        raise requests.exceptions.ConnectionError()
+    monkeypatch.setattr(bill_text.requests, 'get', unreachable)
+    add_bills(db, [(1, 'TX', '2023', None), (2, 'TX', '2023', None)])
+    db.connect()
+    for sql in SQ.SQL_EMBEDDINGS_BUILD:
+        db.curs.execute(sql)
+    yield db.conn
+    db.close()
+
+def bill(conn, bill_id: int) -> tuple:
+    return conn.execute('SELECT content, error FROM tBills WHERE bill_id = ?;', (bill_id,)).fetchone()
+
+def embedded(conn, bill_id: int) -> bool:
+    return conn.execute('SELECT 1 FROM tEmbeddingRuns WHERE bill_id = ?;', (bill_id,)).fetchone() is not None
+
+def test_api_text_with_url_fallback(conn):
+    Bill.process_bills(conn, [1, 2], sources=('api', 'url'), legis=FakeLegiScan({1: 'text of bill one'}), max_workers=2)
+    assert bill(conn, 1) == ('text of bill one', None)
+    # the api failed for bill 2, then the website could not be reached
+    assert bill(conn, 2) == (None, 'connection')
+
+def test_api_source_needs_a_client(conn):
+    with pytest.raises(ValueError):
+        Bill.process_bills(conn, [1], sources=('api', 'url'))
+    with pytest.raises(ValueError):
+        Bill.get(conn, 1).update_content(sources=('ftp',))
+    assert bill(conn, 1) == (None, None)
+
+def test_results_are_invalidated_only_when_the_text_changes(conn):
+    legis = FakeLegiScan({1: 'first text'})
+    Bill.process_bills(conn, [1], sources=('api',), legis=legis)
+    conn.execute(SQ.SQL_UPSERT_EMBEDDING_RUN, (1,))
+    # the same document again
+    Bill.process_bills(conn, [1], sources=('api',), legis=legis)
+    assert embedded(conn, 1)
+    # a failed fetch keeps the text and the results made from it
+    Bill.process_bills(conn, [1], sources=('api',), legis=FakeLegiScan({}))
+    assert bill(conn, 1) == ('first text', 'api') and embedded(conn, 1)
+    legis.texts[1] = 'second text'
+    Bill.process_bills(conn, [1], sources=('api',), legis=legis)
+    assert bill(conn, 1) == ('second text', None) and not embedded(conn, 1)
+
+def test_one_failing_bill_does_not_stop_the_others(conn, monkeypatch):
+    parse = bill_text.parse_document
+    monkeypatch.setattr(bill_text, 'parse_document', lambda buffer, headers=None: 1 / 0 if buffer == b'bad' else parse(buffer, headers))
+    Bill.process_bills(conn, [1, 2], sources=('api',), legis=FakeLegiScan({1: 'bad', 2: 'good'}))
+    assert bill(conn, 1) == (None, 'unexpected: ZeroDivisionError')
+    assert bill(conn, 2) == ('good', None)
@@ -0,0 +1,30 @@
+import random
+from minhash import MinHashLSH
+from similar import SimilarBills
+from model_bills import ModelBills
+from conftest import random_text, edit_text, add_bills
+
+def test_similar_bills_panel(db, tmp_path):
+    rng = random.Random(0)
+    text, model = random_text(rng), random_text(rng)
+    add_bills(db, [(1, 'TX', '2023', text + ' ' + model), (2, 'CO', '2023', edit_text(rng, text + ' ' + model)),
+                   (3, 'WY', '2023', random_text(rng))])
+    # nothing has been computed yet: the tables do not exist
+    assert db.similar_bills(1).empty
+
+    MinHashLSH(db=db, max_workers=1).update()
+    found = db.similar_bills(1)
+    assert found[['match', 'id', 'state']].values.tolist() == [['near duplicate', 2, 'CO']]
+
+    SimilarBills(db=db, max_workers=1).run()
+    folder = tmp_path / 'models'
+    folder.mkdir()
+    (folder / 'model_act.txt').write_text(model)
+    models = ModelBills(db, max_workers=1)
+    models.ingest(str(folder), source='test')
+    models.match()
+    found = db.similar_bills(1)
+    assert set(found['match']) == {'near duplicate', 'related', 'model source'}
+    assert found.loc[found['match'] == 'related', 'id'].iloc[0] == 2
+    assert found.loc[found['match'] == 'model source', ['code', 'title']].values.tolist() == [['test', 'model_act']]
+    assert 'near duplicate' not in set(db.similar_bills(3)['match'])
@@ -0,0 +1,95 @@
+import os
+import random
+import numpy as np
+import sql_queries as SQ
+from array_store import ArrayStore
+from conftest import random_text, edit_text, add_bills, save_content
+from embeddings import LSAEmbeddings, RandomProjectionForest, project, _build_tree
+
+def vector_store(path: str, n: int = 3000, width: int = 16) -> tuple:
+    X = np.random.default_rng(0).standard_normal((n, width)).astype(np.float32)
+    X /= np.linalg.norm(X, axis=1, keepdims=True)
+    store = ArrayStore(path, np.float32, width)
+    store.append(np.arange(n) + 1000, X)
+    return store, X
+
+def test_blocked_projection(tmp_path):
+    store, X = vector_store(str(tmp_path / 'vectors'))
+    rng = np.random.default_rng(1)
+    rows = rng.permutation(len(X))[:2000]
+    normal = rng.standard_normal(X.shape[1]).astype(np.float32)
+    np.testing.assert_allclose(project(store.open().matrix, rows, normal, block=333), X[rows] @ normal, atol=1e-5)
+
+def test_tree_leaves_partition_the_live_rows(tmp_path):
+    store, X = vector_store(str(tmp_path / 'vectors'))
+    store.append([1000, 1001], X[:2])
+    tree = _build_tree((store.path, 50, 1))
+    leaves = tree['left'] < 0
+    assert (tree['stop'][leaves] - tree['start'][leaves]).max() <= 50
+    assert sorted(tree['order'].tolist()) == sorted(np.flatnonzero(store.open().live()).tolist())
+
+def lsa(db, **params) -> LSAEmbeddings:
+    return LSAEmbeddings(db, dims=8, n_features=2**12, n_trees=2, leaf_size=8, batch_size=16, max_workers=1, **params)
+
+def corpus(db, n: int = 60) -> list:
+    rng = random.Random(0)
+    texts = [random_text(rng) for _ in range(n)]
+    add_bills(db, [(i, 'TX', '2023', text) for i, text in enumerate(texts)])
+    return texts
+
+def embedded(db) -> int:
+    return db.run_query('SELECT COUNT(*) AS n FROM tEmbeddingRuns')['n'][0]
+
+def test_build_swaps_in_a_complete_index(db):
+    texts = corpus(db)
+    embeddings = lsa(db)
+    assert embeddings.build() == len(texts)
+    assert sorted(os.listdir(db.path_data)) == ['embeddings', 'legislation.db']
+    assert sorted(os.listdir(embeddings.path)) == ['model.joblib', 'trees', 'vectors']
+    assert embedded(db) == len(texts)
+    # a second build replaces the first one and the old index keeps answering until then
+    reader = lsa(db).open()
+    add_bills(db, [(100, 'TX', '2023', edit_text(random.Random(1), texts[7]))])
+    embeddings.build()
+    assert reader.neighbors(7, k=3)['bill_id'].tolist()[0] != 100
+    assert lsa(db).neighbors(7, k=3)['bill_id'].tolist()[0] == 100
+    assert embedded(db) == len(texts) + 1
+
+def test_bills_saved_during_a_build_stay_pending(db):
+    corpus(db)
+    db.connect()
+    db.curs.execute("UPDATE tBills SET processed_at = '9999-01-01' WHERE bill_id = 3;")
+    db.close()
+    lsa(db).build()
+    assert db.run_query(SQ.SQL_PENDING_EMBEDDING_BILLS)['bill_id'].tolist() == [3]
+
+def test_update_embeds_changed_bills(db):
+    texts = corpus(db)
+    embeddings = lsa(db)
+    embeddings.build()
+    save_content(db, 5, edit_text(random.Random(1), texts[20]))
+    assert embeddings.update() == 1
+    assert embeddings.neighbors(20, k=3)['bill_id'].tolist()[0] == 5
+    assert embeddings.forest.store.rows == len(texts) + 1
+    assert embedded(db) == len(texts)
+
+def test_update_rebuilds_past_max_unindexed(db):
+    texts = corpus(db)
+    embeddings = lsa(db, max_unindexed=3)
+    embeddings.build()
+    add_bills(db, [(100 + i, 'TX', '2023', random_text(random.Random(i))) for i in range(2)])
+    embeddings.update()
+    assert embeddings.forest.open().unindexed == 2
+    add_bills(db, [(200 + i, 'TX', '2023', random_text(random.Random(i))) for i in range(2)])
+    embeddings.update()
+    assert embeddings.forest.open().unindexed == 0
+
+def test_search_scores_at_most_max_unindexed_appended_rows(tmp_path):
+    store, X = vector_store(str(tmp_path / 'vectors'), n=200)
+    forest = RandomProjectionForest(str(tmp_path), n_trees=2, leaf_size=8, max_unindexed=5, max_workers=1).build()
+    query = X[0]
+    # ten new bills with the query vector itself: only the newest five are scored
+    store.append(np.arange(10) + 5000, np.tile(query, (10, 1)))
+    rows, scores = forest.search(query, k=20, search_k=8)
+    assert forest.unindexed == 10
+    assert sorted(np.asarray(store.open().ids[rows[rows >= 200]]).tolist()) == list(range(5005, 5010))
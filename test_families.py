@@ -0,0 +1,76 @@
+import random
+from conftest import add_bills, set_pairs
+from families import CopyFamilies, UnionFind
+
+def components(edges) -> set:
+    '''Connected components of two or more bills, brute force'''
+    sets = UnionFind()
+    for bill_id, other_id in edges:
+        sets.union(bill_id, other_id)
+    return {frozenset(members) for members in sets.groups().values() if len(members) > 1}
+
+def stored(db) -> set:
+    '''Families in tFamilyMembers, checked against tCopyFamilies'''
+    db.connect()
+    members = db.curs.execute('SELECT bill_id, family_id FROM tFamilyMembers;').fetchall()
+    summaries = {row[0]: row[1:] for row in db.curs.execute('SELECT family_id, representative, bills, states FROM tCopyFamilies;')}
+    db.close()
+    families = {}
+    for bill_id, family_id in members:
+        families.setdefault(family_id, set()).add(bill_id)
+    assert set(summaries) == set(families)
+    for family_id, bills in families.items():
+        representative, n_bills, n_states = summaries[family_id]
+        # a family id is always one of its bills
+        assert family_id in bills and representative in bills
+        assert n_bills == len(bills)
+        assert n_states == len({bill_id % 3 for bill_id in bills})
+    return {frozenset(bills) for bills in families.values()}
+
+def test_incremental_families_match_connected_components(db):
+    add_bills(db, [(i, 'S' + str(i % 3), '2023', 'text') for i in range(40)])
+    families = CopyFamilies(db, pairs_table='tPairs')
+    rng = random.Random(0)
+    pairs = {}
+    for step in range(30):
+        # add a few pairs, drop a few and move some across the threshold
+        for _ in range(rng.randint(0, 6)):
+            b, o = sorted(rng.sample(range(40), 2))
+            pairs[(b, o)] = rng.choice([0.9, 0.95])
+        for edge in rng.sample(sorted(pairs), min(len(pairs), rng.randint(0, 3))):
+            del pairs[edge]
+        for edge in rng.sample(sorted(pairs), min(len(pairs), rng.randint(0, 2))):
+            pairs[edge] = rng.choice([0.5, 0.9])
+        set_pairs(db, pairs)
+        families.update()
+        assert stored(db) == components(edge for edge, score in pairs.items() if score >= 0.8), step
+    families.rebuild()
+    assert stored(db) == components(edge for edge, score in pairs.items() if score >= 0.8)
+
+def test_manual_merge_and_split(db):
+    add_bills(db, [(i, 'S' + str(i % 3), '2023', 'text') for i in range(10)])
+    families = CopyFamilies(db, pairs_table='tPairs')
+    set_pairs(db, {(1, 2): 0.9, (2, 3): 0.9, (5, 6): 0.9})
+    families.update()
+    assert stored(db) == {frozenset({1, 2, 3}), frozenset({5, 6})}
+
+    families.merge(3, 5)
+    assert stored(db) == {frozenset({1, 2, 3, 5, 6})}
+    # a manual edge is not a pair, so it survives an update
+    families.update()
+    assert stored(db) == {frozenset({1, 2, 3, 5, 6})}
+
+    families.split(2, 3)
+    assert stored(db) == {frozenset({1, 2}), frozenset({3, 5, 6})}
+    # a blocked pair does not come back, and a new chain of pairs still joins the bills
+    families.update()
+    assert stored(db) == {frozenset({1, 2}), frozenset({3, 5, 6})}
+    set_pairs(db, {(1, 2): 0.9, (2, 3): 0.9, (5, 6): 0.9, (2, 7): 0.9, (7, 3): 0.9})
+    families.update()
+    assert stored(db) == {frozenset({1, 2, 3, 5, 6, 7})}
+
+    families.rebuild()
+    assert stored(db) == {frozenset({1, 2, 3, 5, 6, 7})}
+    set_pairs(db, {})
+    families.update()
+    assert stored(db) == {frozenset({3, 5})}
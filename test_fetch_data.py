@@ -0,0 +1,135 @@
+import base64
+import io
+import json
+import os
+import zipfile
+import pandas as pd
+import pytest
+from conftest import legiscan_bill
+from fetch_data import FetchData, bill_record
+
+def dataset_zip(bills: list) -> bytes:
+    '''A dataset zip in Legiscan's layout, with a people file next to the bill files'''
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as z:
+        for bill in bills:
+            z.writestr('{0}/2023-2023_Regular/bill/{1}.json'.format(bill['state'], bill['bill_number']), json.dumps({'bill': bill}))
+        z.writestr('TX/2023-2023_Regular/people/1.json', json.dumps({'person': {}}))
+    return buffer.getvalue()
+
+def fetcher(path_out: str = './data', legis = None) -> FetchData:
+    '''FetchData without the download and write steps its constructor runs'''
+    fetch = FetchData.__new__(FetchData)
+    fetch.legis = legis
+    fetch.partition = None
+    fetch.file_format = 'csv'
+    fetch.PATH_OUT = path_out
+    fetch.PATH_MANIFEST = os.path.join(path_out, 'dataset_manifest.json')
+    return fetch
+
+def test_zip_is_read_in_memory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    fetch = fetcher()
+    fetch.dataset = {'zip': base64.b64encode(dataset_zip([legiscan_bill(1), legiscan_bill(2, state='CO')]))}
+    fetch.open_dataset_zip()
+    fetch.process_zip()
+    fetch.create_dataframe()
+    assert sorted(fetch.get_json_filenames()) == ['CO/2023-2023_Regular/bill/HB2.json', 'TX/2023-2023_Regular/bill/HB1.json']
+    df = fetch.get_dataframe().set_index('bill_id')
+    assert df.loc[2, 'state'] == 'CO' and df.loc[1, 'session'] == '2023 Regular Session'
+    assert df.loc[1, 'url'] == 'https://example.com/1'
+    # "0000-00-00" dates become null, as in process_json
+    assert df['status_date'].isnull().all()
+    assert os.listdir(tmp_path) == []
+
+def test_saved_zip_is_memory_mapped(tmp_path):
+    path = tmp_path / 'dataset.zip'
+    path.write_bytes(dataset_zip([legiscan_bill(3)]))
+    fetch = fetcher()
+    fetch.open_dataset_zip(str(path))
+    assert [name for name, text in fetch.iter_zip_json()] == ['TX/2023-2023_Regular/bill/HB3.json']
+    assert json.loads(next(fetch.iter_zip_json())[1])['bill']['bill_id'] == 3
+    assert os.listdir(tmp_path) == ['dataset.zip']
+
+class FakeLegiScan:
+    '''Dataset list and zips served from memory; every getDataset call is recorded'''
+    def __init__(self, datasets: dict):
+        self.datasets = datasets # session_id: (dataset_hash, [bills])
+        self.fetched = []
+
+    def get_dataset_list(self):
+        return [{'session_id': session_id, 'dataset_hash': dataset_hash, 'state_id': 43, 'access_key': 'key'}
+                for session_id, (dataset_hash, bills) in self.datasets.items()]
+
+    def get_dataset(self, session_id, access_key):
+        self.fetched.append(session_id)
+        return {'zip': base64.b64encode(dataset_zip(self.datasets[session_id][1]))}
+
+def test_sync_downloads_only_changed_datasets(db, tmp_path, monkeypatch):
+    legis = FakeLegiScan({1: ('h1', [legiscan_bill(1), legiscan_bill(2)]), 2: ('h2', [legiscan_bill(3, state='CO')])})
+    fetch = fetcher(str(tmp_path), legis)
+    upserts = []
+    upsert_bills = db.upsert_bills
+    monkeypatch.setattr(db, 'upsert_bills', lambda df: upserts.append(sorted(df['bill_id'])) or upsert_bills(df))
+
+    assert fetch.sync_datasets(db) == ['1', '2']
+    assert legis.fetched == [1, 2] and upserts == [[1, 2], [3]]
+    assert sorted(db.run_query('SELECT bill_id FROM tBills')['bill_id']) == [1, 2, 3]
+
+    # unchanged hashes: nothing is downloaded or upserted
+    legis.fetched, upserts[:] = [], []
+    assert fetch.sync_datasets(db) == []
+    assert legis.fetched == [] and upserts == []
+
+    legis.datasets[1] = ('h1b', [legiscan_bill(1), legiscan_bill(4)])
+    assert fetch.sync_datasets(db) == ['1']
+    assert legis.fetched == [1] and upserts == [[1, 4]]
+    with open(fetch.PATH_MANIFEST) as f:
+        manifest = json.load(f)
+    assert {session_id: entry['dataset_hash'] for session_id, entry in manifest.items()} == {'1': 'h1b', '2': 'h2'}
+    # the csv keeps the bills of the other datasets and of earlier syncs
+    assert sorted(pd.read_csv(os.path.join(str(tmp_path), 'bills-with-urls.csv'))['bill_id']) == [1, 2, 3, 4]
+
+def test_interrupted_sync_resumes(db, tmp_path):
+    legis = FakeLegiScan({1: ('h1', [legiscan_bill(1)]), 2: ('h2', [legiscan_bill(2)])})
+    fetch = fetcher(str(tmp_path), legis)
+    get_dataset = legis.get_dataset
+    legis.get_dataset = lambda session_id, access_key: get_dataset(session_id, access_key) if session_id == 1 else 1 / 0
+    with pytest.raises(ZeroDivisionError):
+        fetch.sync_datasets(db)
+    legis.get_dataset = get_dataset
+    legis.fetched = []
+    assert fetch.sync_datasets(db) == ['2']
+    assert legis.fetched == [2]
+
+def partitioner(tmp_path, bills: list, partition: str = 'session', file_format: str = 'csv') -> FetchData:
+    fetch = fetcher(str(tmp_path))
+    fetch.partition = partition
+    fetch.file_format = file_format
+    fetch.PATH_PARTITION_DIR = os.path.join(str(tmp_path), 'partitions', partition)
+    fetch.PATH_PARTITIONS = os.path.join(fetch.PATH_PARTITION_DIR, 'partitions.json')
+    fetch.all_bill_data = {bill['bill_id']: bill_record(bill, str(bill['bill_id'])) for bill in bills}
+    fetch.create_dataframe()
+    return fetch
+
+@pytest.mark.parametrize('file_format', ['csv', 'parquet'])
+def test_partitions_merge_and_reload_only_changed_files(db, tmp_path, file_format):
+    bills = [legiscan_bill(1), legiscan_bill(2, session='2021 Regular Session'), legiscan_bill(3, state='CO')]
+    fetch = partitioner(tmp_path, bills, file_format=file_format)
+    fetch.df_to_partitions(max_workers=2)
+    names = ['CO_2023_Regular_Session', 'TX_2021_Regular_Session', 'TX_2023_Regular_Session']
+    assert sorted(os.listdir(fetch.PATH_PARTITION_DIR)) == sorted([name + '.' + file_format for name in names] + ['partitions.json'])
+    assert sorted(db.load_partitions(manifest_path=fetch.PATH_PARTITIONS)) == sorted(name + '.' + file_format for name in names)
+
+    # a later dataset replaces bill 1 and adds bill 4 to one partition
+    changed = dict(legiscan_bill(1), title='New title')
+    fetch = partitioner(tmp_path, [changed, legiscan_bill(4)], file_format=file_format)
+    assert list(fetch.df_to_partitions()) == ['TX_2023_Regular_Session.' + file_format]
+    path = os.path.join(fetch.PATH_PARTITION_DIR, 'TX_2023_Regular_Session.' + file_format)
+    merged = pd.read_parquet(path) if file_format == 'parquet' else pd.read_csv(path)
+    assert merged['bill_id'].tolist() == [1, 4] and merged['title'].tolist() == ['New title', 'Title 4']
+    with open(fetch.PATH_PARTITIONS) as f:
+        assert sorted(json.load(f)) == sorted(name + '.' + file_format for name in names)
+    assert db.load_partitions(manifest_path=fetch.PATH_PARTITIONS) == ['TX_2023_Regular_Session.' + file_format]
+    assert db.run_query('SELECT title FROM tBills WHERE bill_id = 1')['title'][0] == 'New title'
+    assert db.load_partitions(manifest_path=fetch.PATH_PARTITIONS) == []
@@ -0,0 +1,52 @@
+import spacy
+from spacy.language import Language
+from conftest import add_bills, save_content
+from keywords import KeywordEngine
+
+@Language.component('test_noun_tagger')
+def noun_tagger(doc):
+    # stands in for a trained tagger: every word is a noun and its own lemma
+    for token in doc:
+        token.pos_ = 'NOUN'
+        token.lemma_ = token.lower_
+    return doc
+
+def tagging_pipeline():
+    nlp = spacy.blank('en')
+    nlp.add_pipe('test_noun_tagger')
+    return nlp
+
+def term_df(db) -> tuple:
+    '''The stored document frequencies and the ones counted from scratch from tBillTerms'''
+    db.connect()
+    stored = dict(db.curs.execute('SELECT term, df FROM tTermDF;').fetchall())
+    counted = dict(db.curs.execute('SELECT term, COUNT(*) FROM tBillTerms GROUP BY term;').fetchall())
+    db.close()
+    return stored, counted
+
+def test_document_frequencies_follow_content_changes(db):
+    add_bills(db, [(1, 'TX', '2023', 'water permit board'),
+                   (2, 'TX', '2023', 'water school district'),
+                   (3, 'TX', '2023', 'school tax levy'),
+                   (4, 'CO', '2023', 'water river compact'),
+                   (5, 'CO', '2023', 'river tax')])
+    engine = KeywordEngine(db, batch_size=2, n_process=1)
+    engine._nlp = tagging_pipeline()
+    assert engine.update() == 5
+    stored, counted = term_df(db)
+    assert stored == counted and stored['water'] == 3
+
+    save_content(db, 2, 'groundwater district')
+    save_content(db, 3, None)
+    save_content(db, 5, '')
+    assert engine.update() == 1
+    stored, counted = term_df(db)
+    assert stored == counted
+    assert stored['water'] == 2 and 'school' not in stored and 'tax' not in stored
+    db.connect()
+    assert db.curs.execute('SELECT COUNT(*) FROM tTermDF WHERE df <= 0;').fetchone()[0] == 0
+    assert sorted(row[0] for row in db.curs.execute('SELECT bill_id FROM tKeywordRuns;')) == [1, 2, 4]
+    assert sorted(row[0] for row in db.curs.execute('SELECT DISTINCT bill_id FROM tKeywords;')) == [1, 2, 4]
+    db.close()
+    # nothing left to do
+    assert engine.update() == 0
@@ -0,0 +1,75 @@
+import random
+import numpy as np
+from minhash import MinHashLSH
+from conftest import random_text, edit_text, add_bills, save_content
+
+def near_duplicates(db) -> set:
+    db.connect()
+    pairs = set(db.curs.execute('SELECT bill_id, other_id FROM tNearDuplicates;').fetchall())
+    db.close()
+    return pairs
+
+def make_corpus(db, rng):
+    '''20 unrelated bills, and bills 101-110 as near copies of bills 1-10'''
+    texts = {bill_id: random_text(rng) for bill_id in range(1, 21)}
+    texts.update({100 + bill_id: edit_text(rng, texts[bill_id]) for bill_id in range(1, 11)})
+    add_bills(db, [(bill_id, 'WY', '2023', text) for bill_id, text in texts.items()])
+    return texts
+
+def test_update_finds_near_duplicates(db):
+    rng = random.Random(1)
+    make_corpus(db, rng)
+    index = MinHashLSH(db=db, batch_size=7, max_workers=1)
+    assert index.update() == 30
+    pairs = near_duplicates(db)
+    assert {(b, b + 100) for b in range(1, 11)} <= pairs
+    assert all((o, b) in pairs for b, o in pairs)
+    # every batch was indexed once at the end: 30 live rows, one per bill
+    assert index.store.live().sum() == 30 and len(index.store.bill_ids) == 30
+
+def test_changed_and_too_short_text(db):
+    rng = random.Random(2)
+    texts = make_corpus(db, rng)
+    index = MinHashLSH(db=db, max_workers=1)
+    index.update()
+    save_content(db, 101, random_text(rng))
+    save_content(db, 102, 'too short')
+    assert index.update() == 2
+    pairs = near_duplicates(db)
+    assert (1, 101) not in pairs and (101, 1) not in pairs
+    assert (2, 102) not in pairs and (102, 2) not in pairs
+    assert index.store.row_of(102) < 0 and index.band_store.row_of(102) < 0
+    assert index.query(2) == [] or 102 not in dict(index.query(2))
+    assert (3, 103) in pairs
+
+def test_reopen_and_compact(db):
+    rng = random.Random(3)
+    make_corpus(db, rng)
+    MinHashLSH(db=db, max_workers=1).update()
+    save_content(db, 104, edit_text(rng, random_text(rng)))
+    index = MinHashLSH(db=db, max_workers=1)
+    index.update()
+    before = {b: index.query(b) for b in (1, 5, 105)}
+    assert index.store.rows == 31
+    index.compact()
+    assert index.store.rows == 30
+    assert {b: index.query(b) for b in (1, 5, 105)} == before
+    np.testing.assert_array_equal(MinHashLSH(db=db, max_workers=1).store.bill_ids, index.store.bill_ids)
+
+def test_band_index_merges_new_rows(db):
+    rng = random.Random(4)
+    texts = make_corpus(db, rng)
+    index = MinHashLSH(db=db, batch_size=7, max_workers=1)
+    index.update(limit=12)
+    index.update()
+    save_content(db, 3, edit_text(rng, texts[3]))
+    index.update()
+    # the merged order is the one a full stable sort of the band keys gives
+    band_keys = np.asarray(index.band_store.matrix).T
+    order = np.argsort(band_keys, axis=1, kind='stable')
+    np.testing.assert_array_equal(index.band_index.order, order)
+    np.testing.assert_array_equal(index.band_index.keys, np.take_along_axis(band_keys, order, axis=1))
+    # a reader maps the saved order instead of sorting again
+    reader = MinHashLSH(db=db, max_workers=1)
+    assert isinstance(reader.band_index.order, np.memmap) and reader.band_index.rows == index.band_store.rows
+    assert reader.query(3) == index.query(3) and 103 in dict(reader.query(3))
@@ -0,0 +1,35 @@
+import random
+from model_bills import ModelBills
+from conftest import random_text, add_bills, save_content
+
+def matched(db) -> set:
+    db.connect()
+    pairs = set(db.curs.execute('SELECT m.bill_id, mb.title FROM tModelMatches m JOIN tModelBills mb ON mb.model_id = m.model_id;').fetchall())
+    db.close()
+    return pairs
+
+def test_bills_are_matched_again_when_the_corpus_or_their_text_changes(db, tmp_path):
+    rng = random.Random(0)
+    models = {'water_act': random_text(rng), 'tax_act': random_text(rng)}
+    folder = tmp_path / 'models'
+    folder.mkdir()
+    (folder / 'water_act.txt').write_text(models['water_act'])
+    add_bills(db, [(1, 'TX', '2023', random_text(rng, 50) + ' ' + models['water_act']),
+                   (2, 'CO', '2023', random_text(rng, 50) + ' ' + models['tax_act']),
+                   (3, 'CO', '2023', random_text(rng))])
+    engine = ModelBills(db, max_workers=1)
+    assert engine.ingest(str(folder), source='test') == 1
+    assert engine.match() == 3
+    assert matched(db) == {(1, 'water_act')}
+    assert engine.match() == 0
+
+    # unchanged files are not read again; a new model document requeues every bill
+    (folder / 'tax_act.txt').write_text(models['tax_act'])
+    assert engine.ingest(str(folder), source='test') == 1
+    assert engine.match() == 3
+    assert matched(db) == {(1, 'water_act'), (2, 'tax_act')}
+
+    # new text only requeues that bill
+    save_content(db, 1, random_text(rng))
+    assert engine.match() == 1
+    assert matched(db) == {(2, 'tax_act')}
@@ -0,0 +1,41 @@
+import random
+import spacy
+from conftest import ruler_pipeline
+from ner import NERService, chunk_text
+
+def long_bill(n_sections: int = 60) -> str:
+    rng = random.Random(0)
+    sections = []
+    for k in range(n_sections):
+        words = [rng.choice(['the', 'board', 'shall', 'permit', 'fee', 'Texas Water Development Board', 'Travis County']) for _ in range(rng.randint(20, 80))]
+        sections.append('SECTION {0}. '.format(k + 1) + ' '.join(words) + '.')
+    return '\n\n'.join(sections)
+
+def test_chunks_cover_the_text():
+    text = long_bill()
+    chunks = chunk_text(text, max_chars=2000, overlap=200)
+    assert len(chunks) > 3
+    assert all(len(chunk) <= 2000 for offset, chunk in chunks)
+    assert all(text[offset:offset + len(chunk)] == chunk for offset, chunk in chunks)
+    assert chunks[0][0] == 0 and chunks[-1][0] + len(chunks[-1][1]) == len(text)
+    # every chunk starts before the previous one ends, so the chunks overlap
+    assert all(offset < previous + len(chunk) for (previous, chunk), (offset, _) in zip(chunks, chunks[1:]))
+    # a chunk ends before a section heading where there is one
+    assert all(text[offset + len(chunk):].startswith('SECTION') for offset, chunk in chunks[:-1])
+
+def test_chunked_entities_match_the_whole_text():
+    nlp = ruler_pipeline()
+    text = long_bill()
+    service = NERService(nlp=nlp, max_chars=1500, overlap=300, n_process=1)
+    doc = service.docs([text])[0]
+    whole = nlp(text)
+    assert doc.text == text
+    assert [(e.start_char, e.end_char, e.label_) for e in doc.ents] == [(e.start_char, e.end_char, e.label_) for e in whole.ents]
+
+def test_merge_keeps_one_copy_of_entities_in_the_overlap():
+    service = NERService(nlp=spacy.blank('en'))
+    text = 'aa Travis County bb cc Travis County dd'
+    # chunks [0, 30) and [10, 39): both see the entity at 23-36, only the second one owns its start
+    chunks = [(0, 30, [(3, 16, 'GPE'), (23, 30, 'GPE')]), (10, 29, [(13, 26, 'GPE')])]
+    doc = service.merge_chunks(text, chunks)
+    assert [(e.start_char, e.end_char, e.label_) for e in doc.ents] == [(3, 16, 'GPE'), (23, 36, 'GPE')]
@@ -0,0 +1,37 @@
+import random
+import pandas as pd
+from ngram_index import NgramIndex
+from conftest import random_text, add_bills
+
+def test_small_runs_build_the_same_index(db, tmp_path, monkeypatch):
+    rng = random.Random(0)
+    texts = {bill_id: random_text(rng) for bill_id in range(1, 13)}
+    boilerplate = 'be it enacted by the legislature of the state that the following is added'
+    for bill_id in range(1, 9):
+        texts[bill_id] = boilerplate + ' ' + texts[bill_id]
+    # an omnibus bill with a 40 word section of bill 3 in it
+    passage = ' '.join(texts[3].split()[100:140])
+    texts[100] = random_text(rng, 300) + ' ' + passage + ' ' + random_text(rng, 300)
+    add_bills(db, [(bill_id, 'TX', '2023', text) for bill_id, text in texts.items()])
+
+    runs = []
+    write_run = NgramIndex.write_run
+    def counted_write_run(self, postings, run_dir, written):
+        runs.append(self.run_size)
+        return write_run(self, postings, run_dir, written)
+    monkeypatch.setattr(NgramIndex, 'write_run', counted_write_run)
+    small = NgramIndex(db, n=8, max_df=5, run_size=300, buckets=4, batch_size=2, path=str(tmp_path / 'small'))
+    whole = NgramIndex(db, n=8, max_df=5, path=str(tmp_path / 'whole'))
+    assert small.build() == whole.build()
+    assert runs.count(300) > 5 and runs.count(whole.run_size) == 1
+
+    found = small.query(100)
+    assert found['bill_id'].tolist() == [3]
+    assert found['shared'].iloc[0] == 40 - 8 + 1
+    assert found['position'].iloc[0] == 100
+    assert found['query_position'].iloc[0] == 300
+    pd.testing.assert_frame_equal(found, whole.query(100))
+    # the boilerplate is in more than max_df bills, so it is not indexed
+    assert small.query_text(boilerplate).empty
+    for bill_id in (1, 3, 11):
+        pd.testing.assert_frame_equal(small.query(bill_id), whole.query(bill_id))
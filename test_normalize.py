@@ -0,0 +1,81 @@
+import os
+import re
+import sqlite3
+import pytest
+from normalize import normalize_text, Normalizer
+from conftest import add_bills
+
+SHIPPED_DB = os.path.join(os.path.dirname(__file__), 'data', 'legislation.db')
+
+# a Colorado bill as Tika returns it from the PDF: margin line numbers, the formatting note and the draft number
+CO_BILL = '''HOUSE BILL 23-1041
+Capital letters or bold & italic numbers indicate new material to be added to existing law.
+Dashes through the words or numbers indicate deletions from existing law.
+1 A BILL FOR AN ACT
+2 CONCERNING THE BOARD OF COUNTY COMMISSIONERS.
+3 Be it enacted by the General Assembly of the State of Colorado:
+4 SECTION 1. In Colorado Revised Statutes, 30-10-104, amend
+5 (2) as follows:
+6 30-10-104. Notice. (2) The notice must be given at least
+7 30 days after the meeting, and the
+8 15 members of the commission shall
+9
+10 receive 2 percent of the fees.
+'''
+
+def shipped_bill(bill_id: int) -> tuple:
+    conn = sqlite3.connect(SHIPPED_DB)
+    row = conn.execute('SELECT state, content FROM tBills WHERE bill_id = (?);', (bill_id,)).fetchone()
+    conn.close()
+    return row
+
+def test_quantities_at_the_start_of_wrapped_lines_are_kept():
+    text = 'The notice is due\n30 days after notice, the\n15 members of the commission shall\n2 percent'
+    assert normalize_text(text) == text
+
+def test_margin_line_numbers_are_removed():
+    clean = normalize_text(CO_BILL, 'CO')
+    assert 'indicate new material' not in clean and 'HOUSE BILL 23-1041' not in clean
+    assert 'enacted by the General Assembly' not in clean
+    assert [line for line in clean.splitlines() if line != ''] == ['A BILL FOR AN ACT',
+                                  'CONCERNING THE BOARD OF COUNTY COMMISSIONERS.',
+                                  'SECTION 1. In Colorado Revised Statutes, 30-10-104, amend',
+                                  '(2) as follows:',
+                                  '30-10-104. Notice. (2) The notice must be given at least',
+                                  '30 days after the meeting, and the',
+                                  '15 members of the commission shall',
+                                  'receive 2 percent of the fees.']
+
+@pytest.mark.skipif(not os.path.exists(SHIPPED_DB), reason='needs the shipped data/legislation.db')
+def test_shipped_texas_bill():
+    state, content = shipped_bill(218501)
+    clean = normalize_text(content, state)
+    # draft number, enacting clause and the non-breaking spaces Tika kept from the HTML are gone
+    assert '82R1314' not in clean and 'BE IT ENACTED' not in clean and '\xa0' not in clean
+    assert '\n\n\n' not in clean
+    # every number of the bill body is still there
+    body = content.replace('\xa0', ' ')
+    body = body[body.index('SECTION 1.'):]
+    assert re.findall(r'\d+', body) == re.findall(r'\d+', clean[clean.index('SECTION 1.'):])
+    assert 'amended by Chapters 198 (H.B. 2292) and 1251 (S.B. 1862), Acts of' in clean
+    assert 'program during the state fiscal biennium ending August 31, 2003.' in clean
+
+@pytest.mark.skipif(not os.path.exists(SHIPPED_DB), reason='needs the shipped data/legislation.db')
+def test_shipped_texas_resolution_keeps_its_text():
+    state, content = shipped_bill(301998)
+    clean = normalize_text(content, state)
+    # only the H.R. No. header line is dropped
+    raw = re.sub(r'\n[ \t]*H\.R\. No\. 987[ \t]*\n', '\n', content.replace('\xa0', ' '), count=1)
+    assert 'H.R. No. 987' not in clean.splitlines()
+    assert re.findall(r'[A-Za-z0-9]+', raw) == re.findall(r'[A-Za-z0-9]+', clean)
+
+def test_rebuild_normalizes_every_bill_again(db):
+    add_bills(db, [(1, 'CO', '2023', CO_BILL), (2, 'CO', '2023', 'The notice is due\n30 days after notice')])
+    normalizer = Normalizer(db=db, max_workers=1)
+    assert normalizer.run() == 2
+    assert normalizer.run() == 0
+    assert normalizer.rebuild() == 2
+    db.connect()
+    clean = dict(db.curs.execute('SELECT bill_id, content FROM tCleanText;').fetchall())
+    db.close()
+    assert clean[2] == 'The notice is due\n30 days after notice'
@@ -0,0 +1,74 @@
+import random
+import pytest
+import sql_queries as SQ
+from conftest import add_bills
+from rollups import Rollups
+
+def brute_force(db) -> tuple:
+    '''Both rollups counted from scratch from tEntities, tKeywords and the current state, session and status of the bills'''
+    db.connect()
+    entities = {tuple(row[:5]): tuple(row[5:]) for row in db.curs.execute("""
+        SELECT b.state, b.session, COALESCE(b.status, 0), e.label, e.text, COUNT(*), COUNT(DISTINCT e.bill_id)
+        FROM tEntities e JOIN tBills b ON b.bill_id = e.bill_id
+        GROUP BY 1, 2, 3, 4, 5;""")}
+    keywords = {tuple(row[:4]): (row[4], pytest.approx(row[5])) for row in db.curs.execute("""
+        SELECT b.state, b.session, COALESCE(b.status, 0), k.term, COUNT(*), SUM(k.score)
+        FROM tKeywords k JOIN tBills b ON b.bill_id = k.bill_id
+        GROUP BY 1, 2, 3, 4;""")}
+    db.close()
+    return entities, keywords
+
+def stored(db) -> tuple:
+    db.connect()
+    entities = {tuple(row[:5]): tuple(row[5:]) for row in db.curs.execute('SELECT state, session, status, label, text, n, bills FROM tEntityRollup;')}
+    keywords = {tuple(row[:4]): tuple(row[4:]) for row in db.curs.execute('SELECT state, session, status, term, bills, score FROM tKeywordRollup;')}
+    db.close()
+    return entities, keywords
+
+def replace_rows(db, rollups: Rollups, rng: random.Random, bill_ids: list):
+    '''Rewrite the entities and keywords of bills the way batch_ner and keywords do: remove, replace the rows, add, in one transaction'''
+    db.connect()
+    db.curs.execute('BEGIN;')
+    for kind in ('entity', 'keyword'):
+        rollups.remove(db.curs, kind, bill_ids)
+    ids = ', '.join(str(b) for b in bill_ids)
+    db.curs.execute('DELETE FROM tEntities WHERE bill_id IN (' + ids + ');')
+    db.curs.execute('DELETE FROM tKeywords WHERE bill_id IN (' + ids + ');')
+    for bill_id in bill_ids:
+        db.curs.executemany('INSERT INTO tEntities (bill_id, label, text, "start", "end") VALUES (?, ?, ?, 0, 1);',
+                            [(bill_id, rng.choice(['ORG', 'GPE']), rng.choice(['Texas', 'EPA', 'Board'])) for _ in range(rng.randint(0, 4))])
+        terms = rng.sample(['water', 'tax', 'school', 'permit'], rng.randint(0, 3))
+        db.curs.executemany('INSERT INTO tKeywords (bill_id, term, score, rank) VALUES (?, ?, ?, ?);',
+                            [(bill_id, term, rng.random(), rank) for rank, term in enumerate(terms)])
+    for kind in ('entity', 'keyword'):
+        rollups.add(db.curs, kind, bill_ids)
+    db.curs.execute('COMMIT;')
+    db.close()
+    return
+
+def test_rollup_deltas_match_a_recount(db):
+    rng = random.Random(0)
+    add_bills(db, [(i, rng.choice(['TX', 'CO']), rng.choice(['2022', '2023']), 'text') for i in range(20)])
+    db.connect()
+    for sql in SQ.SQL_ENTITIES_BUILD + SQ.SQL_KEYWORDS_BUILD:
+        db.curs.execute(sql)
+    db.close()
+    rollups = Rollups(db)
+    for step in range(20):
+        replace_rows(db, rollups, rng, rng.sample(range(20), rng.randint(1, 6)))
+        # the status or session of a bill changes after it was counted
+        db.connect()
+        for bill_id in rng.sample(range(20), rng.randint(0, 3)):
+            db.curs.execute('UPDATE tBills SET status = ?, session = ? WHERE bill_id = ?;', (rng.randint(1, 4), rng.choice(['2022', '2023']), bill_id))
+        db.close()
+        rollups.move_changed()
+        assert stored(db) == brute_force(db), step
+    # no group is left behind with nothing in it
+    assert all(bills > 0 for n, bills in stored(db)[0].values())
+    db.connect()
+    db.curs.execute('BEGIN;')
+    for kind in rollups.KINDS:
+        rollups.rebuild(db.curs, kind)
+    db.curs.execute('COMMIT;')
+    db.close()
+    assert stored(db) == brute_force(db)
@@ -0,0 +1,76 @@
+import os
+import random
+import threading
+import time
+from shard_jobs import ShardRunner, StatePairJob
+from shingles import shingle_set
+from conftest import random_text, edit_text, add_bills, save_content
+
+def jaccard_pairs(db) -> dict:
+    db.connect()
+    pairs = {(b, o): score for b, o, score in db.curs.execute('SELECT bill_id, other_id, score FROM tJaccardPairs;')}
+    db.close()
+    return pairs
+
+def brute_force(texts: dict, threshold: float) -> set:
+    sets = {b: set(shingle_set(text, 5).tolist()) for b, text in texts.items()}
+    return {(b, o) for b in sets for o in sets if b != o and len(sets[b] & sets[o]) / len(sets[b] | sets[o]) >= threshold}
+
+def corpus(db, rng) -> dict:
+    texts = {}
+    for k, state in enumerate(['WY', 'UT', 'CO']):
+        for b in range(10):
+            texts[100 * k + b] = random_text(rng)
+    for b in range(5):
+        texts[300 + b] = edit_text(rng, texts[b], 10)        # CO copies of WY bills
+        texts[310 + b] = edit_text(rng, texts[100 + b], 10)  # CO copies of UT bills
+    add_bills(db, [(b, ['WY', 'UT', 'CO', 'CO'][b // 100], '2023', text) for b, text in texts.items()])
+    return texts
+
+def test_state_pairs_match_brute_force_and_rerun_replaces_them(db, tmp_path):
+    rng = random.Random(1)
+    texts = corpus(db, rng)
+    runner = ShardRunner(StatePairJob(threshold=0.5), run='first', db=db, max_workers=2, path=str(tmp_path / 'shards'))
+    assert runner.run() == 6
+    runner.merge()
+    assert set(jaccard_pairs(db)) == brute_force(texts, 0.5) and len(jaccard_pairs(db)) == 20
+    db.connect()
+    assert db.curs.execute('SELECT COUNT(*) FROM tNearDuplicates;').fetchone()[0] == 0
+    db.close()
+
+    texts[300] = random_text(rng)
+    save_content(db, 300, texts[300])
+    runner = ShardRunner(StatePairJob(threshold=0.5), run='second', db=db, max_workers=2, path=str(tmp_path / 'shards'))
+    runner.run()
+    runner.merge()
+    pairs = jaccard_pairs(db)
+    assert (0, 300) not in pairs and (300, 0) not in pairs
+    assert set(pairs) == brute_force(texts, 0.5)
+
+def test_locks(db, tmp_path):
+    runner = ShardRunner(StatePairJob(), db=db, lock_timeout=60, path=str(tmp_path / 'shards'))
+    lock = runner.shard_path('WY-UT', '.lock')
+    with open(lock, 'w') as f:
+        f.write('other-host:1')
+    # a live lock of another worker is neither claimed nor released
+    assert not runner.claim('WY-UT')
+    runner.release('WY-UT')
+    assert os.path.exists(lock)
+    # a lock that was not touched for lock_timeout is taken over
+    os.utime(lock, (time.time() - 120, time.time() - 120))
+    assert runner.claim('WY-UT') and runner.holds('WY-UT')
+    runner.release('WY-UT')
+    assert not os.path.exists(lock)
+
+def test_heartbeat_keeps_the_lock_fresh(db, tmp_path):
+    runner = ShardRunner(StatePairJob(), db=db, lock_timeout=10, path=str(tmp_path / 'shards'))
+    assert runner.claim('WY-UT')
+    lock = runner.shard_path('WY-UT', '.lock')
+    os.utime(lock, (time.time() - 100, time.time() - 100))
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=runner.heartbeat, args=('WY-UT', stop))
+    heartbeat.start()
+    time.sleep(1.5)
+    stop.set()
+    heartbeat.join()
+    assert time.time() - os.path.getmtime(lock) < 5
@@ -0,0 +1,47 @@
+import random
+import numpy as np
+from similar import SimilarBills, load_matrix
+from conftest import random_text, edit_text, add_bills
+
+def similar_pairs(db) -> dict:
+    db.connect()
+    pairs = {(b, o): score for b, o, score in db.curs.execute('SELECT bill_id, other_id, score FROM tSimilar;')}
+    db.close()
+    return pairs
+
+def test_two_bills(db):
+    rng = random.Random(1)
+    text = random_text(rng)
+    add_bills(db, [(1, 'WY', '2023', text), (2, 'UT', '2023', edit_text(rng, text))])
+    assert SimilarBills(db=db, max_workers=1).run() == 2
+    assert similar_pairs(db).keys() == {(1, 2), (2, 1)}
+
+def test_top_k_in_small_batches_and_blocks(db):
+    rng = random.Random(2)
+    texts = {b: random_text(rng) for b in range(1, 41)}
+    texts.update({100 + b: edit_text(rng, texts[b], 20) for b in range(1, 21)})
+    add_bills(db, [(b, 'WY', '2023', text) for b, text in texts.items()])
+    job = SimilarBills(db=db, top_k=3, min_score=0.1, batch_size=7, memory_mb=1, max_workers=2)
+    job.run()
+    X = load_matrix(job.path)
+    assert X.shape[0] == 60
+    np.testing.assert_allclose(np.asarray(X.multiply(X).sum(axis=1)).ravel(), 1, rtol=1e-4)
+    pairs = similar_pairs(db)
+    best = {}
+    for (b, o), score in pairs.items():
+        if score > best.get(b, (None, -1))[1]:
+            best[b] = (o, score)
+    assert all(best[b][0] == b + 100 and best[b + 100][0] == b for b in range(1, 21))
+    assert max(sum(1 for b, o in pairs if b == bill_id) for bill_id in texts) <= 3
+
+def test_bills_without_text_lose_their_pairs(db):
+    rng = random.Random(3)
+    text = random_text(rng)
+    add_bills(db, [(b, 'WY', '2023', edit_text(rng, text)) for b in range(1, 6)])
+    job = SimilarBills(db=db, max_workers=1)
+    job.run()
+    db.connect()
+    db.curs.execute('UPDATE tBills SET content = NULL WHERE bill_id = 3;')
+    db.close()
+    job.run()
+    assert not any(3 in pair for pair in similar_pairs(db))
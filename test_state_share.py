@@ -0,0 +1,66 @@
+import random
+import pytest
+from conftest import add_bills, set_pairs
+from state_share import StateShareMatrix
+
+def brute_force(db, min_score: float = 0.5) -> tuple:
+    '''Both matrices counted from scratch from the pair table and the current states and sessions of the bills'''
+    db.connect()
+    bills = {row[0]: row[1:] for row in db.curs.execute('SELECT bill_id, state, session FROM tBills;')}
+    pairs = db.curs.execute('SELECT bill_id, other_id, score FROM tPairs WHERE score >= ?;', (min_score,)).fetchall()
+    db.close()
+    states, sessions = {}, {}
+    for bill_id, other_id, score in pairs:
+        (state, session), (other_state, other_session) = bills[bill_id], bills[other_id]
+        for cells, key in ((states, (state, other_state)), (sessions, (state, session, other_state, other_session))):
+            cell = cells.setdefault(key, [0, set(), set(), 0.0])
+            cell[0] += 1
+            cell[1].add(bill_id)
+            cell[2].add(other_id)
+            cell[3] += score
+    count = lambda cells: {key: (n, len(b), len(o), pytest.approx(total / n)) for key, (n, b, o, total) in cells.items()}
+    return count(states), count(sessions)
+
+def stored(db) -> tuple:
+    db.connect()
+    states = {tuple(row[:2]): tuple(row[2:]) for row in db.curs.execute('SELECT state, other_state, pairs, bills, other_bills, score FROM tStateShare;')}
+    sessions = {tuple(row[:4]): tuple(row[4:]) for row in db.curs.execute("""
+        SELECT state, session, other_state, other_session, pairs, bills, other_bills, score FROM tStateSessionShare;""")}
+    db.close()
+    return states, sessions
+
+def test_incremental_matrix_matches_a_recount(db):
+    rng = random.Random(0)
+    bills = {i: (rng.choice('ABC'), rng.choice(['2022', '2023'])) for i in range(30)}
+    add_bills(db, [(i, state, session, 'text') for i, (state, session) in bills.items()])
+    matrix = StateShareMatrix(db, pairs_table='tPairs')
+    pairs = {}
+    for step in range(25):
+        for _ in range(rng.randint(0, 8)):
+            b, o = sorted(rng.sample(range(30), 2))
+            pairs[(b, o)] = round(rng.uniform(0.3, 1.0), 2)
+        for edge in rng.sample(sorted(pairs), min(len(pairs), rng.randint(0, 3))):
+            del pairs[edge]
+        # a bill moves to another state or session
+        for bill_id in rng.sample(range(30), rng.randint(0, 2)):
+            bills[bill_id] = (rng.choice('ABC'), rng.choice(['2022', '2023']))
+            add_bills(db, [(bill_id,) + bills[bill_id] + ('text',)])
+        set_pairs(db, pairs)
+        matrix.update()
+        assert stored(db) == brute_force(db), step
+    matrix.rebuild()
+    assert stored(db) == brute_force(db)
+
+def test_a_moved_bill_leaves_its_old_cells(db):
+    add_bills(db, [(1, 'WY', '2023', 'text'), (2, 'UT', '2023', 'text'), (3, 'UT', '2023', 'text')])
+    matrix = StateShareMatrix(db, pairs_table='tPairs')
+    set_pairs(db, {(1, 2): 0.9, (1, 3): 0.7})
+    matrix.update()
+    assert stored(db)[0] == {('WY', 'UT'): (2, 1, 2, pytest.approx(0.8)), ('UT', 'WY'): (2, 2, 1, pytest.approx(0.8))}
+    add_bills(db, [(3, 'CO', '2024', 'text')])
+    assert matrix.update() == 4
+    states, sessions = stored(db)
+    assert states[('WY', 'UT')] == (1, 1, 1, pytest.approx(0.9))
+    assert states[('CO', 'WY')] == (1, 1, 1, pytest.approx(0.7))
+    assert ('UT', '2023', 'WY', '2023') in sessions and ('CO', '2024', 'WY', '2023') in sessions
+    assert (states, sessions) == brute_force(db)
@@ -0,0 +1,51 @@
+import random
+import numpy as np
+import pytest
+from topics import TopicModel
+from conftest import add_bills, save_content
+
+WATER = ['water', 'river', 'aquifer', 'irrigation', 'drought', 'reservoir', 'groundwater', 'wells']
+TAX = ['taxes', 'revenue', 'levy', 'exemption', 'assessment', 'appraisal', 'income', 'franchise']
+
+def text(rng: random.Random, words: list) -> str:
+    return ' '.join(rng.choice(words) for _ in range(100))
+
+def weights(db) -> dict:
+    db.connect()
+    rows = db.curs.execute('SELECT bill_id, topic_id, weight FROM tBillTopics;').fetchall()
+    db.close()
+    found = {}
+    for bill_id, topic_id, weight in rows:
+        found.setdefault(bill_id, {})[topic_id] = weight
+    return found
+
+def main_topic(found: dict, bill_id: int) -> int:
+    return max(found[bill_id], key=found[bill_id].get)
+
+@pytest.mark.parametrize('method', ['lda', 'nmf'])
+def test_new_bills_are_folded_in(db, tmp_path, method):
+    rng = random.Random(0)
+    add_bills(db, [(i, 'TX', '2023', text(rng, WATER if i % 2 else TAX)) for i in range(1, 21)])
+    model = TopicModel(db, n_topics=2, method=method, batch_size=8, n_jobs=1, path=str(tmp_path / 'topics.joblib'))
+    assert model.update() == 20
+    assert model.update() == 0
+    found = weights(db)
+    water, tax = main_topic(found, 1), main_topic(found, 2)
+    assert water != tax
+
+    # a new process loads the saved model and only folds in the new bills
+    add_bills(db, [(21, 'CO', '2023', text(rng, WATER)), (22, 'CO', '2023', text(rng, TAX))])
+    reopened = TopicModel(db, n_topics=5, method='lda', batch_size=8, n_jobs=1, path=str(tmp_path / 'topics.joblib'))
+    assert reopened.model is None
+    assert reopened.update() == 2
+    assert reopened.n_topics == 2 and reopened.method == method
+    found = weights(db)
+    assert main_topic(found, 21) == water and main_topic(found, 22) == tax
+    assert set(found) == set(range(1, 23))
+
+    # new text requeues only that bill, which moves to the other topic
+    save_content(db, 1, text(rng, TAX))
+    updated = reopened.model.components_.copy()
+    assert reopened.update() == 1
+    assert not np.allclose(reopened.model.components_, updated)
+    assert main_topic(weights(db), 1) == tax
@@ -0,0 +1,191 @@
+from create_database import MyDB
+import sql_queries as SQ
+import argparse
+import os
+import joblib
+import numpy as np
+from sklearn.feature_extraction.text import CountVectorizer, TfidfTransformer
+from sklearn.decomposition import LatentDirichletAllocation, MiniBatchNMF
+
+class TopicModel:
+    '''
+    Topic model over the bill texts in tBills. The first train() fits a vocabulary and an LDA (or NMF) model on a sparse document-term matrix of every bill with text, using all cores. After that, update() folds newly fetched bills into the model with mini-batch partial_fit instead of retraining; words that were not in the original vocabulary are ignored until the next full train().
+
+    The fitted vectorizer and model are saved with joblib, topic terms go to tTopics and the per-bill topic weights to tBillTopics, indexed by topic so browsing the bills of a topic or the topics of a state/session is a lookup.
+
+    class parameters:
+
+    db: MyDB instance for legislation.db (default: MyDB())
+    n_topics: number of topics (default: int = 20)
+    method: 'lda' (LatentDirichletAllocation on term counts) or 'nmf' (MiniBatchNMF on tf-idf) (default: str = 'lda')
+    max_features: size of the vocabulary (default: int = 20000)
+    batch_size: number of bills per partial_fit batch and per database read (default: int = 256)
+    n_jobs: processes LDA uses, -1 uses every core (default: int = -1)
+    min_weight: topic weights below this are not stored for a bill (default: float = 0.05)
+    path: where the fitted model is saved (default: data/topic_model.joblib)
+    '''
+
+    def __init__(self,
+                 db: MyDB = None,
+                 n_topics: int = 20,
+                 method: str = 'lda',
+                 max_features: int = 20000,
+                 batch_size: int = 256,
+                 n_jobs: int = -1,
+                 min_weight: float = 0.05,
+                 path: str = None,
+                ):
+        if method not in ('lda', 'nmf'):
+            raise ValueError("method must be 'lda' or 'nmf'")
+        self.db = db if db is not None else MyDB()
+        self.n_topics = n_topics
+        self.method = method
+        self.max_features = max_features
+        self.batch_size = batch_size
+        self.n_jobs = n_jobs
+        self.min_weight = min_weight
+        self.path = path or os.path.join(self.db.path_data, 'topic_model.joblib')
+        self.vectorizer = None
+        self.transformer = None
+        self.model = None
+        self.build_tables()
+
+    def build_tables(self):
+        '''Create the topic tables and their indexes if they do not exist'''
+        self.db.connect()
+        for sql in SQ.SQL_TOPICS_BUILD:
+            self.db.curs.execute(sql)
+        self.db.close()
+        return
+
+    def load(self):
+        '''Load the saved vectorizer and model; the saved method and number of topics replace the ones passed to the class'''
+        saved = joblib.load(self.path)
+        self.vectorizer, self.transformer, self.model = saved['vectorizer'], saved['transformer'], saved['model']
+        self.method, self.n_topics = saved['method'], saved['n_topics']
+        return
+
+    def save(self):
+        joblib.dump({'vectorizer': self.vectorizer, 'transformer': self.transformer, 'model': self.model,
+                     'method': self.method, 'n_topics': self.n_topics}, self.path + '.tmp')
+        os.replace(self.path + '.tmp', self.path)
+        return
+
+    def iter_content(self, sql: str, params: tuple = ()):
+        '''Yield (bill_id, content) pages of batch_size bills, so the corpus is never held in memory as a list of strings'''
+        self.db.connect()
+        bill_ids = [row[0] for row in self.db.curs.execute(sql, params)]
+        self.db.close()
+        for i in range(0, len(bill_ids), self.batch_size):
+            chunk = bill_ids[i:i + self.batch_size]
+            self.db.connect()
+            rows = self.db.curs.execute(SQ.SQL_SELECT_CLEAN_CONTENT.format(', '.join('?' * len(chunk))), chunk).fetchall()
+            self.db.close()
+            yield rows
+
+    def features(self, texts):
+        '''Document-term matrix in the form the model expects (counts for LDA, tf-idf for NMF)'''
+        counts = self.vectorizer.transform(texts)
+        return counts if self.transformer is None else self.transformer.transform(counts)
+
+    def train(self):
+        '''Fit the vocabulary and the model from scratch on every bill with text, then write all topic weights'''
+        bill_ids = []
+        def texts():
+            for rows in self.iter_content(SQ.SQL_SELECT_BILLS_WITH_CONTENT):
+                for bill_id, content in rows:
+                    bill_ids.append(bill_id)
+                    yield content
+
+        self.db.connect()
+        n_bills = self.db.curs.execute(SQ.SQL_COUNT_BILLS_WITH_CONTENT).fetchone()[0]
+        self.db.close()
+        if n_bills == 0:
+            print('no bills with text to train on')
+            return 0
+        # min_df=2 drops words of a single bill, but needs enough bills that max_df still leaves room for it
+        self.vectorizer = CountVectorizer(max_features=self.max_features, stop_words='english', min_df=2 if 0.95 * n_bills >= 2 else 1, max_df=0.95,
+                                          token_pattern=r'(?u)\b[a-zA-Z][a-zA-Z]+\b')
+        counts = self.vectorizer.fit_transform(texts())
+        print('document-term matrix:', counts.shape)
+        if self.method == 'lda':
+            self.transformer = None
+            self.model = LatentDirichletAllocation(n_components=self.n_topics, learning_method='online',
+                                                   batch_size=self.batch_size, n_jobs=self.n_jobs, random_state=1)
+            weights = self.model.fit_transform(counts)
+        else:
+            self.transformer = TfidfTransformer()
+            self.model = MiniBatchNMF(n_components=self.n_topics, batch_size=self.batch_size, random_state=1)
+            weights = self.model.fit_transform(self.transformer.fit_transform(counts))
+        self.save()
+
+        self.db.connect()
+        self.db.curs.execute('BEGIN;')
+        self.db.curs.execute('DELETE FROM tBillTopics;')
+        self.db.curs.execute('DELETE FROM tTopicRuns;')
+        self.db.curs.execute('COMMIT;')
+        self.db.close()
+        self.write_topics()
+        self.write_weights(bill_ids, weights)
+        return len(bill_ids)
+
+    def update(self) -> int:
+        '''Fold bills that have no topic weights yet into the saved model with partial_fit and write their weights. Trains from scratch if there is no saved model'''
+        if self.model is None and os.path.exists(self.path):
+            self.load()
+        if self.model is None:
+            return self.train()
+        done = 0
+        for rows in self.iter_content(SQ.SQL_PENDING_TOPIC_BILLS):
+            features = self.features(content for bill_id, content in rows)
+            self.model.partial_fit(features)
+            self.write_weights([bill_id for bill_id, content in rows], self.model.transform(features))
+            done += len(rows)
+            print(done, 'bills added to the topic model')
+        if done > 0:
+            self.save()
+            self.write_topics()
+        return done
+
+    def write_topics(self, n_terms: int = 10):
+        '''Store the top terms of every topic'''
+        terms = self.vectorizer.get_feature_names_out()
+        rows = [(topic_id, ', '.join(terms[np.argsort(component)[::-1][:n_terms]]))
+                for topic_id, component in enumerate(self.model.components_)]
+        self.db.connect()
+        self.db.curs.execute('BEGIN;')
+        self.db.curs.execute('DELETE FROM tTopics;')
+        self.db.curs.executemany(SQ.SQL_INSERT_TOPIC, rows)
+        self.db.curs.execute('COMMIT;')
+        self.db.close()
+        return rows
+
+    def write_weights(self, bill_ids: list, weights: np.ndarray):
+        '''Store the normalized topic weights of each bill that are at least min_weight, and mark the bills as done'''
+        weights = weights / np.maximum(weights.sum(axis=1, keepdims=True), 1e-12)
+        rows, cols = np.nonzero(weights >= self.min_weight)
+        bill_ids = np.asarray(bill_ids)
+        self.db.connect()
+        self.db.curs.execute('BEGIN;')
+        self.db.curs.execute('DELETE FROM tBillTopics WHERE bill_id IN (' + ', '.join(str(int(b)) for b in bill_ids) + ');')
+        self.db.curs.executemany(SQ.SQL_INSERT_BILL_TOPIC, zip(bill_ids[rows].tolist(), cols.tolist(), weights[rows, cols].tolist()))
+        self.db.curs.executemany(SQ.SQL_UPSERT_TOPIC_RUN, [(int(b),) for b in bill_ids])
+        self.db.curs.execute('COMMIT;')
+        self.db.close()
+        return
+
+    def session_topics(self, state: str, session: str):
+        '''Average topic weight over the bills of a state/session, with the topic terms'''
+        return self.db.run_query(SQ.SQL_SELECT_SESSION_TOPICS, {'state': state, 'session': session})
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Train the topic model or fold newly fetched bills into it')
+    args.add_argument('--train', action='store_true', help='retrain from scratch instead of updating')
+    args.add_argument('--n-topics', type=int, default=20)
+    args.add_argument('--method', default='lda', choices=['lda', 'nmf'])
+    args = args.parse_args()
+    topics = TopicModel(n_topics=args.n_topics, method=args.method)
+    if args.train:
+        topics.train()
+    else:
+        topics.update()